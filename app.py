@@ -30,62 +30,182 @@ from email.mime.base import MIMEBase
 from email import encoders
 import requests
 from io import BytesIO
+import io
+import csv
+import tempfile
 import base64
 import traceback
 import os
 import sys
 import inspect
 import logging
+import threading
+import atexit
+import argparse
 from typing import Dict, List, Optional, Tuple, Any, Union, Callable
 import sqlite3
 from sqlite3 import Error as SqliteError
 from contextlib import contextmanager
 import pickle
+import copy
+import heapq
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import warnings
+import importlib
+import types
+
+# msgpack es opcional: solo se usa si se elige como formato de los archivos de datos
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
 warnings.filterwarnings('ignore')
 
+# ============================================
+# IMPORTACIONES DIFERIDAS
+# ============================================
+# Las librerías pesadas (IA, PDF, NLP, vectores) se importan la primera vez
+# que se usan: la página de inicio se sirve sin cargar la pila de ML.
+
+class LazyModule(types.ModuleType):
+    """Módulo que se importa de verdad al acceder al primero de sus atributos"""
+    
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+    
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_module"]
+        if module is None:
+            with self.__dict__["_lock"]:
+                module = self.__dict__["_module"]
+                if module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self.__name__)
+                    LAZY_IMPORT_TIMES[self.__name__] = time.perf_counter() - start
+                    self.__dict__["_module"] = module
+        return module
+    
+    @property
+    def loaded(self) -> bool:
+        return self.__dict__["_module"] is not None
+    
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+    
+    def __repr__(self):
+        state = "cargado" if self.loaded else "diferido"
+        return f"<LazyModule {self.__name__} ({state})>"
+
+
+class LazyAttribute:
+    """Clase o función de un módulo diferido (equivale a `from módulo import nombre`)"""
+    
+    def __init__(self, module: LazyModule, name: str):
+        self._module = module
+        self._name = name
+    
+    def resolve(self):
+        return getattr(self._module._load(), self._name)
+    
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+    
+    def __getattr__(self, attribute: str):
+        return getattr(self.resolve(), attribute)
+    
+    def __repr__(self):
+        return f"<LazyAttribute {self._module.__name__}.{self._name}>"
+
+
+# Módulos diferidos registrados y segundos que tardó cada importación real
+LAZY_MODULES: Dict[str, LazyModule] = {}
+LAZY_IMPORT_TIMES: Dict[str, float] = {}
+
+
+def lazy_import(module_name: str, attribute: str = None):
+    """Registra un módulo diferido; con `attribute` devuelve uno de sus nombres"""
+    module = LAZY_MODULES.get(module_name)
+    if module is None:
+        module = LAZY_MODULES[module_name] = LazyModule(module_name)
+    return module if attribute is None else LazyAttribute(module, attribute)
+
+
+def preload_modules(names) -> dict:
+    """Importa ya los módulos diferidos de la lista (un paquete incluye sus submódulos)"""
+    results = {}
+    for module_name, module in LAZY_MODULES.items():
+        if not any(module_name == name or module_name.startswith(name + ".") for name in names):
+            continue
+        try:
+            module._load()
+            results[module_name] = True
+        except Exception as e:
+            logger.warning(f"No se pudo precargar {module_name}: {e}")
+            results[module_name] = False
+    return results
+
+
+def lazy_modules_status() -> dict:
+    """Estado de cada módulo diferido: milisegundos de importación o None si no se ha usado"""
+    return {
+        name: round(LAZY_IMPORT_TIMES[name] * 1000, 1) if module.loaded else None
+        for name, module in LAZY_MODULES.items()
+    }
+
+
 # Importaciones para IA y ML
-import google.generativeai as genai
-from groq import Groq
-import openai
-from openai import OpenAI
-import anthropic
-from anthropic import Anthropic
-import cohere
-from cohere import Client as CohereClient
+genai = lazy_import("google.generativeai")
+Groq = lazy_import("groq", "Groq")
+openai = lazy_import("openai")
+OpenAI = lazy_import("openai", "OpenAI")
+anthropic = lazy_import("anthropic")
+Anthropic = lazy_import("anthropic", "Anthropic")
+cohere = lazy_import("cohere")
+CohereClient = lazy_import("cohere", "Client")
 
 # Importaciones para PDF y reportes
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch, cm
-from reportlab.pdfgen import canvas
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import pypdf as PyPDF2
-from pypdf import PdfReader, PdfWriter
-import seaborn as sns
-from wordcloud import WordCloud, STOPWORDS
-import networkx as nx
+colors = lazy_import("reportlab.lib.colors")
+pagesizes = lazy_import("reportlab.lib.pagesizes")
+enums = lazy_import("reportlab.lib.enums")
+SimpleDocTemplate = lazy_import("reportlab.platypus", "SimpleDocTemplate")
+Table = lazy_import("reportlab.platypus", "Table")
+TableStyle = lazy_import("reportlab.platypus", "TableStyle")
+Paragraph = lazy_import("reportlab.platypus", "Paragraph")
+Spacer = lazy_import("reportlab.platypus", "Spacer")
+Image = lazy_import("reportlab.platypus", "Image")
+getSampleStyleSheet = lazy_import("reportlab.lib.styles", "getSampleStyleSheet")
+ParagraphStyle = lazy_import("reportlab.lib.styles", "ParagraphStyle")
+canvas = lazy_import("reportlab.pdfgen.canvas")
+pdfmetrics = lazy_import("reportlab.pdfbase.pdfmetrics")
+TTFont = lazy_import("reportlab.pdfbase.ttfonts", "TTFont")
+PyPDF2 = lazy_import("pypdf")
+PdfReader = lazy_import("pypdf", "PdfReader")
+PdfWriter = lazy_import("pypdf", "PdfWriter")
+sns = lazy_import("seaborn")
+WordCloud = lazy_import("wordcloud", "WordCloud")
+nx = lazy_import("networkx")
 
 # Importaciones para procesamiento de texto
-import nltk
-from nltk.tokenize import word_tokenize, sent_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer, PorterStemmer
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-import spacy
-from textblob import TextBlob
-import gensim
-from gensim import corpora, models
+nltk = lazy_import("nltk")
+word_tokenize = lazy_import("nltk.tokenize", "word_tokenize")
+sent_tokenize = lazy_import("nltk.tokenize", "sent_tokenize")
+stopwords = lazy_import("nltk.corpus", "stopwords")
+WordNetLemmatizer = lazy_import("nltk.stem", "WordNetLemmatizer")
+PorterStemmer = lazy_import("nltk.stem", "PorterStemmer")
+SentimentIntensityAnalyzer = lazy_import("nltk.sentiment.vader", "SentimentIntensityAnalyzer")
+spacy = lazy_import("spacy")
+TextBlob = lazy_import("textblob", "TextBlob")
+gensim = lazy_import("gensim")
+corpora = lazy_import("gensim.corpora")
+models = lazy_import("gensim.models")
 
 # Importaciones para base de datos vectorial
-import chromadb
-from chromadb import Client, Settings
-from chromadb.config import Settings as ChromaSettings
-from chromadb.utils import embedding_functions
+chromadb = lazy_import("chromadb")
+embedding_functions = lazy_import("chromadb.utils.embedding_functions")
 
 # Importaciones para audio (sesiones de hipnosis)
 # ============================================
@@ -209,7 +329,8 @@ st.set_page_config(
 # Inicialización de estado de sesión
 if 'initialized' not in st.session_state:
     st.session_state.initialized = True
-    st.session_state.page = "home"
+    # Una sesión que vuelve con un diagnóstico en segundo plano (?job=) retoma esa página
+    st.session_state.page = "diagnostic" if "job" in st.query_params else "home"
     st.session_state.user_data = {}
     st.session_state.diagnostic_history = []
     st.session_state.session_history = []
@@ -239,6 +360,10 @@ class ConfigManager:
     
     def _load_config(self):
         """Carga la configuración desde secrets"""
+        self._load_database_config()
+        self._load_performance_config()
+        self._load_ai_routing_config()
+        
         try:
             # Configuración de email
             self.email_config = {
@@ -342,6 +467,88 @@ class ConfigManager:
             "payout_day": "thursday",
             "default_currency": "USD"
         }
+    
+    def _load_database_config(self):
+        """Carga la configuración de almacenamiento (sección [database])"""
+        database = {}
+        try:
+            database = dict(st.secrets.get("database", {}))
+        except Exception as e:
+            logger.warning(f"Sección [database] no disponible, usando valores por defecto: {e}")
+        
+        self.database_config = {
+            "type": str(database.get("type", "json")).lower(),
+            "serializer": str(database.get("serializer", "json")).lower(),
+            "path": database.get("path", "data/"),
+            "sqlite_file": database.get("sqlite_file", "mindgeekclinic.db"),
+            "payments_journal": bool(database.get("payments_journal", True)),
+            "payments_journal_max_kb": int(database.get("payments_journal_max_kb", 512)),
+            "counter_flush_ms": int(database.get("counter_flush_ms", 500)),
+            "counter_flush_events": int(database.get("counter_flush_events", 100)),
+            "vector_path": database.get("vector_path", "chroma_db")
+        }
+    
+    def _load_ai_routing_config(self):
+        """Carga el enrutado entre proveedores de IA (sección [ai_routing])"""
+        routing = {}
+        try:
+            routing = dict(st.secrets.get("ai_routing", {}))
+        except Exception as e:
+            logger.warning(f"Sección [ai_routing] no disponible, usando valores por defecto: {e}")
+        
+        self.ai_routing_config = {
+            # Orden de preferencia; los proveedores sin clave configurada se omiten
+            "providers": [str(name).lower() for name in routing.get("providers", ["groq", "openai", "anthropic"])],
+            "models": {
+                "groq": "mixtral-8x7b-32768",
+                "openai": "gpt-4o-mini",
+                "anthropic": "claude-3-5-haiku-latest",
+                **dict(routing.get("models", {}))
+            },
+            "timeouts_s": {
+                "groq": 20.0,
+                "openai": 30.0,
+                "anthropic": 30.0,
+                **{name: float(value) for name, value in dict(routing.get("timeouts_s", {})).items()}
+            },
+            # Segunda petición a un proveedor de respaldo si la primera supera el p95
+            "hedging": bool(routing.get("hedging", False)),
+            "hedge_default_ms": float(routing.get("hedge_default_ms", 8000)),
+            "hedge_min_samples": int(routing.get("hedge_min_samples", 20)),
+            # Errores consecutivos tras los que un proveedor pasa al final de la cola
+            "max_consecutive_errors": int(routing.get("max_consecutive_errors", 3)),
+            # Tasa de error reciente que también lo manda al final, solo con suficientes muestras
+            "error_rate_threshold": float(routing.get("error_rate_threshold", 0.5)),
+            "error_rate_min_samples": int(routing.get("error_rate_min_samples", 20)),
+            "cooldown_s": float(routing.get("cooldown_s", 60))
+        }
+    
+    def _load_performance_config(self):
+        """Carga la configuración de rendimiento (sección [performance])"""
+        performance = {}
+        try:
+            performance = dict(st.secrets.get("performance", {}))
+        except Exception as e:
+            logger.warning(f"Sección [performance] no disponible, usando valores por defecto: {e}")
+        
+        self.performance_config = {
+            # Módulos diferidos que se importan al arrancar en lugar de en su primer uso
+            "eager_imports": list(performance.get("eager_imports", [])),
+            # Precarga en segundo plano al arrancar el proceso
+            "warmup": bool(performance.get("warmup", False)),
+            "preconnect_llm": bool(performance.get("preconnect_llm", False)),
+            # Respuestas del chat mostradas token a token
+            "chat_streaming": bool(performance.get("chat_streaming", True)),
+            # Caché de respuestas del LLM para perfiles de síntomas repetidos
+            "diagnosis_cache_size": int(performance.get("diagnosis_cache_size", 256)),
+            "diagnosis_cache_ttl_hours": float(performance.get("diagnosis_cache_ttl_hours", 24)),
+            # Diagnósticos en segundo plano: hilos, conservación de resultados y sondeo de la página
+            "diagnosis_workers": int(performance.get("diagnosis_workers", 2)),
+            "diagnosis_job_retention_hours": float(performance.get("diagnosis_job_retention_hours", 24)),
+            "diagnosis_poll_seconds": float(performance.get("diagnosis_poll_seconds", 1.5)),
+            # Minutos que se conservan los archivos de exportación temporales
+            "export_retention_minutes": float(performance.get("export_retention_minutes", 60))
+        }
 
 # ============================================
 # PARTE 4: SISTEMA DE EMAIL MEJORADO
@@ -662,29 +869,2066 @@ class EmailService:
 # PARTE 5: BASE DE DATOS COMPLETA
 # ============================================
 
+class Serializer:
+    """Formato de los archivos de datos; los binarios llevan una cabecera con su nombre"""
+    
+    name = ""
+    binary = False
+    
+    def dumps(self, data) -> bytes:
+        raise NotImplementedError
+    
+    def loads(self, payload: bytes):
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """JSON indentado (formato original, legible a mano)"""
+    
+    name = "json"
+    
+    def dumps(self, data) -> bytes:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    
+    def loads(self, payload: bytes):
+        return json.loads(payload)
+
+
+class CompactJSONSerializer(JSONSerializer):
+    """JSON sin espacios: mismo contenido, archivos más pequeños y lectura más rápida"""
+    
+    name = "json-compact"
+    
+    def dumps(self, data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+
+class MsgpackSerializer(Serializer):
+    """msgpack (dependencia opcional)"""
+    
+    name = "msgpack"
+    binary = True
+    
+    def dumps(self, data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+    
+    def loads(self, payload: bytes):
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+class PickleSerializer(Serializer):
+    """pickle protocolo 5; solo para archivos locales de confianza"""
+    
+    name = "pickle"
+    binary = True
+    
+    def dumps(self, data) -> bytes:
+        return pickle.dumps(data, protocol=5)
+    
+    def loads(self, payload: bytes):
+        return pickle.loads(payload)
+
+
+SERIALIZERS = {
+    serializer.name: serializer
+    for serializer in (JSONSerializer(), CompactJSONSerializer(), MsgpackSerializer(), PickleSerializer())
+}
+
+# Cabecera de los archivos binarios: b"MGDB <formato>\n"; sin ella el archivo es JSON
+DATA_FILE_MAGIC = b"MGDB "
+
+
+def get_serializer(name: str) -> Serializer:
+    """Serializador configurado, con JSON como alternativa si no está disponible"""
+    serializer = SERIALIZERS.get(name)
+    if serializer is None:
+        logger.warning(f"Serializador desconocido '{name}', usando json")
+        return SERIALIZERS["json"]
+    if serializer.name == "msgpack" and not MSGPACK_AVAILABLE:
+        logger.warning("msgpack no está instalado, usando json-compact")
+        return SERIALIZERS["json-compact"]
+    return serializer
+
+
+def encode_data_file(data, serializer: Serializer) -> bytes:
+    """Contenido de un archivo de datos en el formato indicado"""
+    payload = serializer.dumps(data)
+    if serializer.binary:
+        return DATA_FILE_MAGIC + serializer.name.encode("ascii") + b"\n" + payload
+    return payload
+
+
+def decode_data_file(content: bytes):
+    """Interpreta un archivo de datos detectando su formato por la cabecera"""
+    if content.startswith(DATA_FILE_MAGIC):
+        header, _, payload = content.partition(b"\n")
+        name = header[len(DATA_FILE_MAGIC):].decode("ascii")
+        if name == "msgpack" and not MSGPACK_AVAILABLE:
+            raise RuntimeError("El archivo está en formato msgpack y msgpack no está instalado")
+        return SERIALIZERS[name].loads(payload)
+    return json.loads(content)
+
+
+def read_data_file(path: str):
+    """Lee un archivo de datos en cualquiera de los formatos soportados"""
+    with open(path, 'rb') as f:
+        return decode_data_file(f.read())
+
+
+def write_data_file(path: str, data, serializer: Serializer):
+    """Escribe un archivo de datos y lo lleva a disco antes de devolver"""
+    with open(path, 'wb') as f:
+        f.write(encode_data_file(data, serializer))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class JSONItemStream:
+    """Lector incremental de un archivo JSON: recorre los elementos del objeto o
+    lista raíz (o de una sección del objeto raíz) leyendo por bloques, sin
+    cargar el archivo completo en memoria"""
+    
+    CHUNK_SIZE = 64 * 1024
+    _WHITESPACE = re.compile(r"\s*")
+    _STRING_TAIL = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+    _STRUCTURAL = re.compile(r'["{}\[\]]')
+    _DELIMITERS = ",:]} \t\r\n"
+    
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+    
+    def _fill(self) -> bool:
+        """Descarta lo ya consumido y añade el siguiente bloque"""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+    
+    def _peek(self) -> str:
+        while True:
+            self.pos = self._WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+    
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"JSON inválido: se esperaba '{char}' en la posición {self.pos}")
+        self.pos += 1
+    
+    def _decode(self):
+        """Decodifica el valor completo en la posición actual"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # Un número cortado por el bloque ("1" de "1e5") podría continuar:
+                # solo se acepta si le sigue un delimitador
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in self._DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+    
+    def _skip(self):
+        """Salta el valor en la posición actual sin construirlo"""
+        if self._peek() not in "{[":
+            self._decode()
+            return
+        
+        depth = 0
+        while True:
+            if self.pos >= len(self.buffer) and not self._fill():
+                raise ValueError("JSON truncado")
+            
+            char = self.buffer[self.pos]
+            if char == '"':
+                match = self._STRING_TAIL.match(self.buffer, self.pos + 1)
+                if match is None:
+                    if not self._fill():
+                        raise ValueError("JSON truncado")
+                    continue
+                self.pos = match.end()
+            elif char in "{[":
+                depth += 1
+                self.pos += 1
+            elif char in "}]":
+                depth -= 1
+                self.pos += 1
+                if depth == 0:
+                    return
+            else:
+                match = self._STRUCTURAL.search(self.buffer, self.pos)
+                self.pos = match.start() if match else len(self.buffer)
+    
+    def _members(self):
+        """Claves (o índices) del contenedor actual; quien consume debe leer o saltar cada valor"""
+        opening = self._peek()
+        if opening not in "{[":
+            raise ValueError("JSON inválido: se esperaba un objeto o una lista")
+        closing = "}" if opening == "{" else "]"
+        self.pos += 1
+        
+        index = 0
+        while True:
+            if self._peek() == closing:
+                self.pos += 1
+                return
+            
+            if opening == "{":
+                key = self._decode()
+                self._expect(":")
+            else:
+                key = index
+                index += 1
+            
+            yield key
+            
+            if self._peek() == ",":
+                self.pos += 1
+    
+    def items(self, section: str = None, exclude=()):
+        """Pares (clave, valor) de la raíz o de la sección indicada del objeto raíz"""
+        for key in self._members():
+            if section is None:
+                if key in exclude:
+                    self._skip()
+                else:
+                    yield key, self._decode()
+            elif key == section:
+                for inner_key in self._members():
+                    yield inner_key, self._decode()
+            else:
+                self._skip()
+
+
+def iter_data_items(f, section: str = None, exclude=()):
+    """Recorre elemento a elemento un archivo de datos abierto en modo binario
+    
+    Los archivos JSON se leen de forma incremental; los binarios (msgpack,
+    pickle) no admiten lectura parcial y se cargan completos.
+    """
+    with f:
+        if f.read(len(DATA_FILE_MAGIC)) == DATA_FILE_MAGIC:
+            f.seek(0)
+            data = decode_data_file(f.read())
+            if section is not None:
+                data = data.get(section, {})
+            pairs = enumerate(data) if isinstance(data, list) else data.items()
+            yield from ((k, v) for k, v in pairs if k not in exclude)
+            return
+        
+        f.seek(0)
+        yield from JSONItemStream(io.TextIOWrapper(f, encoding='utf-8')).items(section, exclude)
+
+
+def iter_data_file_items(path: str, section: str = None, exclude=()):
+    """Recorre un archivo de datos elemento a elemento (ver iter_data_items)"""
+    return iter_data_items(open(path, 'rb'), section, exclude)
+
+
+class IdGenerator:
+    """Identificadores tipo ULID: 48 bits de milisegundos + 80 bits aleatorios
+    
+    Se codifican en base32 de Crockford con ancho fijo, así que el orden
+    lexicográfico de las claves es el orden temporal. Dentro del mismo
+    milisegundo la parte aleatoria se incrementa para mantener la monotonía en
+    el proceso; entre procesos la aleatoriedad evita colisiones.
+    """
+    
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    RANDOM_BITS = 80
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_random = 0
+    
+    def _encode(self, value: int, length: int) -> str:
+        chars = []
+        for _ in range(length):
+            value, remainder = divmod(value, 32)
+            chars.append(self.ALPHABET[remainder])
+        return "".join(reversed(chars))
+    
+    def new_id(self, prefix: str) -> str:
+        """Genera un identificador nuevo con el prefijo indicado (DIAG, SESS, COM, PAY...)"""
+        with self._lock:
+            now_ms = int(time.time() * 1000)
+            
+            if now_ms <= self._last_ms:
+                # Mismo milisegundo o reloj atrasado: se continúa la secuencia anterior
+                now_ms = self._last_ms
+                self._last_random += 1
+                if self._last_random >= 1 << self.RANDOM_BITS:
+                    now_ms += 1
+                    self._last_random = 0
+            else:
+                self._last_random = int.from_bytes(os.urandom(self.RANDOM_BITS // 8), "big")
+            
+            self._last_ms = now_ms
+            return f"{prefix}_{self._encode(now_ms, 10)}{self._encode(self._last_random, 16)}"
+    
+    def lower_bound(self, prefix: str, moment: datetime) -> str:
+        """Menor identificador posible generado en el instante indicado"""
+        return f"{prefix}_{self._encode(int(moment.timestamp() * 1000), 10)}{'0' * 16}"
+
+
+# Generador compartido por todo el proceso
+ID_GENERATOR = IdGenerator()
+
+# Tablas lógicas de cada almacén. El documento de afiliados se reparte en tres
+# tablas; el resto de almacenes ocupan una sola tabla con su mismo nombre.
+STORE_TABLES = {
+    "affiliates": ("affiliates", "referrals", "affiliates_meta"),
+    "payments": ("payments",),
+    "diagnostics": ("diagnostics",),
+    "sessions": ("sessions",),
+    "users": ("users",)
+}
+
+# Sección del documento de afiliados que ocupa cada tabla (None = claves sueltas)
+AFFILIATES_SECTIONS = {
+    "affiliates": "affiliates",
+    "referrals": "referrals",
+    "affiliates_meta": None
+}
+
+TABLE_STORES = {table: store for store, tables in STORE_TABLES.items() for table in tables}
+
+
+def _payment_key(payment: dict, position: int) -> str:
+    """Clave de fila de un pago (payment_id o posición para registros antiguos)"""
+    return str(payment.get("payment_id") or f"legacy-{position}")
+
+
+def _referral_user_entries(referral_code: str, referral_data: dict) -> list:
+    """Posición de cada user_id dentro de la lista de referidos de un código"""
+    entries, seen = [], set()
+    for position, referral in enumerate(referral_data.get("referrals", [])):
+        user_id = referral.get("user_id")
+        # Con duplicados antiguos se indexa la primera aparición
+        if user_id not in seen:
+            seen.add(user_id)
+            entries.append((f"{referral_code}:{user_id}", position))
+    return entries
+
+
+# Índices secundarios persistentes: nombre -> (tabla, función que devuelve los
+# pares (valor, referencia) que aporta una fila). Se actualizan en cada escritura.
+SECONDARY_INDEXES = {
+    "affiliate_email": ("affiliates", lambda key, row: [(row.get("email"), key)]),
+    "affiliate_referral_code": ("affiliates", lambda key, row: [(row.get("referral_code"), key)]),
+    "referral_user": ("referrals", _referral_user_entries),
+    "payment_id": ("payments", lambda key, row: [(row.get("payment_id"), key)])
+}
+
+INDEXED_TABLES = {table for table, _ in SECONDARY_INDEXES.values()}
+
+# En el motor JSON el historial de pagos es una lista sin sección de índices: su
+# índice payment_id se sirve con el mapa de posiciones cacheado del historial
+DOCUMENT_INDEXED_TABLES = INDEXED_TABLES - {"payments"}
+
+# Clave del documento JSON en la que se guardan los índices
+INDEX_SECTION = "_indexes"
+
+
+# Almacenes JSON repartidos en un directorio de shards: nombre -> shard de cada clave.
+# Las sesiones van en un archivo por usuario y los diagnósticos en 256 grupos por hash.
+SHARDED_STORES = {
+    "sessions": lambda key: re.sub(r"[^A-Za-z0-9_-]", "_", str(key))[:100] or "_",
+    "diagnostics": lambda key: hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:2]
+}
+
+
+def _shard_directory(path: str) -> str:
+    """Directorio de shards que sustituye al archivo único de un almacén"""
+    return os.path.splitext(path)[0]
+
+
+# Archivo de cada almacén dentro del directorio de datos
+STORE_FILE_NAMES = {
+    "affiliates": "affiliates_db . json",
+    "payments": "payment_log.json",
+    "diagnostics": "diagnostics_db.json",
+    "sessions": "sessions_db.json",
+    "users": "users_db.json"
+}
+
+
+def store_data_files(data_dir: str) -> list:
+    """Archivos de los almacenes (y sus shards) que existen en el directorio de datos
+    
+    El resto de data/ (instantáneas, caché de diagnósticos, trabajos...) tiene
+    su propio formato y no forma parte de los almacenes.
+    """
+    paths = []
+    for store, name in STORE_FILE_NAMES.items():
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            paths.append(path)
+        directory = _shard_directory(path)
+        if store in SHARDED_STORES and os.path.isdir(directory):
+            paths += [os.path.join(directory, shard) for shard in sorted(os.listdir(directory))
+                      if shard.endswith(".json")]
+    return paths
+
+
+def _read_json_store(path: str):
+    """Lee un almacén JSON, sea el archivo único o su directorio de shards (None si no existe)"""
+    if os.path.exists(path):
+        return read_data_file(path)
+    
+    directory = _shard_directory(path)
+    if not os.path.isdir(directory):
+        return None
+    
+    data = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            data.update(read_data_file(os.path.join(directory, name)))
+    return data
+
+
+def _index_entries(table: str, key: str, row) -> list:
+    """Entradas (índice, valor, referencia) que genera una fila"""
+    entries = []
+    if not isinstance(row, dict):
+        return entries
+    for name, (indexed_table, extract) in SECONDARY_INDEXES.items():
+        if indexed_table == table:
+            for value, ref in extract(key, row):
+                if value is not None:
+                    entries.append((name, str(value), ref))
+    return entries
+
+
+def file_signature(paths) -> tuple:
+    """Firma de los archivos de origen (inode, mtime, tamaño; None si no existe)"""
+    signature = []
+    for path in paths:
+        try:
+            st_result = os.stat(path)
+            signature.append((st_result.st_ino, st_result.st_mtime_ns, st_result.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class StoreCache:
+    """Caché de lectura de los almacenes JSON validada por mtime/tamaño del archivo"""
+    
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, key: str, paths, loader: Callable, readonly: bool = False):
+        """Devuelve el documento cacheado o lo carga si los archivos cambiaron
+        
+        Con readonly=True se entrega la estructura compartida (no debe mutarse);
+        en otro caso una copia independiente reconstruida desde pickle, más
+        barata que volver a leer y parsear el JSON.
+        """
+        signature = file_signature(paths)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["signature"] == signature:
+                self.hits += 1
+                return entry["data"] if readonly else pickle.loads(entry["blob"])
+            self.misses += 1
+        
+        # La firma se toma antes de leer: si el archivo cambia durante la
+        # lectura, la siguiente consulta no coincidirá y se recargará
+        data = loader()
+        blob = pickle.dumps(data, protocol=5)
+        
+        with self._lock:
+            self._entries[key] = {"signature": signature, "data": data, "blob": blob}
+        
+        return data if readonly else pickle.loads(blob)
+    
+    def invalidate(self, key: str):
+        """Descarta una entrada tras una escritura"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+    
+    def clear(self):
+        """Vacía la caché completa"""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        """Contadores de aciertos y fallos"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total * 100, 1) if total else 0.0
+            }
+
+
+# Caché compartida por todas las sesiones del proceso
+STORE_CACHE = StoreCache()
+
+
+class StorageBackend:
+    """Interfaz común de los motores de almacenamiento"""
+    
+    def initialize(self, defaults: dict):
+        """Crea los almacenes que no existan con sus valores por defecto"""
+        raise NotImplementedError
+    
+    @contextmanager
+    def batch(self):
+        """Agrupa varias operaciones en una única escritura"""
+        raise NotImplementedError
+    
+    def get(self, table: str, key: str, default=None):
+        """Obtiene una fila por clave"""
+        raise NotImplementedError
+    
+    def put(self, table: str, key: str, value):
+        """Inserta o actualiza una fila"""
+        raise NotImplementedError
+    
+    def delete(self, table: str, key: str):
+        """Elimina una fila"""
+        raise NotImplementedError
+    
+    def items(self, table: str) -> list:
+        """Devuelve todas las filas como pares (clave, valor) en orden de inserción"""
+        raise NotImplementedError
+    
+    def replace(self, table: str, items):
+        """Reemplaza el contenido completo de una tabla"""
+        raise NotImplementedError
+    
+    def lookup(self, index: str, value, default=None):
+        """Consulta un índice secundario (ver SECONDARY_INDEXES)"""
+        raise NotImplementedError
+    
+    def patch(self, table: str, key: str, changes: dict) -> bool:
+        """Actualiza campos concretos de una fila existente"""
+        with self.batch():
+            value = self.get(table, key)
+            if value is None:
+                return False
+            value.update(changes)
+            self.put(table, key, value)
+            return True
+    
+    def count(self, table: str) -> int:
+        """Número de filas de una tabla"""
+        return len(self.items(table))
+    
+    def key_range(self, table: str, start_key: str, end_key: str) -> list:
+        """Filas con start_key <= clave < end_key, ordenadas por clave"""
+        return sorted(((k, v) for k, v in self.items(table) if start_key <= k < end_key),
+                      key=lambda item: item[0])
+    
+    def size_bytes(self) -> int:
+        """Tamaño en disco del almacenamiento"""
+        raise NotImplementedError
+    
+    def iter_items(self, table: str):
+        """Recorre las filas sin cargarlas todas a la vez cuando el motor lo permite"""
+        yield from self.items(table)
+    
+    def segments(self, table: str) -> dict:
+        """Versión de cada segmento de la tabla (unidad que puede releerse por separado)
+        
+        La versión cambia siempre que cambia alguna fila del segmento; la usan
+        las instantáneas de estructuras derivadas para saber qué releer.
+        """
+        raise NotImplementedError
+    
+    def segment_items(self, table: str, segment: str):
+        """Filas de un segmento devuelto por segments()"""
+        raise NotImplementedError
+    
+    def put_many(self, table: str, items) -> int:
+        """Inserta o actualiza una secuencia de filas; devuelve cuántas se escribieron"""
+        count = 0
+        with self.batch():
+            for key, value in items:
+                self.put(table, str(key), value)
+                count += 1
+        return count
+    
+    # ========== CAPA DE COMPATIBILIDAD (DOCUMENTOS COMPLETOS) ==========
+    
+    def load_store(self, store: str, readonly: bool = False):
+        """Reconstruye el documento completo de un almacén"""
+        if store == "affiliates":
+            document = dict(self.items("affiliates_meta"))
+            document["affiliates"] = dict(self.items("affiliates"))
+            document["referrals"] = dict(self.items("referrals"))
+            return document
+        
+        if store == "payments":
+            return [value for _, value in self.items("payments")]
+        
+        return dict(self.items(store))
+    
+    def save_store(self, store: str, data):
+        """Guarda el documento completo de un almacén"""
+        with self.batch():
+            if store == "affiliates":
+                data = dict(data)
+                data.pop(INDEX_SECTION, None)
+                self.replace("affiliates", data.pop("affiliates", {}).items())
+                self.replace("referrals", data.pop("referrals", {}).items())
+                self.replace("affiliates_meta", data.items())
+            elif store == "payments":
+                self.replace("payments", [(_payment_key(p, i), p) for i, p in enumerate(data)])
+            else:
+                self.replace(store, data.items())
+
+
+class PaymentJournal:
+    """Diario JSON-Lines del historial de pagos con compactación en segundo plano"""
+    
+    def __init__(self, snapshot_path: str, lock, max_bytes: int, serializer: Serializer = None):
+        self.snapshot_path = snapshot_path
+        self.serializer = serializer or SERIALIZERS["json"]
+        self.journal_path = os.path.splitext(snapshot_path)[0] + ".jsonl"
+        self.compacting_path = self.journal_path + ".compacting"
+        self.lock = lock
+        self.max_bytes = max_bytes
+        self._compaction_thread = None
+    
+    def read_merged(self) -> list:
+        """Instantánea más los registros del diario aplicados en orden"""
+        with self.lock:
+            payments = []
+            if os.path.exists(self.snapshot_path):
+                payments = read_data_file(self.snapshot_path)
+            
+            positions = {_payment_key(p, i): i for i, p in enumerate(payments)}
+            for path in (self.compacting_path, self.journal_path):
+                self._replay(path, payments, positions)
+            
+            return payments
+    
+    def _records(self, path: str):
+        """Registros de un archivo de diario en orden"""
+        if not os.path.exists(path):
+            return
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Última línea incompleta tras una caída
+                    logger.warning(f"Registro de diario corrupto ignorado en {path}")
+    
+    def iter_merged(self):
+        """Recorre el historial aplicando el diario sin cargar la instantánea completa
+        
+        El diario (acotado por max_bytes) se condensa en memoria y se aplica
+        sobre la instantánea leída pago a pago.
+        """
+        overlay, appended = {}, []
+        
+        with self.lock:
+            for path in (self.compacting_path, self.journal_path):
+                for record in self._records(path):
+                    key, entry = record["key"], overlay.get(record["key"])
+                    if record["op"] == "put":
+                        if key not in overlay:
+                            appended.append(key)
+                        overlay[key] = {"op": "put", "value": record["value"]}
+                    elif record["op"] == "patch":
+                        if entry is None:
+                            overlay[key] = {"op": "patch", "changes": dict(record["changes"])}
+                        elif entry["op"] == "put":
+                            entry["value"] = {**entry["value"], **record["changes"]}
+                        elif entry["op"] == "patch":
+                            entry["changes"].update(record["changes"])
+                    elif record["op"] == "delete":
+                        overlay[key] = {"op": "delete"}
+            
+            # El archivo abierto sigue siendo legible aunque una compactación lo sustituya
+            snapshot = iter(())
+            if os.path.exists(self.snapshot_path):
+                snapshot = iter_data_items(open(self.snapshot_path, 'rb'))
+        
+        for position, payment in snapshot:
+            key = _payment_key(payment, position)
+            entry = overlay.pop(key, None)
+            if entry is None:
+                yield key, payment
+            elif entry["op"] == "put":
+                yield key, entry["value"]
+            elif entry["op"] == "patch":
+                payment.update(entry["changes"])
+                yield key, payment
+        
+        for key in appended:
+            entry = overlay.get(key)
+            if entry is not None and entry["op"] == "put":
+                yield key, entry["value"]
+    
+    def _replay(self, path: str, payments: list, positions: dict):
+        """Aplica los registros de un archivo de diario (idempotente)"""
+        if not os.path.exists(path):
+            return
+        self.apply_records(self._records(path), payments, positions)
+    
+    @staticmethod
+    def apply_records(records, payments: list, positions: dict):
+        """Aplica registros del diario sobre el historial cargado y reconstruye `positions`"""
+        for record in records:
+            key = record["key"]
+            if record["op"] == "put":
+                if key in positions:
+                    payments[positions[key]] = record["value"]
+                else:
+                    positions[key] = len(payments)
+                    payments.append(record["value"])
+            elif record["op"] == "patch" and key in positions:
+                payments[positions[key]].update(record["changes"])
+            elif record["op"] == "delete" and key in positions:
+                payments[positions.pop(key)] = None
+        
+        payments[:] = [p for p in payments if p is not None]
+        positions.clear()
+        positions.update({_payment_key(p, i): i for i, p in enumerate(payments)})
+    
+    def append(self, records: list):
+        """Añade registros al diario con una sola escritura"""
+        lines = "".join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + "\n" for r in records)
+        
+        with self.lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            STORE_CACHE.invalidate(self.snapshot_path)
+            
+            if os.path.getsize(self.journal_path) >= self.max_bytes:
+                self.compact_in_background()
+    
+    def discard(self):
+        """Descarta el diario tras reescribir la instantánea completa"""
+        with self.lock:
+            for path in (self.compacting_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            STORE_CACHE.invalidate(self.snapshot_path)
+    
+    def _write_snapshot_file(self, payments: list):
+        tmp_path = self.snapshot_path + ".tmp"
+        write_data_file(tmp_path, payments, self.serializer)
+        os.replace(tmp_path, self.snapshot_path)
+        STORE_CACHE.invalidate(self.snapshot_path)
+    
+    def compact(self):
+        """Integra el diario en la instantánea"""
+        with self.lock:
+            # El diario se renombra antes de leerlo para que las escrituras de
+            # otros procesos vayan a un archivo nuevo y no se pierdan
+            if not os.path.exists(self.compacting_path):
+                if not os.path.exists(self.journal_path):
+                    return
+                os.replace(self.journal_path, self.compacting_path)
+            
+            payments = []
+            if os.path.exists(self.snapshot_path):
+                payments = read_data_file(self.snapshot_path)
+            
+            positions = {_payment_key(p, i): i for i, p in enumerate(payments)}
+            self._replay(self.compacting_path, payments, positions)
+            
+            self._write_snapshot_file(payments)
+            os.remove(self.compacting_path)
+            logger.info(f"Diario de pagos compactado ({len(payments)} pagos)")
+    
+    def compact_in_background(self):
+        """Lanza la compactación en un hilo si no hay otra en curso"""
+        if self._compaction_thread and self._compaction_thread.is_alive():
+            return
+        
+        def run():
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error compactando diario de pagos: {e}")
+        
+        self._compaction_thread = threading.Thread(target=run, name="payments-compaction", daemon=True)
+        self._compaction_thread.start()
+
+
+class PaymentKeyIndex:
+    """Claves del historial de pagos, para escribir en el diario sin cargarlo
+    
+    Se reconstruye recorriendo la instantánea en streaming solo cuando cambia
+    la instantánea (o aparece un diario en compactación) o el diario se
+    sustituye; en otro caso se leen únicamente los registros añadidos al
+    diario desde el último desplazamiento conocido.
+    """
+    
+    _instances = {}
+    _instances_lock = threading.Lock()
+    
+    def __init__(self, journal: "PaymentJournal"):
+        self.journal = journal
+        self.keys = set()
+        self.rebuilds = 0
+        self._base_signature = None
+        self._journal_inode = None
+        self._offset = 0
+    
+    @classmethod
+    def shared(cls, journal: "PaymentJournal") -> "PaymentKeyIndex":
+        """Índice único por historial de pagos, compartido por todas las sesiones del proceso"""
+        path = os.path.abspath(journal.snapshot_path)
+        with cls._instances_lock:
+            index = cls._instances.get(path)
+            if index is None:
+                index = cls._instances[path] = cls(journal)
+            return index
+    
+    def contains(self, key: str) -> bool:
+        with self.journal.lock:
+            self._refresh()
+            return key in self.keys
+    
+    def _refresh(self):
+        journal = self.journal
+        base_signature = file_signature((journal.snapshot_path, journal.compacting_path))
+        try:
+            st_result = os.stat(journal.journal_path)
+            inode, size = st_result.st_ino, st_result.st_size
+        except FileNotFoundError:
+            inode, size = None, 0
+        
+        replaced = self._offset and (inode != self._journal_inode or size < self._offset)
+        if base_signature != self._base_signature or replaced:
+            # Los registros añadidos mientras se recorre se vuelven a leer desde
+            # `size`: aplicarlos dos veces no cambia el conjunto de claves
+            self.keys = {key for key, _ in journal.iter_merged()}
+            self._base_signature = base_signature
+            self._journal_inode = inode
+            self._offset = size
+            self.rebuilds += 1
+            return
+        
+        self._journal_inode = inode
+        if size > self._offset:
+            self._read_tail()
+    
+    def _read_tail(self):
+        """Aplica los registros completos añadidos al diario desde el último desplazamiento"""
+        with open(self.journal.journal_path, 'rb') as f:
+            f.seek(self._offset)
+            tail = f.read()
+        
+        # Una línea sin salto final aún se está escribiendo: se leerá la próxima vez
+        complete = tail[:tail.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Registro de diario corrupto ignorado en {self.journal.journal_path}")
+                continue
+            if record["op"] == "put":
+                self.keys.add(record["key"])
+            elif record["op"] == "delete":
+                self.keys.discard(record["key"])
+
+
+class JSONStorageBackend(StorageBackend):
+    """Motor de almacenamiento sobre los archivos JSON originales"""
+    
+    # Compartidos por todas las instancias: los archivos son los mismos
+    _lock = threading.RLock()
+    _local = threading.local()
+    # Historial de pagos cacheado -> (esa misma lista, mapa de posiciones)
+    _shared_positions = {}
+    
+    def __init__(self, files: dict, payments_journal: bool = False, journal_max_bytes: int = 512 * 1024,
+                 serializer: Serializer = None):
+        self.files = files
+        self.location = os.path.abspath(os.path.dirname(files["affiliates"]))
+        self.serializer = serializer or SERIALIZERS["json"]
+        self.payments_journal = payments_journal
+        self.journal = PaymentJournal(files["payments"], self._lock, journal_max_bytes, self.serializer)
+        self.intent_path = os.path.join(os.path.dirname(files["payments"]), "transaction.intent.json")
+    
+    def initialize(self, defaults: dict):
+        """Crea los archivos que no existan"""
+        self._recover()
+        
+        for store, default_data in defaults.items():
+            if store in SHARDED_STORES:
+                self._migrate_to_shards(store)
+            elif not os.path.exists(self.files[store]):
+                self._write_json(self.files[store], default_data)
+        
+        # Los documentos escritos antes de existir los índices se indexan una vez
+        with self.batch():
+            for store in {TABLE_STORES[table] for table in DOCUMENT_INDEXED_TABLES}:
+                document = self._document(store)
+                if INDEX_SECTION not in document:
+                    document[INDEX_SECTION] = self._build_indexes(document)
+                    self._touch(store)
+        
+        # Un diario pendiente con el modo desactivado se integra en la instantánea
+        if not self.payments_journal:
+            self.journal.compact()
+    
+    def _migrate_to_shards(self, store: str):
+        """Reparte el archivo único de un almacén en shards (una sola vez)"""
+        os.makedirs(_shard_directory(self.files[store]), exist_ok=True)
+        
+        legacy_path = self.files[store]
+        if not os.path.exists(legacy_path):
+            return
+        
+        data = self._read_json(legacy_path)
+        with self.batch():
+            for key, value in data.items():
+                self.put(store, key, value)
+        
+        # El archivo original se conserva renombrado; si el proceso cae antes,
+        # la migración se repite al arrancar (las escrituras son idempotentes)
+        os.replace(legacy_path, legacy_path + ".migrated")
+        logger.info(f"Almacén {store} migrado a shards ({len(data)} claves)")
+    
+    @contextmanager
+    def batch(self):
+        """Carga cada documento una vez y lo escribe una sola vez al final"""
+        with self._lock:
+            outermost = getattr(self._local, "working", None) is None
+            if outermost:
+                self._local.working = {}
+                self._local.dirty = set()
+                self._local.journal_records = []
+                self._local.payment_positions = None
+            
+            try:
+                yield self
+            except BaseException:
+                if outermost:
+                    self._local.working = None
+                raise
+            
+            if outermost:
+                working, dirty = self._local.working, self._local.dirty
+                journal_records = self._local.journal_records
+                self._local.working = None
+                self._commit(working, dirty, journal_records)
+    
+    def _commit(self, working: dict, dirty: set, journal_records: list):
+        """Confirma el lote: un archivo temporal por almacén y renombrado atómico
+        
+        Si el lote toca más de un archivo se escribe antes una intención de
+        commit; al arrancar, una intención pendiente se completa (roll forward)
+        y los temporales huérfanos se descartan.
+        """
+        intent = {
+            "writes": {},
+            "journal_records": journal_records if "payments" not in dirty else [],
+            "discard_journal": "payments" in dirty
+        }
+        
+        for doc_id in dirty:
+            path = self._path(doc_id)
+            self._dump(path + ".tmp", working[doc_id])
+            intent["writes"][path] = path + ".tmp"
+        
+        if len(intent["writes"]) + bool(intent["journal_records"]) > 1:
+            write_data_file(self.intent_path + ".tmp", intent, SERIALIZERS["json"])
+            os.replace(self.intent_path + ".tmp", self.intent_path)
+            self._apply(intent)
+            os.remove(self.intent_path)
+        else:
+            self._apply(intent)
+    
+    def _apply(self, intent: dict):
+        """Aplica una intención de commit (idempotente)"""
+        for path, tmp_path in intent["writes"].items():
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, path)
+            STORE_CACHE.invalidate(path)
+        
+        if intent["discard_journal"]:
+            self.journal.discard()
+        
+        # Repetir registros del diario es inocuo: su reproducción es idempotente
+        if intent["journal_records"]:
+            self.journal.append(intent["journal_records"])
+    
+    def _recover(self):
+        """Completa un commit interrumpido o descarta sus temporales"""
+        with self._lock:
+            if os.path.exists(self.intent_path):
+                with open(self.intent_path, 'r', encoding='utf-8') as f:
+                    intent = json.load(f)
+                logger.warning("Completando transacción interrumpida")
+                self._apply(intent)
+                os.remove(self.intent_path)
+            
+            tmp_paths = [path + ".tmp" for path in list(self.files.values()) + [self.intent_path]]
+            for store in SHARDED_STORES:
+                directory = _shard_directory(self.files[store])
+                if os.path.isdir(directory):
+                    tmp_paths += [os.path.join(directory, name) for name in os.listdir(directory)
+                                  if name.endswith(".tmp")]
+            
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    
+    def _read_json(self, path: str):
+        # Acepta cualquier formato: los archivos convertidos llevan cabecera
+        return read_data_file(path)
+    
+    def _dump(self, path: str, data):
+        """Escribe un documento en el formato configurado y lo lleva a disco"""
+        write_data_file(path, data, self.serializer)
+    
+    def _write_json(self, path: str, data):
+        self._dump(path + ".tmp", data)
+        os.replace(path + ".tmp", path)
+        STORE_CACHE.invalidate(path)
+    
+    def _doc_id(self, table: str, key: str) -> str:
+        """Documento que contiene una fila: el almacén o almacén/shard"""
+        store = TABLE_STORES[table]
+        if store in SHARDED_STORES:
+            return f"{store}/{SHARDED_STORES[store](key)}"
+        return store
+    
+    def _path(self, doc_id: str) -> str:
+        if "/" in doc_id:
+            store, shard = doc_id.split("/", 1)
+            return os.path.join(_shard_directory(self.files[store]), shard + ".json")
+        return self.files[doc_id]
+    
+    def _shard_ids(self, store: str) -> list:
+        """Shards existentes de un almacén (en disco o creados en el lote)"""
+        directory = _shard_directory(self.files[store])
+        shards = set()
+        if os.path.isdir(directory):
+            shards = {f"{store}/{name[:-5]}" for name in os.listdir(directory) if name.endswith(".json")}
+        
+        working = getattr(self._local, "working", None) or {}
+        shards.update(doc_id for doc_id in working if doc_id.startswith(store + "/"))
+        return sorted(shards)
+    
+    def _document(self, doc_id: str, readonly: bool = False):
+        """Documento del almacén (el del lote en curso si lo hay)"""
+        working = getattr(self._local, "working", None)
+        if working is None:
+            return self._read_store(doc_id, readonly)
+        if doc_id not in working:
+            working[doc_id] = self._read_store(doc_id)
+            if doc_id == "payments" and self._local.journal_records:
+                # Escrituras del lote que fueron directamente al diario
+                PaymentJournal.apply_records(self._local.journal_records, working[doc_id], {
+                    _payment_key(p, i): i for i, p in enumerate(working[doc_id])
+                })
+        return working[doc_id]
+    
+    def _journal_only(self) -> bool:
+        """Modo diario con el historial sin cargar en el lote: las escrituras solo se añaden al diario"""
+        return self.payments_journal and "payments" not in self._local.working
+    
+    def _payment_exists(self, key: str) -> bool:
+        """Existencia de un pago sin cargar el historial (diario pendiente del lote e índice de claves)"""
+        for record in reversed(self._local.journal_records):
+            if record["key"] == key and record["op"] != "patch":
+                return record["op"] == "put"
+        return PaymentKeyIndex.shared(self.journal).contains(key)
+    
+    def _source_paths(self, doc_id: str) -> tuple:
+        """Archivos de los que se compone un documento (pagos incluye su diario)"""
+        path = self._path(doc_id)
+        if doc_id == "payments":
+            return (path, self.journal.compacting_path, self.journal.journal_path)
+        return (path,)
+    
+    def _read_store(self, doc_id: str, readonly: bool = False):
+        """Lee un documento a través de la caché compartida del proceso"""
+        path = self._path(doc_id)
+        
+        if doc_id == "payments":
+            return STORE_CACHE.get(path, self._source_paths(doc_id), self.journal.read_merged, readonly)
+        
+        # Un shard que aún no existe se lee como documento vacío
+        loader = lambda: self._read_json(path) if os.path.exists(path) else {}
+        return STORE_CACHE.get(path, (path,), loader, readonly)
+    
+    def _journal(self, record: dict) -> bool:
+        """Registra una operación de pagos en el diario si el modo está activo"""
+        if not self.payments_journal:
+            self._touch("payments")
+            return False
+        self._local.journal_records.append(record)
+        return True
+    
+    def _touch(self, doc_id: str):
+        """Marca un documento del lote como modificado"""
+        self._local.dirty.add(doc_id)
+    
+    def _container(self, document, table: str):
+        """Sección del documento en la que vive la tabla"""
+        if TABLE_STORES[table] == "affiliates":
+            section = AFFILIATES_SECTIONS[table]
+            return document.setdefault(section, {}) if section else document
+        return document
+    
+    def _payment_positions(self, payments: list) -> dict:
+        """Índice payment_id -> posición del historial
+        
+        Fuera de un lote el historial es la lista compartida de STORE_CACHE,
+        que solo cambia al recargarse: el mapa se construye una vez por
+        versión de la lista y las consultas siguientes son O(1). Dentro de un
+        lote se construye una vez sobre la copia de trabajo.
+        """
+        if getattr(self._local, "working", None) is None:
+            with self._lock:
+                cached = self._shared_positions.get(self.journal.snapshot_path)
+                if cached is None or cached[0] is not payments:
+                    cached = (payments, {_payment_key(p, i): i for i, p in enumerate(payments)})
+                    self._shared_positions[self.journal.snapshot_path] = cached
+                return cached[1]
+        if self._local.payment_positions is None:
+            self._local.payment_positions = {_payment_key(p, i): i for i, p in enumerate(payments)}
+        return self._local.payment_positions
+    
+    def _build_indexes(self, document) -> dict:
+        """Reconstruye los índices secundarios de un documento completo"""
+        indexes = {name: {} for name, (table, _) in SECONDARY_INDEXES.items() if table in DOCUMENT_INDEXED_TABLES}
+        for table in DOCUMENT_INDEXED_TABLES:
+            rows = document.get(AFFILIATES_SECTIONS[table], {})
+            for key, row in rows.items():
+                for name, value, ref in _index_entries(table, key, row):
+                    indexes[name].setdefault(value, ref)
+        return indexes
+    
+    def _update_indexes(self, document, table: str, key: str, old, new):
+        """Sustituye las entradas de índice de una fila"""
+        if table not in DOCUMENT_INDEXED_TABLES:
+            return
+        
+        indexes = document.get(INDEX_SECTION)
+        if indexes is None:
+            document[INDEX_SECTION] = self._build_indexes(document)
+            return
+        
+        for name, value, ref in _index_entries(table, key, old):
+            if indexes.get(name, {}).get(value) == ref:
+                del indexes[name][value]
+        for name, value, ref in _index_entries(table, key, new):
+            indexes.setdefault(name, {}).setdefault(value, ref)
+    
+    def get(self, table: str, key: str, default=None):
+        # Fuera de un lote se consulta la copia compartida de la caché y solo
+        # se copia la fila devuelta
+        document = self._document(self._doc_id(table, key), readonly=True)
+        
+        if table == "payments":
+            position = self._payment_positions(document).get(key)
+            value = document[position] if position is not None else None
+        elif table == "affiliates_meta" and (key in AFFILIATES_SECTIONS or key == INDEX_SECTION):
+            value = None
+        else:
+            section = AFFILIATES_SECTIONS.get(table) if TABLE_STORES[table] == "affiliates" else None
+            value = (document.get(section, {}) if section else document).get(key)
+        
+        if value is None:
+            return default
+        return pickle.loads(pickle.dumps(value, protocol=5))
+    
+    def lookup(self, index: str, value, default=None):
+        table = SECONDARY_INDEXES[index][0]
+        document = self._document(TABLE_STORES[table], readonly=True)
+        
+        if table == "payments":
+            position = self._payment_positions(document).get(str(value))
+            if position is None or document[position].get("payment_id") is None:
+                return default
+            return str(value)
+        
+        indexes = document.get(INDEX_SECTION)
+        if indexes is None:
+            # Documento modificado por fuera sin índices
+            indexes = self._build_indexes(document)
+        
+        return indexes.get(index, {}).get(str(value), default)
+    
+    def put(self, table: str, key: str, value):
+        doc_id = self._doc_id(table, key)
+        with self.batch():
+            if table == "payments" and self._journal_only():
+                self._journal({"op": "put", "key": key, "value": value})
+                return
+            
+            document = self._document(doc_id)
+            
+            if table == "payments":
+                positions = self._payment_positions(document)
+                if key in positions:
+                    document[positions[key]] = value
+                else:
+                    positions[key] = len(document)
+                    document.append(value)
+                self._journal({"op": "put", "key": key, "value": value})
+            else:
+                container = self._container(document, table)
+                old = container.get(key)
+                container[key] = value
+                self._update_indexes(document, table, key, old, value)
+                self._touch(doc_id)
+    
+    def patch(self, table: str, key: str, changes: dict) -> bool:
+        if table != "payments":
+            return super().patch(table, key, changes)
+        
+        with self.batch():
+            if self._journal_only():
+                if not self._payment_exists(key):
+                    return False
+                self._journal({"op": "patch", "key": key, "changes": changes})
+                return True
+            
+            document = self._document(table)
+            position = self._payment_positions(document).get(key)
+            if position is None:
+                return False
+            document[position].update(changes)
+            self._journal({"op": "patch", "key": key, "changes": changes})
+            return True
+    
+    def delete(self, table: str, key: str):
+        doc_id = self._doc_id(table, key)
+        with self.batch():
+            document = self._document(doc_id)
+            
+            if table == "payments":
+                document[:] = [p for i, p in enumerate(document) if _payment_key(p, i) != key]
+                self._local.payment_positions = None
+                self._journal({"op": "delete", "key": key})
+            else:
+                container = self._container(document, table)
+                self._update_indexes(document, table, key, container.pop(key, None), None)
+                self._touch(doc_id)
+    
+    def items(self, table: str) -> list:
+        if table in SHARDED_STORES:
+            return [item for doc_id in self._shard_ids(table) for item in self._document(doc_id).items()]
+        
+        document = self._document(TABLE_STORES[table])
+        
+        if table == "payments":
+            return [(_payment_key(p, i), p) for i, p in enumerate(document)]
+        
+        container = self._container(document, table)
+        if table == "affiliates_meta":
+            return [(k, v) for k, v in container.items()
+                    if k not in AFFILIATES_SECTIONS and k != INDEX_SECTION]
+        return list(container.items())
+    
+    def replace(self, table: str, items):
+        store = TABLE_STORES[table]
+        with self.batch():
+            if store in SHARDED_STORES:
+                shards = {}
+                for key, value in items:
+                    shards.setdefault(self._doc_id(table, key), {})[key] = value
+                for doc_id in set(self._shard_ids(store)) | set(shards):
+                    self._local.working[doc_id] = shards.get(doc_id, {})
+                    self._touch(doc_id)
+                return
+            
+            document = self._document(store)
+            
+            if table == "payments":
+                document[:] = [value for _, value in items]
+                self._local.payment_positions = None
+            elif table == "affiliates_meta":
+                sections = {k: document[k] for k in (*AFFILIATES_SECTIONS, INDEX_SECTION) if k in document}
+                document.clear()
+                document.update(items)
+                document.update(sections)
+            else:
+                container = self._container(document, table)
+                container.clear()
+                container.update(items)
+                if table in DOCUMENT_INDEXED_TABLES:
+                    document[INDEX_SECTION] = self._build_indexes(document)
+            
+            self._touch(store)
+    
+    def iter_items(self, table: str):
+        if getattr(self._local, "working", None) is not None:
+            yield from self.items(table)
+            return
+        
+        if table == "payments":
+            yield from self.journal.iter_merged()
+            return
+        
+        # Lectura directa de disco: no se llena la caché con todo el almacén
+        if table in SHARDED_STORES:
+            for doc_id in self._shard_ids(table):
+                yield from read_data_file(self._path(doc_id)).items()
+            return
+        
+        path = self.files[TABLE_STORES[table]]
+        if table == "affiliates_meta":
+            yield from iter_data_file_items(path, exclude=(*AFFILIATES_SECTIONS, INDEX_SECTION))
+        elif TABLE_STORES[table] == "affiliates":
+            yield from iter_data_file_items(path, section=AFFILIATES_SECTIONS[table])
+        else:
+            yield from iter_data_file_items(path)
+    
+    def segments(self, table: str) -> dict:
+        """Un segmento por archivo: el del almacén o cada shard, versionado por su firma"""
+        store = TABLE_STORES[table]
+        doc_ids = self._shard_ids(store) if store in SHARDED_STORES else [store]
+        return {doc_id: repr(file_signature(self._source_paths(doc_id))) for doc_id in doc_ids}
+    
+    def segment_items(self, table: str, segment: str):
+        if table in SHARDED_STORES:
+            path = self._path(segment)
+            return read_data_file(path).items() if os.path.exists(path) else []
+        return self.iter_items(table)
+    
+    def load_store(self, store: str, readonly: bool = False):
+        if store in SHARDED_STORES:
+            document = {}
+            for doc_id in self._shard_ids(store):
+                document.update(self._document(doc_id, readonly))
+            return document
+        
+        if getattr(self._local, "working", None) is None:
+            return self._read_store(store, readonly)
+        return self._document(store)
+    
+    def save_store(self, store: str, data):
+        if store in SHARDED_STORES:
+            self.replace(store, list(data.items()))
+            return
+        
+        with self.batch():
+            if store == "payments":
+                self._local.payment_positions = None
+            elif store in {TABLE_STORES[table] for table in DOCUMENT_INDEXED_TABLES}:
+                data[INDEX_SECTION] = self._build_indexes(data)
+            self._local.working[store] = data
+            self._touch(store)
+    
+    def size_bytes(self) -> int:
+        paths = list(self.files.values()) + [self.journal.journal_path, self.journal.compacting_path]
+        paths += [self._path(doc_id) for store in SHARDED_STORES for doc_id in self._shard_ids(store)]
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """Motor de almacenamiento SQLite (WAL, una tabla por almacén, upserts por fila)"""
+    
+    def __init__(self, db_path: str, legacy_files: dict = None):
+        self.db_path = db_path
+        self.location = os.path.abspath(db_path)
+        self.legacy_files = legacy_files or {}
+        self._local = threading.local()
+        
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._create_schema()
+    
+    def _connection(self) -> sqlite3.Connection:
+        """Conexión propia de cada hilo (los scripts de Streamlit corren en hilos distintos)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+    
+    def _create_schema(self):
+        conn = self._connection()
+        for table in TABLE_STORES:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL UNIQUE,
+                    data TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+        conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS storage_index (
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                PRIMARY KEY (name, value)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS storage_index_row ON storage_index (name, row_key)")
+    
+    def _table(self, table: str) -> str:
+        """Valida el nombre de tabla antes de interpolarlo en SQL"""
+        if table not in TABLE_STORES:
+            raise ValueError(f"Tabla desconocida: {table}")
+        return table
+    
+    def initialize(self, defaults: dict):
+        """Migra los archivos JSON existentes la primera vez o siembra valores por defecto"""
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM storage_meta WHERE key = 'initialized'").fetchone():
+            # Bases creadas antes de existir alguno de los índices secundarios
+            missing = {table for name, (table, _) in SECONDARY_INDEXES.items() if name not in self._indexed_names()}
+            if missing:
+                with self.batch():
+                    for table in missing:
+                        self._reindex_table(table, self.items(table))
+                    self._mark_indexed()
+            return
+        
+        with self.batch():
+            for store, default_data in defaults.items():
+                data = default_data
+                legacy_path = self.legacy_files.get(store)
+                if legacy_path:
+                    try:
+                        legacy_data = _read_json_store(legacy_path)
+                        if legacy_data is not None:
+                            data = legacy_data
+                            logger.info(f"Migrando {legacy_path} a SQLite")
+                    except Exception as e:
+                        logger.error(f"Error migrando {legacy_path}: {e}")
+                self.save_store(store, data)
+            
+            conn.execute(
+                "INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('initialized', ?)",
+                (datetime.now().isoformat(),)
+            )
+            self._mark_indexed()
+    
+    # Índices que existían antes de registrarse sus nombres en storage_meta
+    LEGACY_INDEX_NAMES = ("affiliate_email", "affiliate_referral_code", "referral_user")
+    
+    def _indexed_names(self) -> set:
+        """Índices ya construidos en esta base"""
+        conn = self._connection()
+        row = conn.execute("SELECT value FROM storage_meta WHERE key = 'index_names'").fetchone()
+        if row:
+            return set(json.loads(row[0]))
+        if conn.execute("SELECT 1 FROM storage_meta WHERE key = 'indexes'").fetchone():
+            return set(self.LEGACY_INDEX_NAMES)
+        return set()
+    
+    def _mark_indexed(self):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('indexes', ?)",
+            (datetime.now().isoformat(),)
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('index_names', ?)",
+            (json.dumps(sorted(SECONDARY_INDEXES)),)
+        )
+    
+    def _index_names(self, table: str) -> list:
+        return [name for name, (indexed_table, _) in SECONDARY_INDEXES.items() if indexed_table == table]
+    
+    def _unindex_row(self, table: str, key: str):
+        names = self._index_names(table)
+        self._connection().execute(
+            f"DELETE FROM storage_index WHERE name IN ({','.join('?' * len(names))}) AND row_key = ?",
+            (*names, key)
+        )
+    
+    def _index_rows(self, table: str, rows):
+        self._connection().executemany(
+            "INSERT OR IGNORE INTO storage_index (name, value, row_key, ref) VALUES (?, ?, ?, ?)",
+            [(name, value, str(key), self._encode(ref))
+             for key, row in rows
+             for name, value, ref in _index_entries(table, str(key), row)]
+        )
+    
+    def _reindex_table(self, table: str, rows):
+        """Reconstruye las entradas de índice de una tabla completa"""
+        names = self._index_names(table)
+        self._connection().execute(
+            f"DELETE FROM storage_index WHERE name IN ({','.join('?' * len(names))})", names
+        )
+        self._index_rows(table, rows)
+    
+    @contextmanager
+    def batch(self):
+        """Transacción SQLite; las llamadas anidadas se unen a la exterior"""
+        conn = self._connection()
+        outermost = self._local.depth == 0
+        if outermost:
+            conn.execute("BEGIN IMMEDIATE")
+        self._local.depth += 1
+        
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if outermost:
+                conn.execute("ROLLBACK")
+            raise
+        
+        self._local.depth -= 1
+        if outermost:
+            conn.execute("COMMIT")
+    
+    def _encode(self, value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    
+    def get(self, table: str, key: str, default=None):
+        row = self._connection().execute(
+            f"SELECT data FROM {self._table(table)} WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def put(self, table: str, key: str, value):
+        with self.batch():
+            self._connection().execute(
+                f"""INSERT INTO {self._table(table)} (key, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+                (key, self._encode(value), datetime.now().isoformat())
+            )
+            if table in INDEXED_TABLES:
+                self._unindex_row(table, key)
+                self._index_rows(table, [(key, value)])
+    
+    def delete(self, table: str, key: str):
+        with self.batch():
+            self._connection().execute(f"DELETE FROM {self._table(table)} WHERE key = ?", (key,))
+            if table in INDEXED_TABLES:
+                self._unindex_row(table, key)
+    
+    def lookup(self, index: str, value, default=None):
+        row = self._connection().execute(
+            "SELECT ref FROM storage_index WHERE name = ? AND value = ?", (index, str(value))
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def items(self, table: str) -> list:
+        rows = self._connection().execute(
+            f"SELECT key, data FROM {self._table(table)} ORDER BY seq"
+        ).fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+    
+    def replace(self, table: str, items):
+        now = datetime.now().isoformat()
+        with self.batch():
+            conn = self._connection()
+            conn.execute(f"DELETE FROM {self._table(table)}")
+            items = list(items)
+            conn.executemany(
+                f"INSERT INTO {table} (key, data, updated_at) VALUES (?, ?, ?)",
+                [(str(key), self._encode(value), now) for key, value in items]
+            )
+            if table in INDEXED_TABLES:
+                self._reindex_table(table, items)
+    
+    def count(self, table: str) -> int:
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self._table(table)}").fetchone()[0]
+    
+    def iter_items(self, table: str):
+        cursor = self._connection().execute(f"SELECT key, data FROM {self._table(table)} ORDER BY seq")
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                return
+            for key, data in rows:
+                yield key, json.loads(data)
+    
+    # Filas por segmento, agrupadas por seq (que no cambia al actualizar una fila)
+    SEGMENT_ROWS = 1000
+    
+    def segments(self, table: str) -> dict:
+        """Versión de cada bloque de filas: número de filas y última modificación
+        
+        Una inserción o un borrado cambian el recuento del bloque; una
+        actualización fija updated_at al instante actual, que pasa a ser el
+        máximo del bloque.
+        """
+        rows = self._connection().execute(
+            f"SELECT seq / ?, COUNT(*), MAX(updated_at) FROM {self._table(table)} GROUP BY seq / ?",
+            (self.SEGMENT_ROWS, self.SEGMENT_ROWS)
+        ).fetchall()
+        return {str(block): f"{count}:{updated_at}" for block, count, updated_at in rows}
+    
+    def segment_items(self, table: str, segment: str):
+        start = int(segment) * self.SEGMENT_ROWS
+        cursor = self._connection().execute(
+            f"SELECT key, data FROM {self._table(table)} WHERE seq >= ? AND seq < ? ORDER BY seq",
+            (start, start + self.SEGMENT_ROWS)
+        )
+        for key, data in cursor:
+            yield key, json.loads(data)
+    
+    def put_many(self, table: str, items, chunk_size: int = 1000) -> int:
+        # Una transacción por bloque: la memoria queda acotada al tamaño del bloque
+        count, chunk = 0, []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                count += super().put_many(table, chunk)
+                chunk = []
+        if chunk:
+            count += super().put_many(table, chunk)
+        return count
+    
+    def key_range(self, table: str, start_key: str, end_key: str) -> list:
+        # Recorrido ordenado sobre el índice UNIQUE de la clave
+        rows = self._connection().execute(
+            f"SELECT key, data FROM {self._table(table)} WHERE key >= ? AND key < ? ORDER BY key",
+            (start_key, end_key)
+        ).fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+    
+    def size_bytes(self) -> int:
+        return sum(
+            os.path.getsize(path)
+            for path in (self.db_path, self.db_path + "-wal")
+            if os.path.exists(path)
+        )
+
+
+def create_storage_backend(database_config: dict, files: dict) -> StorageBackend:
+    """Crea el motor de almacenamiento configurado en [database]"""
+    if database_config.get("type") == "sqlite":
+        db_path = os.path.join(database_config.get("path", "data/"),
+                               database_config.get("sqlite_file", "mindgeekclinic.db"))
+        return SQLiteStorageBackend(db_path, legacy_files=files)
+    
+    return JSONStorageBackend(
+        files,
+        payments_journal=database_config.get("payments_journal", True),
+        journal_max_bytes=int(database_config.get("payments_journal_max_kb", 512)) * 1024,
+        serializer=get_serializer(database_config.get("serializer", "json"))
+    )
+
+
+class CounterBuffer:
+    """Buffer write-behind para contadores calientes
+    
+    Acumula incrementos y asignaciones de campos en memoria y los escribe en un
+    único lote cada flush_ms milisegundos o cada max_events eventos, lo que
+    ocurra antes. Al salir el proceso se vacía con atexit.
+    """
+    
+    _instances = {}
+    _instances_lock = threading.Lock()
+    
+    def __init__(self, storage: StorageBackend, flush_ms: int = 500, max_events: int = 100):
+        self.storage = storage
+        self.flush_ms = flush_ms
+        self.max_events = max_events
+        self._pending = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+    
+    @classmethod
+    def shared(cls, storage: StorageBackend, location: str, flush_ms: int, max_events: int) -> "CounterBuffer":
+        """Buffer único por ubicación de almacenamiento, compartido por todas las sesiones"""
+        with cls._instances_lock:
+            if location not in cls._instances:
+                cls._instances[location] = cls(storage, flush_ms, max_events)
+            return cls._instances[location]
+    
+    def increment(self, table: str, key: str, field: str, delta=1):
+        """Acumula un incremento sobre un campo numérico de una fila"""
+        self._record(table, key, field, "inc", delta)
+    
+    def set(self, table: str, key: str, field: str, value):
+        """Acumula una asignación; gana la última antes del flush"""
+        self._record(table, key, field, "set", value)
+    
+    def _record(self, table: str, key: str, field: str, op: str, value):
+        with self._lock:
+            fields = self._pending.setdefault((table, key), {})
+            previous = fields.get(field)
+            if op == "inc" and previous is not None:
+                fields[field] = (previous[0], previous[1] + value)
+            else:
+                fields[field] = (op, value)
+            
+            self._events += 1
+            flush_now = self._events >= self.max_events
+            if not flush_now and self._timer is None:
+                self._timer = threading.Timer(self.flush_ms / 1000, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        
+        if flush_now:
+            self.flush()
+    
+    def flush(self):
+        """Escribe los contadores acumulados en un único lote"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._events = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        
+        if not pending:
+            return
+        
+        try:
+            with self.storage.batch():
+                for (table, key), fields in pending.items():
+                    # Las estadísticas globales se crean si faltan; el resto de filas no
+                    row = self.storage.get(table, key, {} if table == "affiliates_meta" else None)
+                    if row is None:
+                        continue
+                    for field, (op, value) in fields.items():
+                        row[field] = row.get(field, 0) + value if op == "inc" else value
+                    self.storage.put(table, key, row)
+        except Exception as e:
+            logger.error(f"Error escribiendo contadores acumulados: {e}")
+            self._restore(pending)
+    
+    def _restore(self, pending: dict):
+        """Devuelve al buffer unos cambios no escritos, por delante de los más recientes"""
+        with self._lock:
+            for row_key, fields in pending.items():
+                current = self._pending.setdefault(row_key, {})
+                for field, (op, value) in fields.items():
+                    newer = current.get(field)
+                    if newer is None:
+                        current[field] = (op, value)
+                    elif newer[0] == "inc":
+                        current[field] = (op, value + newer[1])
+            
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_ms / 1000, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def pending_count(self) -> int:
+        """Filas con cambios pendientes de escribir"""
+        with self._lock:
+            return len(self._pending)
+
+
+# ============================================
+# INSTANTÁNEAS DE ESTRUCTURAS DERIVADAS
+# ============================================
+
+def _top_rows(rows, field: str, default=0, limit: int = 5) -> list:
+    """Las `limit` filas con mayor valor de `field` (mismo orden que sorted(..., reverse=True))"""
+    return heapq.nlargest(limit, rows, key=lambda row: row.get(field, default))
+
+
+def _merge_counts(partials) -> dict:
+    totals = {}
+    for partial in partials:
+        for key, count in partial.items():
+            totals[key] = totals.get(key, 0) + count
+    return dict(sorted(totals.items()))
+
+
+def _count_diagnoses_by_day(items) -> dict:
+    counts = {}
+    for _, report in items:
+        day = str(report.get("timestamp", ""))[:10] if isinstance(report, dict) else ""
+        if day:
+            counts[day] = counts.get(day, 0) + 1
+    return counts
+
+
+# Estructuras derivadas de los almacenes: cada segmento de la tabla de origen
+# se reduce a un resultado parcial y los parciales se combinan en el resultado.
+# Subir "version" al cambiar la definición invalida las instantáneas guardadas.
+DERIVED_VIEWS = {
+    "top_affiliates": {
+        "version": 1,
+        "table": "affiliates",
+        "partial": lambda items: _top_rows(
+            ({
+                "id": affiliate.get("id"),
+                "name": affiliate.get("full_name", "N/A"),
+                "earnings": affiliate.get("total_commission", 0.0),
+                "conversions": affiliate.get("conversions_count", 0)
+            } for _, affiliate in items),
+            "earnings"
+        ),
+        "merge": lambda partials: _top_rows((row for partial in partials for row in partial), "earnings")
+    },
+    "recent_payments": {
+        "version": 1,
+        "table": "payments",
+        "partial": lambda items: _top_rows((payment for _, payment in items), "request_date", ""),
+        "merge": lambda partials: _top_rows((row for partial in partials for row in partial), "request_date", "")
+    },
+    "diagnoses_by_day": {
+        "version": 1,
+        "table": "diagnostics",
+        "partial": _count_diagnoses_by_day,
+        "merge": _merge_counts
+    }
+}
+
+SNAPSHOT_FORMAT = 1
+
+
+class SnapshotManager:
+    """Instantáneas en disco de las estructuras derivadas (DERIVED_VIEWS)
+    
+    Cada instantánea guarda la versión de su definición, la versión de cada
+    segmento de origen con su resultado parcial, una suma de comprobación de
+    las versiones de origen y otra de su propio contenido. Si el origen no ha
+    cambiado se sirve tras leer el archivo; si cambió, solo se releen los
+    segmentos modificados.
+    """
+    
+    def __init__(self, storage: StorageBackend, directory: str):
+        self.storage = storage
+        self.directory = directory
+        self._memory = {}
+        self._lock = threading.Lock()
+        self.counters = {"memory": 0, "loaded": 0, "incremental": 0, "rebuilt": 0, "segments_read": 0}
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.snapshot.json")
+    
+    @staticmethod
+    def _checksum(data) -> str:
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    
+    def get(self, name: str):
+        """Resultado actualizado de una estructura derivada (no debe mutarse)"""
+        view = DERIVED_VIEWS[name]
+        
+        with self._lock:
+            # Las versiones se toman antes de leer: un cambio concurrente se verá en la siguiente consulta
+            segments = self.storage.segments(view["table"])
+            source_checksum = self._checksum(segments)
+            
+            snapshot = self._memory.get(name)
+            if snapshot and snapshot["source_checksum"] == source_checksum:
+                self.counters["memory"] += 1
+                return snapshot["result"]
+            
+            snapshot = snapshot or self._read(name, view)
+            if snapshot and snapshot["source_checksum"] == source_checksum:
+                self.counters["loaded"] += 1
+            else:
+                snapshot = self._rebuild(name, view, segments, source_checksum, snapshot)
+                self._write(name, snapshot)
+            
+            self._memory[name] = snapshot
+            return snapshot["result"]
+    
+    def _read(self, name: str, view: dict) -> Optional[dict]:
+        """Instantánea guardada, o None si falta, está dañada o es de otra versión"""
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            content = stored["content"]
+            if stored.get("checksum") != self._checksum(content):
+                logger.warning(f"Instantánea {name} dañada, se reconstruye")
+                return None
+            if content["format"] != SNAPSHOT_FORMAT or content["version"] != view["version"]:
+                return None
+            return content
+        except Exception as e:
+            logger.warning(f"No se pudo leer la instantánea {name}: {e}")
+            return None
+    
+    def _rebuild(self, name: str, view: dict, segments: dict, source_checksum: str, previous: dict = None) -> dict:
+        """Relee solo los segmentos nuevos o modificados y combina los parciales"""
+        known = (previous or {}).get("segments", {})
+        rebuilt = {}
+        reread = 0
+        
+        for segment, version in segments.items():
+            entry = known.get(segment)
+            if entry is None or entry["version"] != version:
+                entry = {"version": version, "partial": view["partial"](self.storage.segment_items(view["table"], segment))}
+                reread += 1
+            rebuilt[segment] = entry
+        
+        self.counters["incremental" if previous else "rebuilt"] += 1
+        self.counters["segments_read"] += reread
+        logger.info(f"Instantánea {name}: {reread}/{len(segments)} segmentos releídos")
+        
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "view": name,
+            "version": view["version"],
+            "source_checksum": source_checksum,
+            "built_at": datetime.now().isoformat(),
+            "segments": rebuilt,
+            "result": view["merge"](entry["partial"] for entry in rebuilt.values())
+        }
+    
+    def _write(self, name: str, content: dict):
+        path = self._path(name)
+        try:
+            with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump({"checksum": self._checksum(content), "content": content}, f, ensure_ascii=False, default=str)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.error(f"Error guardando instantánea {name}: {e}")
+    
+    def stats(self) -> dict:
+        """Contadores de uso de las instantáneas"""
+        return dict(self.counters)
+
+
+class VectorStore:
+    """Colecciones de ChromaDB abiertas en el primer uso
+    
+    El cliente persistente se abre una sola vez por proceso y ruta, y cada
+    colección se crea la primera vez que se necesita.
+    """
+    
+    COLLECTIONS = {
+        "diagnostics": "Diagnósticos de biodescodificación",
+        "sessions": "Sesiones de hipnosis y meditación"
+    }
+    
+    _clients = {}
+    _lock = threading.Lock()
+    
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._collections = {}
+    
+    @property
+    def opened(self) -> bool:
+        return self.path in VectorStore._clients
+    
+    def _client(self):
+        """Cliente persistente del proceso para esta ruta (None si ChromaDB no está disponible)"""
+        with VectorStore._lock:
+            if self.path not in VectorStore._clients:
+                try:
+                    VectorStore._clients[self.path] = chromadb.PersistentClient(path=self.path)
+                except Exception as e:
+                    logger.warning(f"No se pudo abrir ChromaDB en {self.path}: {e}")
+                    VectorStore._clients[self.path] = None
+            return VectorStore._clients[self.path]
+    
+    def collection(self, name: str):
+        """Colección por nombre, creada si no existe"""
+        collection = self._collections.get(name)
+        if collection is None:
+            client = self._client()
+            if client is None:
+                return None
+            try:
+                collection = client.get_or_create_collection(
+                    name=name,
+                    metadata={"description": self.COLLECTIONS.get(name, name)}
+                )
+                self._collections[name] = collection
+            except Exception as e:
+                logger.warning(f"No se pudo crear la colección {name}: {e}")
+        return collection
+    
+    def add(self, name: str, document_id: str, document: str, metadata: dict) -> bool:
+        """Inserta (o reemplaza) un documento; devuelve False si no hay almacén vectorial"""
+        collection = self.collection(name)
+        if collection is None:
+            return False
+        collection.upsert(documents=[document], metadatas=[metadata], ids=[document_id])
+        return True
+
+
 class DatabaseManager:
     """Gestor completo de base de datos"""
     
     def __init__(self):
-        self.affiliates_file = "data/affiliates_db . json"
-        self.payments_file = "data/payment_log.json"
-        self.diagnostics_file = "data/diagnostics_db.json"
-        self.sessions_file = "data/sessions_db.json"
-        self.users_file = "data/users_db.json"
+        self.affiliates_file = os.path.join("data", STORE_FILE_NAMES["affiliates"])
+        self.payments_file = os.path.join("data", STORE_FILE_NAMES["payments"])
+        self.diagnostics_file = os.path.join("data", STORE_FILE_NAMES["diagnostics"])
+        self.sessions_file = os.path.join("data", STORE_FILE_NAMES["sessions"])
+        self.users_file = os.path.join("data", STORE_FILE_NAMES["users"])
         
         # Crear directorio si no existe
         os.makedirs("data", exist_ok=True)
         
+        # Motor de almacenamiento configurado (JSON o SQLite)
+        database_config = ConfigManager().database_config
+        self.storage = create_storage_backend(
+            database_config,
+            {
+                "affiliates": self.affiliates_file,
+                "payments": self.payments_file,
+                "diagnostics": self.diagnostics_file,
+                "sessions": self.sessions_file,
+                "users": self.users_file
+            }
+        )
+        
         # Inicializar bases de datos
         self._init_databases()
         
-        # Configurar ChromaDB para embeddings
-        self._setup_chromadb()
+        # Contadores calientes con escritura diferida
+        self.counters = CounterBuffer.shared(
+            self.storage,
+            self.storage.location,
+            database_config.get("counter_flush_ms", 500),
+            database_config.get("counter_flush_events", 100)
+        )
+        
+        # Estructuras derivadas persistidas junto a los datos
+        self.snapshots = SnapshotManager(self.storage, os.path.join("data", "snapshots"))
+        
+        # Almacén vectorial (ChromaDB): se abre en la primera operación con vectores
+        self.vectors = VectorStore(database_config.get("vector_path", "chroma_db"))
     
     def _init_databases(self):
         """Inicializa todas las bases de datos"""
         databases = {
-            self.affiliates_file: {
+            "affiliates": {
                 "affiliates": {},
                 "next_id": 1,
                 "referrals": {},
@@ -702,103 +2946,84 @@ class DatabaseManager:
                 "settings": {
                     "commission_rate": 0.30,
                     "min_payout": 50.0,
-                    "payout_day": "thursday"
-                }
-            },
-            self.payments_file: [],
-            self.diagnostics_file: {},
-            self.sessions_file: {},
-            self.users_file: {}
-        }
-        
-        for file_path, default_data in databases.items():
-            if not os.path.exists(file_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(default_data, f, indent=2, ensure_ascii=False)
-    
-    def _setup_chromadb(self):
-        """Configura ChromaDB para embeddings"""
-        try:
-            self.chroma_client = chromadb.Client(Settings(
-                chroma_db_impl="duckdb+parquet",
-                persist_directory="./chroma_db"
-            ))
-            
-            # Crear colección para diagnósticos
-            self.diagnostics_collection = self.chroma_client.get_or_create_collection(
-                name="diagnostics",
-                metadata={"description": "Diagnósticos de biodescodificación"}
-            )
-            
-            # Crear colección para sesiones
-            self.sessions_collection = self.chroma_client.get_or_create_collection(
-                name="sessions",
-                metadata={"description": "Sesiones de hipnosis y meditación"}
-            )
-            
-        except Exception as e:
-            logger.warning(f"No se pudo configurar ChromaDB: {e}")
-            self.chroma_client = None
+                    "payout_day": "thursday"
+                }
+            },
+            "payments": [],
+            "diagnostics": {},
+            "sessions": {},
+            "users": {}
+        }
+        
+        self.storage.initialize(databases)
+    
+    @contextmanager
+    def transaction(self):
+        """Unidad de trabajo: cada almacén se carga una vez y todos los cambios se confirman juntos
+        
+        Con JSON, un commit que toca varios archivos pasa por una intención de
+        commit y renombrados atómicos; con SQLite es una única transacción.
+        Las transacciones anidadas se unen a la exterior.
+        """
+        with self.storage.batch():
+            yield self
     
     # ========== MÉTODOS PARA AFILIADOS ==========
     
     def add_affiliate(self, affiliate_data: dict) -> Tuple[bool, str, dict]:
         """Agrega un nuevo afiliado"""
         try:
-            db = self.load_affiliates()
-            
             # Verificar si el email ya existe
-            for aff in db["affiliates"].values():
-                if aff["email"] == affiliate_data["email"]:
-                    return False, "El email ya está registrado", {}
-            
-            # Generar IDs y códigos
-            affiliate_id = f"AFF{db['next_id']:04d}"
-            referral_code = self._generate_referral_code()
-            
-            # Crear registro completo
-            affiliate_record = {
-                "id": affiliate_id,
-                "referral_code": referral_code,
-                "status": "pending",
-                "verification_status": "pending",
-                "kyc_status": "pending",
-                "registration_date": datetime.now().isoformat(),
-                "last_login": None,
-                "last_payment": None,
-                "total_earnings": 0.0,
-                "pending_earnings": 0.0,
-                "paid_earnings": 0.0,
-                "commission_rate": 0.30,
-                "referrals_count": 0,
-                "conversions_count": 0,
-                "total_commission": 0.0,
-                "payment_method": "binance",
-                "payment_address": affiliate_data.get("binance_address", ""),
-                **affiliate_data
-            }
-            
-            # Guardar en base de datos
-            db["affiliates"][affiliate_id] = affiliate_record
-            db["next_id"] += 1
-            
-            # Inicializar registro de referidos
-            db["referrals"][referral_code] = {
-                "affiliate_id": affiliate_id,
-                "referrals": [],
-                "conversions": 0,
-                "total_commission": 0.0,
-                "created_at": datetime.now().isoformat()
-            }
+            if self.find_affiliate_by_email(affiliate_data["email"]):
+                return False, "El email ya está registrado", {}
             
-            # Actualizar estadísticas
-            db["statistics"]["total_registered"] += 1
-            db["statistics"]["pending_affiliates"] += 1
-            
-            self.save_affiliates(db)
+            with self.transaction():
+                next_id = self.storage.get("affiliates_meta", "next_id", 1)
+                
+                # Generar IDs y códigos
+                affiliate_id = f"AFF{next_id:04d}"
+                referral_code = self._generate_referral_code()
             
-            # Crear registro de usuario
-            self._create_user_record(affiliate_id, affiliate_data["email"])
+                # Crear registro completo
+                affiliate_record = {
+                    "id": affiliate_id,
+                    "referral_code": referral_code,
+                    "status": "pending",
+                    "verification_status": "pending",
+                    "kyc_status": "pending",
+                    "registration_date": datetime.now().isoformat(),
+                    "last_login": None,
+                    "last_payment": None,
+                    "total_earnings": 0.0,
+                    "pending_earnings": 0.0,
+                    "paid_earnings": 0.0,
+                    "commission_rate": 0.30,
+                    "referrals_count": 0,
+                    "conversions_count": 0,
+                    "total_commission": 0.0,
+                    "payment_method": "binance",
+                    "payment_address": affiliate_data.get("binance_address", ""),
+                    **affiliate_data
+                }
+                
+                # Guardar en base de datos
+                self.storage.put("affiliates", affiliate_id, affiliate_record)
+                self.storage.put("affiliates_meta", "next_id", next_id + 1)
+                
+                # Inicializar registro de referidos
+                self.storage.put("referrals", referral_code, {
+                    "affiliate_id": affiliate_id,
+                    "referrals": [],
+                    "conversions": 0,
+                    "total_commission": 0.0,
+                    "created_at": datetime.now().isoformat()
+                })
+                
+                # Actualizar estadísticas
+                self._increment_statistics(total_registered=1, pending_affiliates=1)
+                
+                # Crear registro de usuario
+                self._create_user_record(affiliate_id, affiliate_data["email"])
             
             return True, "Afiliado registrado exitosamente", affiliate_record
             
@@ -808,31 +3033,30 @@ class DatabaseManager:
     def update_affiliate_status(self, affiliate_id: str, status: str) -> bool:
         """Actualiza el estado de un afiliado"""
         try:
-            db = self.load_affiliates()
-            
-            if affiliate_id not in db["affiliates"]:
-                return False
-            
-            old_status = db["affiliates"][affiliate_id].get("status", "pending")
-            db["affiliates"][affiliate_id]["status"] = status
-            
-            # Actualizar estadísticas
-            if old_status != status:
-                if old_status == "active":
-                    db["statistics"]["active_affiliates"] -= 1
-                elif old_status == "pending":
-                    db["statistics"]["pending_affiliates"] -= 1
-                elif old_status == "suspended":
-                    db["statistics"]["suspended_affiliates"] -= 1
+            with self.storage.batch():
+                affiliate = self.storage.get("affiliates", affiliate_id)
                 
-                if status == "active":
-                    db["statistics"]["active_affiliates"] += 1
-                elif status == "pending":
-                    db["statistics"]["pending_affiliates"] += 1
-                elif status == "suspended":
-                    db["statistics"]["suspended_affiliates"] += 1
-            
-            self.save_affiliates(db)
+                if affiliate is None:
+                    return False
+                
+                old_status = affiliate.get("status", "pending")
+                affiliate["status"] = status
+                self.storage.put("affiliates", affiliate_id, affiliate)
+                
+                # Actualizar estadísticas
+                if old_status != status:
+                    status_counters = {
+                        "active": "active_affiliates",
+                        "pending": "pending_affiliates",
+                        "suspended": "suspended_affiliates"
+                    }
+                    deltas = {}
+                    if old_status in status_counters:
+                        deltas[status_counters[old_status]] = -1
+                    if status in status_counters:
+                        deltas[status_counters[status]] = 1
+                    self._increment_statistics(**deltas)
+            
             return True
             
         except Exception as e:
@@ -842,12 +3066,11 @@ class DatabaseManager:
     def add_referral(self, referral_code: str, user_id: str):
         """Agrega un referido"""
         try:
-            db = self.load_affiliates()
-            
-            if referral_code in db["referrals"]:
-                referral_data = db["referrals"][referral_code]
+            with self.storage.batch():
+                referral_data = self.storage.get("referrals", referral_code)
+                already_referred = self.storage.lookup("referral_user", f"{referral_code}:{user_id}") is not None
                 
-                if user_id not in referral_data["referrals"]:
+                if referral_data is not None and not already_referred:
                     referral_data["referrals"].append({
                         "user_id": user_id,
                         "timestamp": datetime.now().isoformat(),
@@ -855,15 +3078,11 @@ class DatabaseManager:
                         "conversion_date": None,
                         "commission": 0.0
                     })
+                    self.storage.put("referrals", referral_code, referral_data)
                     
-                    # Actualizar contador del afiliado
-                    affiliate_id = referral_data["affiliate_id"]
-                    if affiliate_id in db["affiliates"]:
-                        db["affiliates"][affiliate_id]["referrals_count"] += 1
-                    
-                    db["statistics"]["total_referrals"] += 1
-                    
-                    self.save_affiliates(db)
+                    # Contadores del afiliado y globales con escritura diferida
+                    self.counters.increment("affiliates", referral_data["affiliate_id"], "referrals_count")
+                    self.counters.increment("affiliates_meta", "statistics", "total_referrals")
                     
         except Exception as e:
             logger.error(f"Error agregando referido: {e}")
@@ -871,13 +3090,23 @@ class DatabaseManager:
     def record_conversion(self, referral_code: str, user_id: str, amount: float):
         """Registra una conversión (venta)"""
         try:
-            db = self.load_affiliates()
-            
-            if referral_code in db["referrals"]:
-                referral_data = db["referrals"][referral_code]
+            # Afiliado, referidos, estadísticas y pago pendiente en un único commit
+            with self.transaction():
+                referral_data = self.storage.get("referrals", referral_code)
+                if referral_data is None:
+                    return
                 
-                # Encontrar el referido
-                for referral in referral_data["referrals"]:
+                # Encontrar el referido (por índice; recorrido solo con duplicados antiguos)
+                referrals = referral_data["referrals"]
+                position = self.storage.lookup("referral_user", f"{referral_code}:{user_id}")
+                if position is None:
+                    return
+                if referrals[position]["converted"]:
+                    candidates = referrals[position + 1:]
+                else:
+                    candidates = [referrals[position]]
+                
+                for referral in candidates:
                     if referral["user_id"] == user_id and not referral["converted"]:
                         referral["converted"] = True
                         referral["conversion_date"] = datetime.now().isoformat()
@@ -888,22 +3117,21 @@ class DatabaseManager:
                         
                         # Actualizar afiliado
                         affiliate_id = referral_data["affiliate_id"]
-                        if affiliate_id in db["affiliates"]:
-                            affiliate = db["affiliates"][affiliate_id]
+                        affiliate = self.storage.get("affiliates", affiliate_id)
+                        if affiliate is not None:
                             affiliate["conversions_count"] += 1
                             affiliate["total_commission"] += commission
                             affiliate["pending_earnings"] += commission
                             affiliate["total_earnings"] += commission
+                            self.storage.put("affiliates", affiliate_id, affiliate)
                         
                         # Actualizar datos de referidos
                         referral_data["conversions"] += 1
                         referral_data["total_commission"] += commission
+                        self.storage.put("referrals", referral_code, referral_data)
                         
                         # Actualizar estadísticas
-                        db["statistics"]["total_conversions"] += 1
-                        db["statistics"]["total_earnings"] += commission
-                        
-                        self.save_affiliates(db)
+                        self._increment_statistics(total_conversions=1, total_earnings=commission)
                         
                         # Registrar pago pendiente
                         self._add_pending_payment(affiliate_id, commission)
@@ -916,10 +3144,10 @@ class DatabaseManager:
     def _add_pending_payment(self, affiliate_id: str, amount: float):
         """Agrega pago pendiente al historial"""
         try:
-            payments = self.load_payments()
-            
+            payment_id = ID_GENERATOR.new_id("COM")
             payment = {
-                "id": len(payments) + 1,
+                "id": payment_id,
+                "payment_id": payment_id,
                 "affiliate_id": affiliate_id,
                 "amount": amount,
                 "currency": "USD",
@@ -931,28 +3159,35 @@ class DatabaseManager:
                 "transaction_id": None
             }
             
-            payments.append(payment)
-            self.save_payments(payments)
+            self.append_payment(payment)
             
         except Exception as e:
             logger.error(f"Error agregando pago pendiente: {e}")
     
+    def _increment_statistics(self, **deltas):
+        """Aplica incrementos a las estadísticas globales de afiliados"""
+        with self.storage.batch():
+            statistics = self.storage.get("affiliates_meta", "statistics", {})
+            for field, delta in deltas.items():
+                statistics[field] = statistics.get(field, 0) + delta
+            self.storage.put("affiliates_meta", "statistics", statistics)
+    
     def _generate_referral_code(self) -> str:
         """Genera un código de referido único"""
         import string
         characters = string.ascii_uppercase + string.digits
         while True:
             code = 'MG' + ''.join(random.choices(characters, k=6))
-            # Verificar unicidad (implementar check en base de datos)
-            return code
+            # Verificar unicidad
+            if (self.storage.lookup("affiliate_referral_code", code) is None
+                    and self.storage.get("referrals", code) is None):
+                return code
     
     def _create_user_record(self, user_id: str, email: str):
         """Crea un registro de usuario"""
         try:
-            users = self.load_users()
-            
-            if user_id not in users:
-                users[user_id] = {
+            if self.storage.get("users", user_id) is None:
+                self.storage.put("users", user_id, {
                     "id": user_id,
                     "email": email,
                     "created_at": datetime.now().isoformat(),
@@ -961,20 +3196,80 @@ class DatabaseManager:
                     "sessions_count": 0,
                     "preferences": {},
                     "subscription": "free"
-                }
-                
-                self.save_users(users)
+                })
                 
         except Exception as e:
             logger.error(f"Error creando registro de usuario: {e}")
     
-    # ========== MÉTODOS DE CARGA/GUARDADO ==========
+    # ========== MÉTODOS POR FILA ==========
+    
+    def get_affiliate(self, affiliate_id: str) -> Optional[dict]:
+        """Obtiene un afiliado por ID"""
+        return self.storage.get("affiliates", affiliate_id)
+    
+    def save_affiliate(self, affiliate: dict):
+        """Guarda un único afiliado"""
+        self.storage.put("affiliates", affiliate["id"], affiliate)
+    
+    def find_affiliate_by_email(self, email: str) -> Optional[dict]:
+        """Busca un afiliado por email usando el índice secundario"""
+        affiliate_id = self.storage.lookup("affiliate_email", email)
+        affiliate = self.storage.get("affiliates", affiliate_id) if affiliate_id else None
+        return affiliate if affiliate and affiliate.get("email") == email else None
+    
+    def find_affiliate_by_referral_code(self, referral_code: str) -> Optional[dict]:
+        """Busca un afiliado por código de referido usando el índice secundario"""
+        affiliate_id = self.storage.lookup("affiliate_referral_code", referral_code)
+        affiliate = self.storage.get("affiliates", affiliate_id) if affiliate_id else None
+        return affiliate if affiliate and affiliate.get("referral_code") == referral_code else None
+    
+    def append_payment(self, payment: dict):
+        """Añade un pago al historial"""
+        key = payment.get("payment_id") or _payment_key(payment, self.storage.count("payments"))
+        self.storage.put("payments", str(key), payment)
+    
+    def update_payment(self, payment: dict):
+        """Actualiza un pago existente identificado por payment_id"""
+        self.storage.put("payments", str(payment["payment_id"]), payment)
+    
+    def update_payment_fields(self, payment_id: str, changes: dict) -> bool:
+        """Actualiza solo los campos indicados de un pago"""
+        return self.storage.patch("payments", str(payment_id), changes)
     
-    def load_affiliates(self) -> dict:
-        """Carga datos de afiliados"""
+    # ========== CONSULTAS POR RANGO DE TIEMPO ==========
+    
+    def get_diagnostics_between(self, start: datetime, end: datetime) -> list:
+        """Diagnósticos creados en [start, end) mediante recorrido ordenado de claves
+        
+        Solo cubre identificadores de ID_GENERATOR; las claves antiguas basadas
+        en segundos no siguen ese orden.
+        """
+        rows = self.storage.key_range(
+            "diagnostics",
+            ID_GENERATOR.lower_bound("DIAG", start),
+            ID_GENERATOR.lower_bound("DIAG", end)
+        )
+        return [value for _, value in rows]
+    
+    def get_payments_between(self, start: datetime, end: datetime) -> list:
+        """Pagos (comisiones y retiros) creados en [start, end), en orden temporal"""
+        rows = []
+        for prefix in ("COM", "PAY"):
+            rows += self.storage.key_range(
+                "payments",
+                ID_GENERATOR.lower_bound(prefix, start),
+                ID_GENERATOR.lower_bound(prefix, end)
+            )
+        # Se ordena por la parte temporal, común a ambos prefijos
+        rows.sort(key=lambda item: item[0].split("_", 1)[1])
+        return [value for _, value in rows]
+    
+    # ========== MÉTODOS DE CARGA/GUARDADO (COMPATIBILIDAD) ==========
+    
+    def load_affiliates(self, readonly: bool = False) -> dict:
+        """Carga datos de afiliados (readonly=True entrega la copia compartida de la caché)"""
         try:
-            with open(self.affiliates_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load_store("affiliates", readonly)
         except Exception as e:
             logger.error(f"Error cargando afiliados: {e}")
             return {"affiliates": {}, "next_id": 1, "referrals": {}, "statistics": {}}
@@ -982,16 +3277,14 @@ class DatabaseManager:
     def save_affiliates(self, data: dict):
         """Guarda datos de afiliados"""
         try:
-            with open(self.affiliates_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            self.storage.save_store("affiliates", data)
         except Exception as e:
             logger.error(f"Error guardando afiliados: {e}")
     
-    def load_payments(self) -> list:
-        """Carga historial de pagos"""
+    def load_payments(self, readonly: bool = False) -> list:
+        """Carga historial de pagos (readonly=True entrega la copia compartida de la caché)"""
         try:
-            with open(self.payments_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load_store("payments", readonly)
         except Exception as e:
             logger.error(f"Error cargando pagos: {e}")
             return []
@@ -999,56 +3292,49 @@ class DatabaseManager:
     def save_payments(self, data: list):
         """Guarda historial de pagos"""
         try:
-            with open(self.payments_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            self.storage.save_store("payments", data)
         except Exception as e:
             logger.error(f"Error guardando pagos: {e}")
     
     def load_diagnostics(self) -> dict:
         """Carga diagnósticos"""
         try:
-            with open(self.diagnostics_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load_store("diagnostics")
         except:
             return {}
     
     def save_diagnostics(self, data: dict):
         """Guarda diagnósticos"""
         try:
-            with open(self.diagnostics_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            self.storage.save_store("diagnostics", data)
         except Exception as e:
             logger.error(f"Error guardando diagnósticos: {e}")
     
     def load_sessions(self) -> dict:
         """Carga sesiones"""
         try:
-            with open(self.sessions_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load_store("sessions")
         except:
             return {}
     
     def save_sessions(self, data: dict):
         """Guarda sesiones"""
         try:
-            with open(self.sessions_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            self.storage.save_store("sessions", data)
         except Exception as e:
             logger.error(f"Error guardando sesiones: {e}")
     
     def load_users(self) -> dict:
         """Carga usuarios"""
         try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load_store("users")
         except:
             return {}
     
     def save_users(self, data: dict):
         """Guarda usuarios"""
         try:
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            self.storage.save_store("users", data)
         except Exception as e:
             logger.error(f"Error guardando usuarios: {e}")
 
@@ -1056,15 +3342,390 @@ class DatabaseManager:
 # PARTE 6: SISTEMA DE IA PARA BIODESCODIFICACIÓN
 # ============================================
 
+def iter_completion_text(stream):
+    """Texto de cada fragmento de una respuesta en streaming (formato de Groq/OpenAI)"""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            yield text
+
+
+# Subir al cambiar el prompt o el modelo: invalida las respuestas cacheadas
+DIAGNOSIS_CACHE_VERSION = 1
+
+
+class DiagnosisCache:
+    """Caché de diagnósticos del LLM por perfil de síntomas normalizado
+    
+    Dos niveles: un LRU en memoria y un archivo por perfil en disco con
+    caducidad (TTL), que sobrevive a reinicios y es compartido por los
+    procesos que usan el mismo directorio de datos.
+    """
+    
+    AGE_BAND = 10
+    
+    def __init__(self, directory: str, max_entries: int = 256, ttl_hours: float = 24):
+        self.directory = directory
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = max(0.0, ttl_hours) * 3600
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "stored": 0}
+        os.makedirs(directory, exist_ok=True)
+    
+    @classmethod
+    def key_for(cls, symptoms_data: dict) -> str:
+        """Hash canónico de los datos que llegan al prompt
+        
+        Las listas de síntomas se ordenan, la edad se agrupa en franjas y se
+        excluyen el nombre y demás campos libres que no forman parte del prompt.
+        """
+        def _symptoms(field):
+            return sorted({str(symptom).strip().lower() for symptom in symptoms_data.get(field) or []})
+        
+        try:
+            age_band = int(symptoms_data.get("age")) // cls.AGE_BAND * cls.AGE_BAND
+        except (TypeError, ValueError):
+            age_band = None
+        
+        profile = {
+            "version": DIAGNOSIS_CACHE_VERSION,
+            "age_band": age_band,
+            "gender": symptoms_data.get("gender"),
+            "physical_symptoms": _symptoms("physical_symptoms"),
+            "emotional_symptoms": _symptoms("emotional_symptoms"),
+            "duration": symptoms_data.get("duration") or symptoms_data.get("symptom_duration"),
+            "history": symptoms_data.get("history")
+        }
+        return hashlib.sha1(json.dumps(profile, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def get(self, key: str) -> Optional[dict]:
+        """Diagnóstico cacheado (copia independiente) o None"""
+        now = time.time()
+        
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry["created_at"] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return copy.deepcopy(entry["diagnosis"])
+            if entry:
+                del self._memory[key]
+        
+        entry = self._read(key, now)
+        
+        with self._lock:
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._remember(key, entry)
+        return copy.deepcopy(entry["diagnosis"])
+    
+    def _read(self, key: str, now: float) -> Optional[dict]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if now - entry["created_at"] < self.ttl_seconds:
+                return entry
+            with self._lock:
+                self.counters["expired"] += 1
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Entrada de caché de diagnóstico ilegible {key}: {e}")
+        return None
+    
+    def _remember(self, key: str, entry: dict):
+        """Inserta en el LRU descartando las entradas menos usadas (con el lock tomado)"""
+        if not self.max_entries:
+            return
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    def put(self, key: str, diagnosis: dict):
+        """Guarda un diagnóstico en memoria y en disco"""
+        entry = {"created_at": time.time(), "diagnosis": copy.deepcopy(diagnosis)}
+        
+        with self._lock:
+            self._remember(key, entry)
+            self.counters["stored"] += 1
+        
+        path = self._path(key)
+        try:
+            with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False, default=str)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.error(f"Error guardando diagnóstico en caché: {e}")
+    
+    def clear(self):
+        """Vacía ambos niveles"""
+        with self._lock:
+            self._memory.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    logger.warning(f"No se pudo borrar {name} de la caché de diagnósticos: {e}")
+    
+    def stats(self) -> dict:
+        """Contadores y tasa de aciertos"""
+        with self._lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            total = hits + self.counters["misses"]
+            return {
+                "entries": len(self._memory),
+                **self.counters,
+                "hit_rate": round(hits / total * 100, 1) if total else 0.0
+            }
+
+
+class ProviderStats:
+    """Latencias y errores recientes de un proveedor de IA"""
+    
+    WINDOW = 100
+    
+    def __init__(self):
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.outcomes = deque(maxlen=self.WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_error = None
+        self.last_error_at = 0.0
+    
+    def record(self, seconds: float, error: Exception = None):
+        self.requests += 1
+        self.outcomes.append(error is None)
+        if error is None:
+            self.latencies.append(seconds)
+            self.consecutive_errors = 0
+        else:
+            self.errors += 1
+            self.consecutive_errors += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            self.last_error_at = time.time()
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class ProviderRouter:
+    """Enruta las peticiones de texto entre Groq, OpenAI y Anthropic
+    
+    Cada proveedor tiene su propio timeout. Se prueban en el orden
+    configurado, pero un proveedor con errores consecutivos o una tasa de
+    error reciente alta (medida sobre un mínimo de peticiones) pasa al final
+    de la cola durante un tiempo de enfriamiento. En modo hedged, si el primero no responde dentro de su
+    p95 se lanza la misma petición al siguiente y se usa la primera
+    respuesta válida.
+    """
+    
+    def __init__(self, clients: dict, config: dict):
+        self.clients = {name: client for name, client in clients.items() if client is not None}
+        self.config = config
+        self.order = [name for name in config["providers"] if name in self.clients]
+        self.stats = {name: ProviderStats() for name in self.order}
+        self._lock = threading.Lock()
+        self._executor = None
+    
+    def available(self) -> bool:
+        return bool(self.order)
+    
+    def ranked(self) -> list:
+        """Proveedores en el orden en que se intentarán ahora"""
+        now = time.time()
+        with self._lock:
+            def rank(name):
+                stats = self.stats[name]
+                # Con pocas muestras la tasa de error no es significativa (1 fallo de 1 = 100%)
+                high_error_rate = (
+                    len(stats.outcomes) >= self.config["error_rate_min_samples"]
+                    and stats.error_rate() >= self.config["error_rate_threshold"]
+                )
+                cooling = now - stats.last_error_at < self.config["cooldown_s"] and (
+                    stats.consecutive_errors >= self.config["max_consecutive_errors"] or high_error_rate
+                )
+                return (cooling, self.order.index(name))
+            return sorted(self.order, key=rank)
+    
+    def hedge_delay(self, name: str) -> float:
+        """Segundos a esperar antes de lanzar la petición de respaldo (p95 del proveedor)"""
+        with self._lock:
+            stats = self.stats[name]
+            if len(stats.latencies) >= self.config["hedge_min_samples"]:
+                return stats.percentile(0.95)
+        return self.config["hedge_default_ms"] / 1000
+    
+    def complete(self, system: str, prompt: str, temperature: float = 0.7, max_tokens: int = 4000) -> Tuple[str, str]:
+        """Texto de la primera respuesta válida y el proveedor que la dio
+        
+        Lanza RuntimeError si ningún proveedor responde.
+        """
+        candidates = self.ranked()
+        if not candidates:
+            raise RuntimeError("No hay proveedores de IA configurados")
+        
+        request = (system, prompt, temperature, max_tokens)
+        if self.config["hedging"] and len(candidates) > 1:
+            return self._complete_hedged(candidates, request)
+        
+        errors = []
+        for name in candidates:
+            try:
+                return self._call(name, request), name
+            except Exception as e:
+                logger.warning(f"Proveedor de IA {name} falló, se prueba el siguiente: {e}")
+                errors.append(f"{name}: {e}")
+        raise RuntimeError(f"Todos los proveedores de IA fallaron ({'; '.join(errors)})")
+    
+    def _complete_hedged(self, candidates: list, request: tuple) -> Tuple[str, str]:
+        executor = self._get_executor()
+        pending = {}
+        errors = []
+        queue = list(candidates)
+        
+        def launch():
+            name = queue.pop(0)
+            pending[executor.submit(self._call, name, request)] = name
+        
+        launch()
+        while pending:
+            # Mientras queden respaldos, se espera como mucho el p95 del más antiguo en curso
+            delay = self.hedge_delay(next(iter(pending.values()))) if queue else None
+            done, _ = wait(list(pending), timeout=delay, return_when=FIRST_COMPLETED)
+            
+            if not done:
+                logger.info(f"Sin respuesta tras {delay:.1f} s, petición de respaldo a {queue[0]}")
+                launch()
+                continue
+            
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    return future.result(), name
+                except Exception as e:
+                    logger.warning(f"Proveedor de IA {name} falló: {e}")
+                    errors.append(f"{name}: {e}")
+            
+            if not pending and queue:
+                launch()
+        
+        raise RuntimeError(f"Todos los proveedores de IA fallaron ({'; '.join(errors)})")
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(2, len(self.order) * 2), thread_name_prefix="ai-provider")
+            return self._executor
+    
+    def _call(self, name: str, request: tuple) -> str:
+        """Una petición a un proveedor, con su timeout, registrando latencia o error"""
+        system, prompt, temperature, max_tokens = request
+        client = self.clients[name]
+        model = self.config["models"][name]
+        timeout = self.config["timeouts_s"].get(name, 30.0)
+        
+        start = time.perf_counter()
+        try:
+            if name == "anthropic":
+                response = client.messages.create(
+                    model=model,
+                    system=system,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=timeout
+                )
+                text = "".join(getattr(block, "text", "") for block in response.content)
+            else:
+                response = client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": system},
+                        {"role": "user", "content": prompt}
+                    ],
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=1,
+                    stream=False,
+                    timeout=timeout
+                )
+                text = response.choices[0].message.content
+            if not text:
+                raise ValueError("respuesta vacía")
+        except Exception as e:
+            with self._lock:
+                self.stats[name].record(time.perf_counter() - start, e)
+            raise
+        
+        with self._lock:
+            self.stats[name].record(time.perf_counter() - start)
+        return text
+    
+    def status(self) -> dict:
+        """Estadísticas por proveedor para el panel de salud"""
+        with self._lock:
+            return {
+                "order": list(self.order),
+                "hedging": self.config["hedging"],
+                "providers": {
+                    name: {
+                        "requests": stats.requests,
+                        "errors": stats.errors,
+                        "error_rate": round(stats.error_rate() * 100, 1),
+                        "p50_ms": round(stats.percentile(0.5) * 1000, 1) if stats.latencies else None,
+                        "p95_ms": round(stats.percentile(0.95) * 1000, 1) if stats.latencies else None,
+                        "last_error": stats.last_error
+                    }
+                    for name, stats in self.stats.items()
+                }
+            }
+
+
 class AIDiagnosticSystem:
     """Sistema de IA para diagnóstico de biodescodificación"""
     
-    def __init__(self):
+    def __init__(self, db: "DatabaseManager" = None):
         self.config = ConfigManager()
+        self.db = db or DatabaseManager()
         self.groq_client = None
         self.openai_client = None
         self.anthropic_client = None
         
+        # Respuestas del LLM ya obtenidas para el mismo perfil de síntomas
+        performance = self.config.performance_config
+        self.cache = DiagnosisCache(
+            os.path.join("data", "diagnosis_cache"),
+            performance["diagnosis_cache_size"],
+            performance["diagnosis_cache_ttl_hours"]
+        )
+        
+        # Hilos para la consulta al LLM, que se solapa con los análisis locales
+        self._pipeline = ThreadPoolExecutor(max_workers=8, thread_name_prefix="diagnosis")
+        self.stage_timings = {}
+        self._timings_lock = threading.Lock()
+        
         # Inicializar clientes de IA
         self._initialize_clients()
         
@@ -1113,32 +3774,47 @@ class AIDiagnosticSystem:
                 
         except Exception as e:
             logger.error(f"Error inicializando clientes de IA: {e}")
+        
+        self.router = ProviderRouter(
+            {"groq": self.groq_client, "openai": self.openai_client, "anthropic": self.anthropic_client},
+            self.config.ai_routing_config
+        )
     
     def analyze_symptoms(self, symptoms_data: dict) -> dict:
         """Analiza síntomas y proporciona diagnóstico de biodescodificación"""
         try:
-            # Preparar prompt
-            prompt = self._create_diagnostic_prompt(symptoms_data)
+            timings = {}
+            total_start = time.perf_counter()
             
-            # Obtener diagnóstico de IA
-            diagnosis = self._get_ai_diagnosis(prompt)
+            # Diagnóstico de IA (o el ya obtenido para el mismo perfil) en segundo plano:
+            # los análisis locales no dependen de él y se calculan mientras tanto
+            ai_future = self._pipeline.submit(self._timed, timings, "ai_diagnosis", self._diagnose, symptoms_data)
             
-            # Enriquecer con conocimiento de biodescodificación
-            enriched_diagnosis = self._enrich_with_biodescodification(diagnosis, symptoms_data)
+            emotional_analysis = self._timed(timings, "emotional_analysis", self._analyze_emotions, symptoms_data)
+            physical_analysis = self._timed(timings, "physical_analysis", self._analyze_physical, symptoms_data)
             
-            # Generar plan de tratamiento
-            treatment_plan = self._generate_treatment_plan(enriched_diagnosis)
+            wait_start = time.perf_counter()
+            diagnosis = ai_future.result()
+            timings["ai_wait"] = (time.perf_counter() - wait_start) * 1000
+            
+            # Etapas que dependen del diagnóstico de IA
+            enriched_diagnosis = self._timed(timings, "enrichment", self._enrich_with_biodescodification, diagnosis, symptoms_data)
+            treatment_plan = self._timed(timings, "treatment_plan", self._generate_treatment_plan, enriched_diagnosis)
+            recommendations = self._timed(timings, "recommendations", self._generate_recommendations, enriched_diagnosis)
+            timings["total"] = (time.perf_counter() - total_start) * 1000
             
             # Crear reporte completo
             report = {
                 "diagnosis": enriched_diagnosis,
                 "treatment_plan": treatment_plan,
-                "emotional_analysis": self._analyze_emotions(symptoms_data),
-                "physical_analysis": self._analyze_physical(symptoms_data),
-                "recommendations": self._generate_recommendations(enriched_diagnosis),
+                "emotional_analysis": emotional_analysis,
+                "physical_analysis": physical_analysis,
+                "recommendations": recommendations,
+                "stage_timings_ms": {stage: round(ms, 1) for stage, ms in timings.items()},
                 "timestamp": datetime.now().isoformat(),
-                "session_id": f"DIAG_{int(time.time())}"
+                "session_id": ID_GENERATOR.new_id("DIAG")
             }
+            self._record_timings(timings)
             
             # Guardar en base de datos
             self._save_diagnosis_report(report)
@@ -1149,6 +3825,37 @@ class AIDiagnosticSystem:
             logger.error(f"Error en análisis de síntomas: {e}")
             return self._get_fallback_diagnosis(symptoms_data)
     
+    @staticmethod
+    def _timed(timings: dict, stage: str, func: Callable, *args):
+        """Ejecuta una etapa del diagnóstico anotando su duración en ms"""
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[stage] = (time.perf_counter() - start) * 1000
+    
+    def _record_timings(self, timings: dict):
+        with self._timings_lock:
+            for stage, ms in timings.items():
+                self.stage_timings.setdefault(stage, deque(maxlen=100)).append(ms)
+    
+    def pipeline_status(self) -> dict:
+        """Mediana y máximo en ms de cada etapa en los últimos diagnósticos"""
+        with self._timings_lock:
+            return {
+                stage: {
+                    "count": len(samples),
+                    "median_ms": round(sorted(samples)[len(samples) // 2], 1),
+                    "max_ms": round(max(samples), 1)
+                }
+                for stage, samples in self.stage_timings.items()
+            }
+    
+    def _diagnose(self, symptoms_data: dict) -> dict:
+        """Prompt y consulta al LLM (con caché) para un perfil de síntomas"""
+        prompt = self._create_diagnostic_prompt(symptoms_data)
+        return self._get_cached_diagnosis(symptoms_data, prompt)
+    
     def _create_diagnostic_prompt(self, symptoms_data: dict) -> str:
         """Crea prompt para diagnóstico"""
         prompt = f"""
@@ -1204,30 +3911,31 @@ class AIDiagnosticSystem:
         
         return prompt
     
-    def _get_ai_diagnosis(self, prompt: str) -> dict:
-        """Obtiene diagnóstico de IA usando Groq"""
+    def _get_cached_diagnosis(self, symptoms_data: dict, prompt: str) -> dict:
+        """Diagnóstico de la caché o, si no está, del LLM (solo se cachean respuestas reales)"""
+        key = DiagnosisCache.key_for(symptoms_data)
+        diagnosis = self.cache.get(key)
+        if diagnosis is not None:
+            return diagnosis
+        
+        diagnosis = self._query_ai(prompt)
+        if diagnosis is None:
+            return self._fallback_ai_diagnosis()
+        
+        self.cache.put(key, diagnosis)
+        return diagnosis
+    
+    def _query_ai(self, prompt: str) -> Optional[dict]:
+        """Consulta al LLM a través del router de proveedores; None si ninguno responde"""
         try:
-            if self.groq_client:
-                response = self.groq_client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Eres un experto en biodescodificación emocional. Proporciona diagnósticos precisos y recomendaciones prácticas."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    model="mixtral-8x7b-32768",
+            if self.router.available():
+                content, provider = self.router.complete(
+                    "Eres un experto en biodescodificación emocional. Proporciona diagnósticos precisos y recomendaciones prácticas.",
+                    prompt,
                     temperature=0.7,
-                    max_tokens=4000,
-                    top_p=1,
-                    stream=False
+                    max_tokens=4000
                 )
-                
-                # Parsear respuesta JSON
-                content = response.choices[0].message.content
+                logger.info(f"Diagnóstico obtenido de {provider}")
                 
                 # Intentar extraer JSON si está presente
                 json_match = re.search(r'\{.*\}', content, re.DOTALL)
@@ -1244,7 +3952,11 @@ class AIDiagnosticSystem:
         except Exception as e:
             logger.error(f"Error obteniendo diagnóstico de IA: {e}")
         
-        # Fallback
+        return None
+    
+    @staticmethod
+    def _fallback_ai_diagnosis() -> dict:
+        """Diagnóstico genérico cuando el LLM no está disponible"""
         return {
             "analysis": "Análisis no disponible temporalmente",
             "conflict": "Por determinar",
@@ -1508,21 +4220,18 @@ class AIDiagnosticSystem:
     def _save_diagnosis_report(self, report: dict):
         """Guarda el reporte de diagnóstico"""
         try:
-            db = DatabaseManager()
-            diagnostics = db.load_diagnostics()
+            db = self.db
             
-            session_id = report.get("session_id", f"DIAG_{int(time.time())}")
-            diagnostics[session_id] = report
-            
-            db.save_diagnostics(diagnostics)
+            session_id = report.get("session_id") or ID_GENERATOR.new_id("DIAG")
+            db.storage.put("diagnostics", session_id, report)
             
             # También guardar en ChromaDB si está disponible
-            if hasattr(db, 'diagnostics_collection') and db.diagnostics_collection:
-                db.diagnostics_collection.add(
-                    documents=[json.dumps(report, ensure_ascii=False)],
-                    metadatas=[{"type": "diagnosis", "timestamp": report["timestamp"]}],
-                    ids=[session_id]
-                )
+            db.vectors.add(
+                "diagnostics",
+                session_id,
+                json.dumps(report, ensure_ascii=False),
+                {"type": "diagnosis", "timestamp": report["timestamp"]}
+            )
                 
         except Exception as e:
             logger.error(f"Error guardando diagnóstico: {e}")
@@ -1547,70 +4256,232 @@ class AIDiagnosticSystem:
             "timestamp": datetime.now().isoformat()
         }
 
+class DiagnosisJobQueue:
+    """Diagnósticos ejecutados en segundo plano por un pool de hilos
+    
+    submit() devuelve un id de trabajo al instante; la página consulta el
+    estado con get(). Cada trabajo se guarda en data/diagnosis_jobs/<id>.json
+    al cambiar de estado, así que una sesión que se reconecta (o el propio
+    proceso tras reiniciarse) puede recoger el resultado o retomar el trabajo.
+    """
+    
+    JOB_ID_PATTERN = re.compile(r"JOB_[A-Za-z0-9]+")
+    
+    # Como mucho un barrido de trabajos caducados cada tantos segundos
+    SWEEP_INTERVAL = 300
+    
+    def __init__(self, ai_system: AIDiagnosticSystem, directory: str, workers: int = 2, retention_hours: float = 24):
+        self.ai_system = ai_system
+        self.directory = directory
+        self.retention_seconds = retention_hours * 3600
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="diagnosis-job")
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+    
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+    
+    def submit(self, symptoms_data: dict) -> str:
+        """Encola un diagnóstico y devuelve su id"""
+        job = {
+            "id": ID_GENERATOR.new_id("JOB"),
+            "status": "queued",
+            "data": symptoms_data,
+            "result": None,
+            "error": None,
+            "submitted_at": time.time(),
+            "finished_at": None
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+        self._save(job)
+        self._executor.submit(self._run, job["id"])
+        self._sweep()
+        return job["id"]
+    
+    def get(self, job_id: str) -> Optional[dict]:
+        """Estado del trabajo (copia), de memoria o del disco; None si no existe"""
+        if not job_id or not self.JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return copy.deepcopy(job)
+        
+        path = self._path(job_id)
+        job = self._read(path)
+        if job is not None and self._expired(job, time.time()):
+            self._remove(path)
+            return None
+        return job
+    
+    def _expired(self, job: dict, now: float) -> bool:
+        return now - job.get("submitted_at", 0) > self.retention_seconds
+    
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo borrar el trabajo caducado {path}: {e}")
+    
+    def _run(self, job_id: str):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = "running"
+            job["started_at"] = time.time()
+        self._save(job)
+        
+        try:
+            result = self.ai_system.analyze_symptoms(job["data"])
+            with self._lock:
+                job.update(status="done", result=result)
+        except Exception as e:
+            logger.error(f"Error en el trabajo de diagnóstico {job_id}: {e}")
+            with self._lock:
+                job.update(status="error", error=str(e))
+        
+        with self._lock:
+            job["finished_at"] = time.time()
+        self._save(job)
+        
+        # El resultado queda en disco; en memoria solo se conservan los trabajos pendientes
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        self._sweep()
+    
+    def _save(self, job: dict):
+        path = self._path(job["id"])
+        with self._lock:
+            content = json.dumps(job, ensure_ascii=False, default=str)
+        try:
+            with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.error(f"Error guardando el trabajo de diagnóstico {job['id']}: {e}")
+    
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            # Acepta cualquier formato de archivo de datos, no solo JSON
+            return read_data_file(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Trabajo de diagnóstico ilegible {path}: {e}")
+            return None
+    
+    def _stored_jobs(self):
+        """(ruta, trabajo) de los archivos del directorio; los ilegibles se registran y se omiten"""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            job = self._read(path)
+            if job is None:
+                logger.error(f"Trabajo de diagnóstico {name} ilegible: no se puede retomar ni caducar")
+                continue
+            yield path, job
+    
+    def _sweep(self, force: bool = False):
+        """Borra del disco los trabajos terminados que superan el tiempo de conservación"""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < self.SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            pending = set(self._jobs)
+        
+        try:
+            for path, job in self._stored_jobs():
+                if job.get("id") not in pending and self._expired(job, now):
+                    self._remove(path)
+        except Exception as e:
+            logger.warning(f"Error barriendo trabajos de diagnóstico caducados: {e}")
+    
+    def _recover(self):
+        """Borra los trabajos caducados y vuelve a encolar los que quedaron a medias"""
+        now = time.time()
+        self._last_sweep = now
+        for path, job in self._stored_jobs():
+            if self._expired(job, now):
+                self._remove(path)
+            elif job.get("status") in ("queued", "running"):
+                logger.info(f"Retomando el trabajo de diagnóstico {job['id']}")
+                job["status"] = "queued"
+                with self._lock:
+                    self._jobs[job["id"]] = job
+                self._executor.submit(self._run, job["id"])
+    
+    def stats(self) -> dict:
+        """Trabajos pendientes en este proceso"""
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {"queued": statuses.count("queued"), "running": statuses.count("running")}
+
 # ============================================
 # PARTE 7: SISTEMA DE HIPNOSIS Y MEDITACIONES
 # ============================================
 
+# Contenido estático de la aplicación: fuera de data/, que solo guarda los almacenes
+SESSION_CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "session_catalog.json")
+
+_SESSION_CATALOGS = {}
+_SESSION_CATALOG_LOCK = threading.Lock()
+
+
+def _freeze(value):
+    """Versión de solo lectura de un valor JSON (diccionarios y listas anidados)"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def load_session_catalog(path: str = SESSION_CATALOG_FILE):
+    """Catálogo de sesiones (títulos, duraciones, beneficios y guiones), leído una vez por proceso"""
+    with _SESSION_CATALOG_LOCK:
+        catalog = _SESSION_CATALOGS.get(path)
+        if catalog is None:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    catalog = _freeze(json.load(f))
+            except Exception as e:
+                logger.error(f"Error cargando catálogo de sesiones {path}: {e}")
+                return types.MappingProxyType({})
+            _SESSION_CATALOGS[path] = catalog
+        return catalog
+
+
 class HypnosisSystem:
     """Sistema de sesiones de hipnosis y meditación guiada"""
     
-    def __init__(self):
-        self.sessions_db = DatabaseManager()
-        self.ai_system = AIDiagnosticSystem()
+    def __init__(self, db: "DatabaseManager" = None, ai_system: AIDiagnosticSystem = None):
+        self.sessions_db = db or DatabaseManager()
+        self.ai_system = ai_system or AIDiagnosticSystem(self.sessions_db)
         
-        # Catálogo de sesiones
-        self.session_catalog = {
-            "relajacion_profunda": {
-                "title": "Relajación Profunda",
-                "duration": 20,
-                "description": "Relajación muscular progresiva y calma mental",
-                "benefits": ["Reducción de estrés", "Mejora del sueño", "Calma mental"],
-                "audio_file": None,
-                "script": self._get_relaxation_script()
-            },
-            "liberacion_emocional": {
-                "title": "Liberación Emocional",
-                "duration": 25,
-                "description": "Libera emociones bloqueadas y sana heridas emocionales",
-                "benefits": ["Liberación emocional", "Sanación interior", "Renovación energética"],
-                "script": self._get_emotional_release_script()
-            },
-            "autoestima_confianza": {
-                "title": "Autoestima y Confianza",
-                "duration": 22,
-                "description": "Refuerza tu autoestima y desarrolla confianza en ti mismo",
-                "benefits": ["Autoaceptación", "Confianza personal", "Empoderamiento"],
-                "script": self._get_self_esteem_script()
-            },
-            "manejo_ansiedad": {
-                "title": "Manejo de Ansiedad",
-                "duration": 18,
-                "description": "Técnicas para reducir la ansiedad y encontrar tranquilidad",
-                "benefits": ["Reducción de ansiedad", "Control emocional", "Paz interior"],
-                "script": self._get_anxiety_script()
-            },
-            "sanacion_interior": {
-                "title": "Sanación Interior",
-                "duration": 30,
-                "description": "Proceso de sanación profunda a nivel emocional y espiritual",
-                "benefits": ["Sanación emocional", "Reconciliación interior", "Renovación"],
-                "script": self._get_healing_script()
-            },
-            "conexion_mindfulness": {
-                "title": "Conexión Mindfulness",
-                "duration": 15,
-                "description": "Práctica de mindfulness para el aquí y el ahora",
-                "benefits": ["Presencia mental", "Claridad", "Reducción de estrés"],
-                "script": self._get_mindfulness_script()
-            }
-        }
+        # Catálogo de sesiones (compartido e inmutable, leído una sola vez)
+        self.session_catalog = load_session_catalog()
     
     def get_session(self, session_type: str, user_data: dict = None) -> dict:
         """Obtiene una sesión personalizada"""
+        if not self.session_catalog:
+            # Un catálogo que no se pudo leer en el constructor se reintenta antes de fallar
+            self.session_catalog = load_session_catalog()
+            if not self.session_catalog:
+                raise RuntimeError(f"El catálogo de sesiones no está disponible ({SESSION_CATALOG_FILE})")
+        
         if session_type not in self.session_catalog:
-            session_type = "relajacion_profunda"
+            session_type = "relajacion_profunda" if "relajacion_profunda" in self.session_catalog else next(iter(self.session_catalog))
         
-        base_session = self.session_catalog[session_type].copy()
+        # Copia superficial: el guion y los beneficios se comparten con el catálogo
+        base_session = dict(self.session_catalog[session_type])
         
         # Personalizar si hay datos del usuario
         if user_data:
@@ -1622,7 +4493,7 @@ class HypnosisSystem:
         base_session["audio_available"] = self._generate_audio_session(base_session)
         
         # Crear ID de sesión
-        base_session["session_id"] = f"SESS_{int(time.time())}_{random.randint(1000, 9999)}"
+        base_session["session_id"] = ID_GENERATOR.new_id("SESS")
         base_session["start_time"] = datetime.now().isoformat()
         
         return base_session
@@ -1693,191 +4564,6 @@ class HypnosisSystem:
         # Por ahora, solo marcamos que el audio está "disponible"
         return True
     
-    def _get_relaxation_script(self) -> str:
-        """Script para relajación profunda"""
-        return """
-        [NOMBRE], bienvenido a esta sesión de relajación profunda.
-        
-        Encuentra una posición cómoda, ya sea sentado o acostado.
-        Cierra suavemente los ojos y permite que tu cuerpo se asiente.
-        
-        Comienza llevando tu atención a tu respiración...
-        Inhalando profundamente... y exhalando lentamente...
-        
-        Vamos a relajar cada parte de tu cuerpo, comenzando por los pies...
-        Siente cómo la tensión se disuelve... los músculos se sueltan...
-        
-        Subiendo a las piernas... dejando ir cualquier esfuerzo...
-        Las caderas... la pelvis... completamente relajadas...
-        
-        El abdomen... suave y tranquilo...
-        El pecho... expandiéndose con cada respiración...
-        
-        Los hombros... liberando el peso del día...
-        Los brazos... pesados y relajados...
-        Las manos... sueltas y abiertas...
-        
-        El cuello... libre de tensión...
-        El rostro... todos los músculos faciales relajados...
-        La mandíbula... suelta...
-        Los ojos... en descanso profundo...
-        
-        Tu mente se calma... los pensamientos se aquietan...
-        Estás en un estado de paz profunda...
-        
-        Permanece en este estado de relajación durante unos minutos...
-        Disfruta de esta calma interior...
-        
-        Cuando estés listo, comienza a volver lentamente...
-        Mueve suavemente los dedos de las manos y pies...
-        Estira el cuerpo con suavidad...
-        Y abre los ojos cuando te sientas preparado...
-        
-        Te sientes renovado, tranquilo y en paz.
-        """
-    
-    def _get_emotional_release_script(self) -> str:
-        """Script para liberación emocional"""
-        return """
-        [NOMBRE], esta sesión te guiará en la liberación de emociones almacenadas.
-        
-        Conéctate con tu respiración... profunda y consciente...
-        Permite que surja cualquier emoción que necesite ser liberada...
-        
-        Visualiza un lugar seguro en tu interior...
-        Un espacio de aceptación y compasión...
-        
-        Si hay tristeza, permítela fluir como un río que limpia...
-        Si hay ira, transfórmala en energía creativa...
-        Si hay miedo, envuélvelo en luz amorosa...
-        
-        Cada emoción tiene un mensaje... escúchalo con amor...
-        Luego, libérala con gratitud por su enseñanza...
-        
-        Siente cómo tu corazón se hace más ligero...
-        Cómo el espacio interior se expande...
-        
-        Eres más que tus emociones... eres la conciencia que las observa...
-        Desde esta conciencia, elige paz... elige amor... elige libertad...
-        
-        Permanece en este estado de liberación...
-        """
-    
-    def _get_self_esteem_script(self) -> str:
-        """Script para autoestima y confianza"""
-        return """
-        [NOMBRE], en esta sesión fortalecerás tu autoestima y confianza.
-        
-        Comienza recordando tus cualidades únicas...
-        Tus fortalezas... tus talentos... tu esencia...
-        
-        Repite en tu mente: "Me acepto completamente"
-        "Me respeto y me valoro"
-        "Confío en mi sabiduría interior"
-        
-        Visualiza una versión de ti mismo llena de confianza...
-        Cómo se mueve... cómo habla... cómo se relaciona...
-        Conecta con esa energía de seguridad interior...
-        
-        Siente cómo esta confianza se integra en cada célula...
-        Cómo transforma tu postura... tu mirada... tu presencia...
-        
-        Eres digno de amor... digno de respeto... digno de éxito...
-        Tu valor es inherente... no depende de logros externos...
-        
-        Desde este lugar de autoestima, tomas decisiones alineadas...
-        Te expresas auténticamente... estableces límites sanos...
-        
-        Esta confianza crece cada día... fortaleciéndote interiormente...
-        """
-    
-    def _get_anxiety_script(self) -> str:
-        """Script para manejo de ansiedad"""
-        return """
-        [NOMBRE], esta sesión te ayudará a calmar la ansiedad.
-        
-        Primero, conecta con el momento presente...
-        Nota 5 cosas que puedes ver...
-        4 cosas que puedes tocar...
-        3 cosas que puedes oír...
-        2 cosas que puedes oler...
-        1 cosa que puedes saborear...
-        
-        Ahora lleva la atención a tu cuerpo...
-        ¿Dónde sientes la ansiedad?...
-        Respira hacia esa zona... suavizando... liberando...
-        
-        Visualiza la ansiedad como una nube que pasa...
-        Tú eres el cielo despejado... vasto y tranquilo...
-        Las nubes vienen y van... el cielo permanece...
-        
-        Con cada exhalación, suelta preocupaciones...
-        Con cada inhalación, aceptas calma...
-        
-        Recuerda: este momento es seguro...
-        Tienes los recursos para manejarlo...
-        La ansiedad es una señal, no una sentencia...
-        
-        Poco a poco, la calma se establece...
-        La claridad regresa... la paz se restaura...
-        """
-    
-    def _get_healing_script(self) -> str:
-        """Script para sanación interior"""
-        return """
-        [NOMBRE], bienvenido a este espacio de sanación profunda.
-        
-        Conéctate con tu cuerpo sabio... ese que siempre busca equilibrio...
-        Escucha sus mensajes... honra su sabiduría...
-        
-        Visualiza una luz sanadora entrando por la coronilla...
-        Una luz dorada, llena de amor y compasión...
-        Fluye por tu cabeza... tu cuello... tus hombros...
-        
-        Llega a tu pecho... a tu corazón...
-        Disuelve viejas heridas... sana memorias dolorosas...
-        Tu corazón se abre... se expande... se renueva...
-        
-        La luz continúa hacia tu abdomen... liberando miedos...
-        Hacia tus piernas... arraigándote en fortaleza...
-        Hacia tus pies... conectándote con la tierra...
-        
-        Cada célula de tu cuerpo se baña en esta luz sanadora...
-        Se regenera... se revitaliza... se armoniza...
-        
-        Eres un ser completo... sanado... renovado...
-        Tu esencia es perfecta salud... perfecta armonía...
-        
-        Permanece en esta frecuencia de sanación...
-        Permite que se integre profundamente...
-        """
-    
-    def _get_mindfulness_script(self) -> str:
-        """Script para mindfulness"""
-        return """
-        [NOMBRE], practiquemos mindfulness juntos.
-        
-        Simplemente observa... sin juzgar... sin aferrarte...
-        Observa tu respiración... el aire entra... el aire sale...
-        
-        Observa los sonidos... lejos... cerca... sin etiquetarlos...
-        Observa las sensaciones en tu cuerpo... cambiantes... momentáneas...
-        
-        Cuando la mente divague, vuelve amablemente al ahora...
-        Al sonido... a la respiración... a la sensación presente...
-        
-        No hay dónde llegar... no hay nada que conseguir...
-        Solo este momento... solo esta experiencia...
-        
-        En este espacio de presencia, encuentras paz...
-        Encuentras claridad... encuentras tu centro...
-        
-        El mindfulness es regresar a casa... a tu verdadero ser...
-        Una y otra vez... con paciencia... con compasión...
-        
-        Permanece aquí... en el ahora... en la presencia...
-        """
-    
     def start_session(self, session_type: str, user_id: str = None) -> dict:
         """Inicia una sesión y la registra"""
         session = self.get_session(session_type)
@@ -1892,7 +4578,6 @@ class HypnosisSystem:
         """Registra la sesión en la base de datos"""
         try:
             db = self.sessions_db
-            sessions = db.load_sessions()
             
             session_record = {
                 "session_id": session["session_id"],
@@ -1905,23 +4590,15 @@ class HypnosisSystem:
                 "completed": True
             }
             
-            if user_id not in sessions:
-                sessions[user_id] = []
-            
-            sessions[user_id].append(session_record)
+            user_sessions = db.storage.get("sessions", user_id, [])
+            user_sessions.append(session_record)
             
             # Limitar historial a 50 sesiones por usuario
-            if len(sessions[user_id]) > 50:
-                sessions[user_id] = sessions[user_id][-50:]
-            
-            db.save_sessions(sessions)
+            db.storage.put("sessions", user_id, user_sessions[-50:])
             
-            # Actualizar contador en usuarios
-            users = db.load_users()
-            if user_id in users:
-                users[user_id]["sessions_count"] = users[user_id].get("sessions_count", 0) + 1
-                users[user_id]["last_session"] = session["start_time"]
-                db.save_users(users)
+            # Actualizar contador en usuarios (escritura diferida; se omite si el usuario no existe)
+            db.counters.increment("users", user_id, "sessions_count")
+            db.counters.set("users", user_id, "last_session", session["start_time"])
             
         except Exception as e:
             logger.error(f"Error registrando sesión: {e}")
@@ -1933,78 +4610,154 @@ class HypnosisSystem:
 class PDFGenerator:
     """Generador de reportes PDF profesionales"""
     
+    # Recursos compartidos por todas las instancias del proceso (estilos y flowables fijos)
+    _resources = None
+    _lock = threading.Lock()
+    
+    FOOTER_TEXT = """
+        <font size="8">
+        <b>MINDGEEKCLINIC</b> - Sistema de Biodescodificación Integral<br/>
+        Email: promptandmente@gmail.com | Versión: 5.0<br/>
+        Este documento es confidencial. Generado automáticamente por el sistema.
+        </font>
+        """
+    
+    DISCLAIMER_TEXT = (
+        "<b>Nota importante:</b> Este diagnóstico es generado por inteligencia artificial "
+        "y debe ser complementado con evaluación profesional. Consulta a un médico o "
+        "terapeuta certificado para diagnóstico y tratamiento formal."
+    )
+    
     def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self._setup_custom_styles()
+        resources = PDFGenerator.shared_resources()
+        self.styles = resources["styles"]
+        self.info_table_style = resources["info_table_style"]
+        self._flowables = resources["flowables"]
+    
+    @classmethod
+    def shared_resources(cls) -> dict:
+        """Hoja de estilos, estilos de tabla y flowables fijos, construidos una vez por proceso"""
+        if cls._resources is None:
+            with cls._lock:
+                if cls._resources is None:
+                    cls._resources = cls._build_resources()
+        return cls._resources
+    
+    @classmethod
+    def clear_cache(cls):
+        """Descarta los recursos compartidos (se reconstruyen en el siguiente uso)"""
+        with cls._lock:
+            cls._resources = None
+    
+    @classmethod
+    def _build_resources(cls) -> dict:
+        styles = getSampleStyleSheet()
+        cls._setup_custom_styles(styles)
+        
+        info_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#3498DB')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#F8F9F9')),
+            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ])
+        
+        # El marcado de estos párrafos se analiza una sola vez
+        flowables = {
+            "report_title": Paragraph("REPORTE DE DIAGNÓSTICO", styles['MainTitle']),
+            "error_title": Paragraph("ERROR AL GENERAR REPORTE", styles['MainTitle']),
+            "disclaimer": Paragraph(cls.DISCLAIMER_TEXT, styles['Note']),
+            "footer": Paragraph(cls.FOOTER_TEXT, styles['Normal']),
+            "no_recommendations": Paragraph("No hay recomendaciones específicas.", styles['BodyText'])
+        }
+        
+        return {"styles": styles, "info_table_style": info_table_style, "flowables": flowables}
     
-    def _setup_custom_styles(self):
+    @staticmethod
+    def _setup_custom_styles(styles):
         """Configura estilos personalizados"""
+        def add_style(style):
+            # La hoja de ejemplo ya define algunos nombres (BodyText, Bullet): se sustituyen
+            if style.name in styles:
+                styles.byName[style.name] = style
+            else:
+                styles.add(style)
+        
         # Estilo para título principal
-        self.styles.add(ParagraphStyle(
+        add_style(ParagraphStyle(
             name='MainTitle',
-            parent=self.styles['Heading1'],
+            parent=styles['Heading1'],
             fontSize=24,
             textColor=colors.HexColor('#2E4053'),
             spaceAfter=30,
-            alignment=TA_CENTER
+            alignment=enums.TA_CENTER
         ))
         
         # Estilo para subtítulos
-        self.styles.add(ParagraphStyle(
+        add_style(ParagraphStyle(
             name='SubTitle',
-            parent=self.styles['Heading2'],
+            parent=styles['Heading2'],
             fontSize=16,
             textColor=colors.HexColor('#3498DB'),
             spaceAfter=15,
             spaceBefore=20
         ))
         
-        # Estilo para contenido
-def _setup_custom_styles(self):
-    """Configura estilos personalizados"""
-    # Verifica si el estilo ya existe antes de agregarlo
-    if 'CustomTitle' not in self.styles:
-        self.styles.add(ParagraphStyle(
+        add_style(ParagraphStyle(
             name='CustomTitle',
-            parent=self.styles['Heading1'],
+            parent=styles['Heading1'],
             fontSize=24,
             textColor=colors.HexColor('#2E86AB'),
             spaceAfter=30
         ))
-    
-    # 🔥 CAMBIA ESTA PARTE - VERIFICA SI BodyText YA EXISTE
-    if 'CustomHeading' not in self.styles:
-        self.styles.add(ParagraphStyle(
+        
+        add_style(ParagraphStyle(
             name='CustomHeading',
-            parent=self.styles['Heading2'],
+            parent=styles['Heading2'],
             fontSize=16,
             textColor=colors.HexColor('#A23B72'),
             spaceAfter=15
         ))
-    
-    # 🔥 ESTE ES EL CAMBIO CRÍTICO: verifica si 'BodyText' ya existe
-    if 'BodyText' not in self.styles:
-        self.styles.add(ParagraphStyle(
+        
+        # Estilo para contenido
+        add_style(ParagraphStyle(
             name='BodyText',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=11,
             leading=14,
             spaceAfter=12
         ))
-    else:
-        # Si ya existe, simplemente lo obtenemos
-        pass  # Ya existe, no necesitamos crearlo
         
         # Estilo para listas
-        self.styles.add(ParagraphStyle(
+        add_style(ParagraphStyle(
             name='Bullet',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=10,
             textColor=colors.HexColor('#2C3E50'),
             leftIndent=20,
             spaceAfter=8,
             bulletIndent=10
         ))
+        
+        # Estilo para la nota de aviso
+        add_style(ParagraphStyle(
+            name='Note',
+            parent=styles['Normal'],
+            fontSize=9,
+            textColor=colors.red,
+            backColor=colors.HexColor('#FDEDEC'),
+            borderPadding=10,
+            borderColor=colors.red,
+            borderWidth=1
+        ))
+    
+    def _static(self, name: str):
+        """Copia de un flowable fijo: comparte el marcado ya analizado, no el estado de maquetación"""
+        return copy.copy(self._flowables[name])
     
     def generate_diagnostic_report(self, diagnosis_data: dict, user_info: dict = None) -> BytesIO:
         """Genera reporte PDF de diagnóstico"""
@@ -2015,7 +4768,7 @@ def _setup_custom_styles(self):
             # Crear documento
             doc = SimpleDocTemplate(
                 buffer,
-                pagesize=A4,
+                pagesize=pagesizes.A4,
                 rightMargin=72,
                 leftMargin=72,
                 topMargin=72,
@@ -2030,7 +4783,7 @@ def _setup_custom_styles(self):
             story.append(Spacer(1, 20))
             
             # 2. Título
-            story.append(Paragraph("REPORTE DE DIAGNÓSTICO", self.styles['MainTitle']))
+            story.append(self._static("report_title"))
             story.append(Spacer(1, 10))
             
             # 3. Información básica
@@ -2038,19 +4791,19 @@ def _setup_custom_styles(self):
             story.append(Spacer(1, 20))
             
             # 4. Análisis emocional
-            story.append(self._create_emotional_analysis(diagnosis_data))
+            story.extend(self._create_emotional_analysis(diagnosis_data))
             story.append(Spacer(1, 20))
             
             # 5. Diagnóstico de biodescodificación
-            story.append(self._create_biodescodification_diagnosis(diagnosis_data))
+            story.extend(self._create_biodescodification_diagnosis(diagnosis_data))
             story.append(Spacer(1, 20))
             
             # 6. Plan de tratamiento
-            story.append(self._create_treatment_plan(diagnosis_data))
+            story.extend(self._create_treatment_plan(diagnosis_data))
             story.append(Spacer(1, 20))
             
             # 7. Recomendaciones
-            story.append(self._create_recommendations(diagnosis_data))
+            story.extend(self._create_recommendations(diagnosis_data))
             story.append(Spacer(1, 20))
             
             # 8. Pie de página
@@ -2101,17 +4854,7 @@ def _setup_custom_styles(self):
                 data.append(["Género", user_info['gender']])
         
         table = Table(data, colWidths=[200, 200])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#3498DB')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#F8F9F9')),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ]))
+        table.setStyle(self.info_table_style)
         
         return table
     
@@ -2246,39 +4989,17 @@ def _setup_custom_styles(self):
             for i, rec in enumerate(recommendations[:10], 1):
                 story.append(Paragraph(f"{i}. {rec}", self.styles['BodyText']))
         else:
-            story.append(Paragraph("No hay recomendaciones específicas.", self.styles['BodyText']))
+            story.append(self._static("no_recommendations"))
         
         # Nota importante
         story.append(Spacer(1, 20))
-        story.append(Paragraph(
-            "<b>Nota importante:</b> Este diagnóstico es generado por inteligencia artificial "
-            "y debe ser complementado con evaluación profesional. Consulta a un médico o "
-            "terapeuta certificado para diagnóstico y tratamiento formal.",
-            ParagraphStyle(
-                name='Note',
-                parent=self.styles['Normal'],
-                fontSize=9,
-                textColor=colors.red,
-                backColor=colors.HexColor('#FDEDEC'),
-                borderPadding=10,
-                borderColor=colors.red,
-                borderWidth=1
-            )
-        ))
+        story.append(self._static("disclaimer"))
         
         return story
     
     def _create_footer(self) -> Paragraph:
         """Crea pie de página"""
-        footer_text = """
-        <font size="8">
-        <b>MINDGEEKCLINIC</b> - Sistema de Biodescodificación Integral<br/>
-        Email: promptandmente@gmail.com | Versión: 5.0<br/>
-        Este documento es confidencial. Generado automáticamente por el sistema.
-        </font>
-        """
-        
-        return Paragraph(footer_text, self.styles['Normal'])
+        return self._static("footer")
     
     def _generate_error_pdf(self) -> BytesIO:
         """Genera PDF de error"""
@@ -2286,7 +5007,7 @@ def _setup_custom_styles(self):
         
         doc = SimpleDocTemplate(
             buffer,
-            pagesize=A4,
+            pagesize=pagesizes.A4,
             rightMargin=72,
             leftMargin=72,
             topMargin=72,
@@ -2295,7 +5016,7 @@ def _setup_custom_styles(self):
         
         story = []
         
-        story.append(Paragraph("ERROR AL GENERAR REPORTE", self.styles['MainTitle']))
+        story.append(self._static("error_title"))
         story.append(Spacer(1, 20))
         
         story.append(Paragraph(
@@ -2316,22 +5037,20 @@ def _setup_custom_styles(self):
 class PaymentSystem:
     """Sistema de gestión de pagos y comisiones"""
     
-    def __init__(self):
-        self.db = DatabaseManager()
-        self.email_service = EmailService()
+    def __init__(self, db: "DatabaseManager" = None, email_service: EmailService = None):
+        self.db = db or DatabaseManager()
+        self.email_service = email_service or EmailService()
         self.config = ConfigManager()
     
     def process_payment_request(self, affiliate_id: str, amount: float) -> Tuple[bool, str, dict]:
         """Procesa solicitud de pago de un afiliado"""
         try:
             # Verificar afiliado
-            db = self.db.load_affiliates()
+            affiliate = self.db.get_affiliate(affiliate_id)
             
-            if affiliate_id not in db["affiliates"]:
+            if affiliate is None:
                 return False, "Afiliado no encontrado", {}
             
-            affiliate = db["affiliates"][affiliate_id]
-            
             # Verificar fondos disponibles
             available_funds = affiliate.get("pending_earnings", 0.0)
             
@@ -2351,8 +5070,7 @@ class PaymentSystem:
             affiliate["paid_earnings"] += amount
             affiliate["last_payment"] = datetime.now().isoformat()
             
-            db["affiliates"][affiliate_id] = affiliate
-            self.db.save_affiliates(db)
+            self.db.save_affiliate(affiliate)
             
             # Guardar pago en historial
             self._save_payment_to_history(payment_data)
@@ -2368,7 +5086,7 @@ class PaymentSystem:
     
     def _create_payment_record(self, affiliate_id: str, amount: float) -> dict:
         """Crea registro de pago"""
-        payment_id = f"PAY_{int(time.time())}_{random.randint(1000, 9999)}"
+        payment_id = ID_GENERATOR.new_id("PAY")
         
         return {
             "payment_id": payment_id,
@@ -2387,9 +5105,7 @@ class PaymentSystem:
     def _save_payment_to_history(self, payment_data: dict):
         """Guarda pago en historial"""
         try:
-            payments = self.db.load_payments()
-            payments.append(payment_data)
-            self.db.save_payments(payments)
+            self.db.append_payment(payment_data)
             
         except Exception as e:
             logger.error(f"Error guardando pago en historial: {e}")
@@ -2454,13 +5170,11 @@ class PaymentSystem:
     def get_affiliate_balance(self, affiliate_id: str) -> dict:
         """Obtiene balance de un afiliado"""
         try:
-            db = self.db.load_affiliates()
+            affiliate = self.db.get_affiliate(affiliate_id)
             
-            if affiliate_id not in db["affiliates"]:
+            if affiliate is None:
                 return {"error": "Afiliado no encontrado"}
             
-            affiliate = db["affiliates"][affiliate_id]
-            
             return {
                 "affiliate_id": affiliate_id,
                 "full_name": affiliate.get("full_name", ""),
@@ -2486,14 +5200,13 @@ class PaymentSystem:
 class AnalyticsSystem:
     """Sistema de análisis y estadísticas"""
     
-    def __init__(self):
-        self.db = DatabaseManager()
+    def __init__(self, db: "DatabaseManager" = None):
+        self.db = db or DatabaseManager()
     
     def get_dashboard_stats(self) -> dict:
         """Obtiene estadísticas para el dashboard"""
         try:
-            db = self.db.load_affiliates()
-            stats = db.get("statistics", {})
+            stats = self.db.storage.get("affiliates_meta", "statistics", {})
             
             # Calcular crecimiento mensual (simulado)
             today = datetime.now()
@@ -2505,13 +5218,9 @@ class AnalyticsSystem:
                 "conversions": random.randint(10, 50)
             }
             
-            # Obtener últimos pagos
-            payments = self.db.load_payments()
-            recent_payments = sorted(payments, key=lambda x: x.get('request_date', ''), reverse=True)[:5]
-            
-            # Obtener mejores afiliados
-            affiliates = list(db.get("affiliates", {}).values())
-            top_affiliates = sorted(affiliates, key=lambda x: x.get('total_commission', 0), reverse=True)[:5]
+            # Últimos pagos y mejores afiliados (instantáneas, sin recorrer los almacenes)
+            recent_payments = [dict(payment) for payment in self.db.snapshots.get("recent_payments")]
+            top_affiliates = [dict(affiliate) for affiliate in self.db.snapshots.get("top_affiliates")]
             
             return {
                 "overall_stats": {
@@ -2524,15 +5233,8 @@ class AnalyticsSystem:
                 },
                 "monthly_growth": monthly_growth,
                 "recent_payments": recent_payments,
-                "top_affiliates": [
-                    {
-                        "id": a.get("id"),
-                        "name": a.get("full_name", "N/A"),
-                        "earnings": a.get("total_commission", 0.0),
-                        "conversions": a.get("conversions_count", 0)
-                    }
-                    for a in top_affiliates
-                ]
+                "top_affiliates": top_affiliates,
+                "diagnoses_by_day": dict(self.db.snapshots.get("diagnoses_by_day"))
             }
             
         except Exception as e:
@@ -2542,7 +5244,7 @@ class AnalyticsSystem:
     def get_affiliate_performance(self, affiliate_id: str) -> dict:
         """Obtiene desempeño de un afiliado específico"""
         try:
-            db = self.db.load_affiliates()
+            db = self.db.load_affiliates(readonly=True)
             
             if affiliate_id not in db["affiliates"]:
                 return {"error": "Afiliado no encontrado"}
@@ -2606,8 +5308,7 @@ class AnalyticsSystem:
             disk = psutil.disk_usage('/')
             
             # Métricas de la aplicación
-            db = self.db.load_affiliates()
-            total_users = len(db.get("affiliates", {}))
+            total_users = self.db.storage.count("affiliates")
             
             # Último backup (simulado)
             last_backup = (datetime.now() - timedelta(hours=2)).isoformat()
@@ -2627,9 +5328,17 @@ class AnalyticsSystem:
                 },
                 "database": {
                     "last_backup": last_backup,
-                    "size_mb": round(os.path.getsize(self.db.affiliates_file) / 1024 / 1024, 2),
-                    "connected": True
+                    "size_mb": round(self.db.storage.size_bytes() / 1024 / 1024, 2),
+                    "connected": True,
+                    "read_cache": STORE_CACHE.stats(),
+                    "snapshots": self.db.snapshots.stats()
                 },
+                "diagnosis_cache": diagnosis_cache_status(),
+                "ai_providers": ai_providers_status(),
+                "diagnosis_pipeline": diagnosis_pipeline_status(),
+                "diagnosis_jobs": diagnosis_jobs_status(),
+                "lazy_modules": lazy_modules_status(),
+                "warmup": warmup_status(),
                 "services": {
                     "email": True,
                     "payments": True,
@@ -2646,6 +5355,381 @@ class AnalyticsSystem:
                 "app_metrics": {"total_users": 0}
             }
 
+# ============================================
+# EXPORTACIÓN DE DATOS
+# ============================================
+
+# Formatos de exportación: cada registro es una clave y su valor (JSON en csv/parquet,
+# ya que las filas de un almacén no comparten un esquema fijo)
+EXPORT_FORMATS = ("jsonl", "csv", "parquet")
+
+
+def _load_pyarrow():
+    """pyarrow solo se necesita para parquet"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow, pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("El formato parquet necesita pyarrow (pip install pyarrow)")
+
+
+def write_records(records, path: str, fmt: str, batch_size: int = 1000) -> int:
+    """Escribe pares (clave, valor) en streaming; devuelve cuántos se escribieron"""
+    count = 0
+    
+    if fmt == "jsonl":
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, value in records:
+                f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+                count += 1
+    
+    elif fmt == "csv":
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["key", "value"])
+            for key, value in records:
+                writer.writerow([key, json.dumps(value, ensure_ascii=False)])
+                count += 1
+    
+    elif fmt == "parquet":
+        pa, pq = _load_pyarrow()
+        schema = pa.schema([("key", pa.string()), ("value", pa.string())])
+        with pq.ParquetWriter(path, schema) as writer:
+            keys, values = [], []
+            for key, value in records:
+                keys.append(str(key))
+                values.append(json.dumps(value, ensure_ascii=False))
+                if len(keys) >= batch_size:
+                    writer.write_table(pa.table({"key": keys, "value": values}, schema=schema))
+                    count += len(keys)
+                    keys, values = [], []
+            if keys:
+                writer.write_table(pa.table({"key": keys, "value": values}, schema=schema))
+                count += len(keys)
+    
+    else:
+        raise ValueError(f"Formato no soportado: {fmt}")
+    
+    return count
+
+
+def read_records(path: str, fmt: str, batch_size: int = 1000):
+    """Lee en streaming los pares (clave, valor) escritos por write_records"""
+    if fmt == "jsonl":
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["key"], record["value"]
+    
+    elif fmt == "csv":
+        csv.field_size_limit(sys.maxsize)
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                yield row["key"], json.loads(row["value"])
+    
+    elif fmt == "parquet":
+        _, pq = _load_pyarrow()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            columns = batch.to_pydict()
+            for key, value in zip(columns["key"], columns["value"]):
+                yield key, json.loads(value)
+    
+    else:
+        raise ValueError(f"Formato no soportado: {fmt}")
+
+
+def with_progress(records, callback: Callable, every: int = 1000):
+    """Pasa los registros tal cual, avisando del total acumulado cada cierto número y al final"""
+    count = 0
+    for count, record in enumerate(records, 1):
+        if count % every == 0:
+            callback(count)
+        yield record
+    callback(count)
+
+
+class DataExporter:
+    """Exportaciones en streaming a archivos temporales para los botones de descarga
+    
+    Los registros se escriben por bloques conforme se leen del almacenamiento,
+    de modo que la memoria no depende del tamaño del almacén. Los archivos
+    contienen datos personales: van a un directorio propio del que se borran
+    los que superan max_age_minutes, al arrancar y en cada exportación nueva,
+    aunque la sesión que los generó ya no exista.
+    """
+    
+    MIME_TYPES = {
+        "jsonl": "application/x-ndjson",
+        "csv": "text/csv",
+        "parquet": "application/vnd.apache.parquet"
+    }
+    
+    def __init__(self, storage: StorageBackend, directory: str = None, max_age_minutes: float = 60):
+        self.storage = storage
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "mindgeekclinic_exports")
+        self.max_age_seconds = max_age_minutes * 60
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self.sweep()
+    
+    def _temp_path(self, prefix: str, fmt: str) -> str:
+        self.sweep()
+        fd, path = tempfile.mkstemp(prefix=f"mindgeekclinic_{prefix}_", suffix=f".{fmt}", dir=self.directory)
+        os.close(fd)
+        return path
+    
+    def sweep(self) -> int:
+        """Elimina las exportaciones más antiguas que max_age; devuelve cuántas se borraron"""
+        removed = 0
+        cutoff = time.time() - self.max_age_seconds
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    self.remove(entry.path)
+                    removed += 1
+        except OSError as e:
+            logger.warning(f"No se pudo revisar el directorio de exportaciones {self.directory}: {e}")
+        return removed
+    
+    def export_table(self, table: str, fmt: str, progress: Callable = None) -> Tuple[str, int]:
+        """Exporta una tabla; devuelve la ruta del archivo temporal y el número de registros"""
+        path = self._temp_path(table, fmt)
+        records = self.storage.iter_items(table)
+        if progress:
+            records = with_progress(records, progress)
+        
+        try:
+            return path, write_records(records, path, fmt)
+        except Exception:
+            self.remove(path)
+            raise
+    
+    def export_rows(self, rows, fieldnames: list, prefix: str = "export", progress: Callable = None) -> Tuple[str, int]:
+        """Exporta filas planas (diccionarios) a un CSV temporal"""
+        path = self._temp_path(prefix, "csv")
+        if progress:
+            rows = with_progress(rows, progress)
+        
+        count = 0
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return path, count
+    
+    def remove(self, path: str):
+        """Elimina un archivo de exportación ya servido"""
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar la exportación {path}: {e}")
+
+
+# ============================================
+# CONTENEDOR DE SERVICIOS
+# ============================================
+
+class ServiceContainer:
+    """Servicios compartidos por todas las sesiones, creados una sola vez y bajo demanda
+    
+    Ninguno de estos servicios guarda estado de sesión tras su constructor,
+    así que una misma instancia puede atender a todas las sesiones del proceso.
+    """
+    
+    def __init__(self):
+        self._services = {}
+        self._lock = threading.RLock()
+        self._factories = {
+            "db": DatabaseManager,
+            "email_service": EmailService,
+            "ai_system": lambda: AIDiagnosticSystem(self.db),
+            "diagnosis_jobs": lambda: DiagnosisJobQueue(
+                self.ai_system,
+                os.path.join("data", "diagnosis_jobs"),
+                ConfigManager().performance_config["diagnosis_workers"],
+                ConfigManager().performance_config["diagnosis_job_retention_hours"]
+            ),
+            "hypnosis_system": lambda: HypnosisSystem(self.db, self.ai_system),
+            "pdf_generator": PDFGenerator,
+            "payment_system": lambda: PaymentSystem(self.db, self.email_service),
+            "analytics": lambda: AnalyticsSystem(self.db),
+            "exporter": lambda: DataExporter(
+                self.db.storage,
+                max_age_minutes=ConfigManager().performance_config["export_retention_minutes"]
+            )
+        }
+    
+    def get(self, name: str):
+        """Devuelve el servicio, construyéndolo (con sus dependencias) la primera vez"""
+        service = self._services.get(name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(name)
+                if service is None:
+                    service = self._factories[name]()
+                    self._services[name] = service
+        return service
+    
+    def require(self, names) -> float:
+        """Construye los servicios indicados que aún no existan; devuelve los segundos empleados"""
+        start = time.perf_counter()
+        for name in names:
+            self.get(name)
+        return time.perf_counter() - start
+    
+    def created(self) -> list:
+        """Servicios ya construidos"""
+        return list(self._services)
+    
+    db = property(lambda self: self.get("db"))
+    email_service = property(lambda self: self.get("email_service"))
+    ai_system = property(lambda self: self.get("ai_system"))
+    diagnosis_jobs = property(lambda self: self.get("diagnosis_jobs"))
+    hypnosis_system = property(lambda self: self.get("hypnosis_system"))
+    pdf_generator = property(lambda self: self.get("pdf_generator"))
+    payment_system = property(lambda self: self.get("payment_system"))
+    analytics = property(lambda self: self.get("analytics"))
+    exporter = property(lambda self: self.get("exporter"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_services() -> ServiceContainer:
+    """Contenedor de servicios del proceso (cacheado por Streamlit entre reruns y sesiones)"""
+    return ServiceContainer()
+
+
+class WarmUp:
+    """Precarga en segundo plano de lo que pagaría el primer usuario tras un despliegue
+    
+    Cada paso se ejecuta una vez, en orden, en un hilo daemon; un fallo se
+    registra y no impide los siguientes. `ready` se activa al terminar todos.
+    """
+    
+    def __init__(self, services: ServiceContainer, preconnect: bool = False):
+        self.services = services
+        self.preconnect = preconnect
+        self.ready = threading.Event()
+        self.steps = {}
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+    
+    def start(self) -> "WarmUp":
+        if self._thread is None:
+            self.started_at = time.perf_counter()
+            self._thread = threading.Thread(target=self._run, name="mindgeekclinic-warmup", daemon=True)
+            self._thread.start()
+        return self
+    
+    def _run(self):
+        steps = [
+            ("stores", self._warm_stores),
+            ("snapshots", self._warm_snapshots),
+            ("session_catalog", load_session_catalog),
+            ("pdf_styles", PDFGenerator.shared_resources),
+            ("ai_clients", lambda: self.services.ai_system)
+        ]
+        if self.preconnect:
+            steps.append(("llm_preconnect", self._preconnect_llm))
+        
+        try:
+            for name, step in steps:
+                start = time.perf_counter()
+                try:
+                    step()
+                    self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+                except Exception as e:
+                    logger.warning(f"Precarga '{name}' fallida: {e}")
+                    self.steps[name] = f"error: {e}"
+        finally:
+            self.finished_at = time.perf_counter()
+            self.ready.set()
+            logger.info(f"Precarga completada en {(self.finished_at - self.started_at) * 1000:.0f} ms")
+    
+    def _warm_stores(self):
+        """Carga en la caché de lectura los almacenes calientes y sus índices"""
+        db = self.services.db
+        db.load_affiliates(readonly=True)
+        db.load_payments(readonly=True)
+        for index in SECONDARY_INDEXES:
+            db.storage.lookup(index, "")
+    
+    def _warm_snapshots(self):
+        """Carga (o actualiza) las instantáneas de las estructuras derivadas"""
+        for name in DERIVED_VIEWS:
+            self.services.db.snapshots.get(name)
+    
+    def _preconnect_llm(self):
+        """Abre la conexión TLS del cliente de Groq con una petición ligera (listado de modelos)
+        
+        La conexión queda en el pool del propio cliente, así que el primer
+        diagnóstico no paga DNS ni el handshake.
+        """
+        client = self.services.ai_system.groq_client
+        if client is None:
+            raise RuntimeError("cliente de Groq no configurado")
+        client.models.list()
+    
+    def status(self) -> dict:
+        """Estado para el panel de salud del sistema"""
+        end = self.finished_at or time.perf_counter()
+        return {
+            "enabled": True,
+            "ready": self.ready.is_set(),
+            "elapsed_ms": round((end - self.started_at) * 1000, 1) if self.started_at else None,
+            "steps": dict(self.steps)
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_warmup() -> WarmUp:
+    """Precarga del proceso, iniciada una sola vez"""
+    performance = ConfigManager().performance_config
+    return WarmUp(get_services(), preconnect=performance["preconnect_llm"]).start()
+
+
+def diagnosis_cache_status() -> dict:
+    """Estadísticas de la caché de diagnósticos, si el sistema de IA ya se construyó"""
+    services = get_services()
+    if "ai_system" not in services.created():
+        return {"entries": 0, "hit_rate": 0.0}
+    return services.ai_system.cache.stats()
+
+
+def ai_providers_status() -> dict:
+    """Latencia y errores por proveedor de IA, si el sistema de IA ya se construyó"""
+    services = get_services()
+    if "ai_system" not in services.created():
+        return {"order": [], "providers": {}}
+    return services.ai_system.router.status()
+
+
+def diagnosis_pipeline_status() -> dict:
+    """Tiempos por etapa de los últimos diagnósticos, si el sistema de IA ya se construyó"""
+    services = get_services()
+    if "ai_system" not in services.created():
+        return {}
+    return services.ai_system.pipeline_status()
+
+
+def diagnosis_jobs_status() -> dict:
+    """Trabajos de diagnóstico pendientes, si la cola ya se construyó"""
+    services = get_services()
+    if "diagnosis_jobs" not in services.created():
+        return {"queued": 0, "running": 0}
+    return services.diagnosis_jobs.stats()
+
+
+def warmup_status() -> dict:
+    """Estado de la precarga, o {"enabled": False} si está desactivada"""
+    if not ConfigManager().performance_config["warmup"]:
+        return {"enabled": False, "ready": True}
+    return get_warmup().status()
+
 # ============================================
 # PARTE 11: INTERFAZ DE USUARIO - COMPONENTES
 # ============================================
@@ -2788,15 +5872,56 @@ class UIComponents:
 class PageRenderer:
     """Renderizador de páginas principales"""
     
-    def __init__(self):
+    # Los servicios se piden al contenedor al usarse por primera vez: cada página
+    # solo construye lo que declara en PAGE_REGISTRY
+    db = property(lambda self: self.services.db)
+    ai_system = property(lambda self: self.services.ai_system)
+    diagnosis_jobs = property(lambda self: self.services.diagnosis_jobs)
+    hypnosis_system = property(lambda self: self.services.hypnosis_system)
+    pdf_generator = property(lambda self: self.services.pdf_generator)
+    payment_system = property(lambda self: self.services.payment_system)
+    analytics = property(lambda self: self.services.analytics)
+    email_service = property(lambda self: self.services.email_service)
+    exporter = property(lambda self: self.services.exporter)
+    
+    def __init__(self, services: "ServiceContainer" = None):
+        self.services = services or get_services()
         self.ui = UIComponents()
-        self.db = DatabaseManager()
-        self.ai_system = AIDiagnosticSystem()
-        self.hypnosis_system = HypnosisSystem()
-        self.pdf_generator = PDFGenerator()
-        self.payment_system = PaymentSystem()
-        self.analytics = AnalyticsSystem()
-        self.email_service = EmailService()
+    
+    def render_page(self, page: str):
+        """Inicializa las dependencias declaradas de la página y la renderiza"""
+        definition = PAGE_REGISTRY.get(page)
+        if definition is None:
+            logger.warning(f"Página desconocida: {page}")
+            return
+        
+        elapsed = self.services.require(definition["services"])
+        if elapsed > 0.05:
+            logger.info(f"Servicios de la página {page} inicializados en {elapsed * 1000:.0f} ms")
+        
+        getattr(self, definition["render"])()
+    
+    def _serve_export(self, state_key: str, label: str, file_name: str, mime: str):
+        """Botón de descarga para la última exportación generada (leída desde el archivo)"""
+        export = st.session_state.get(state_key)
+        if not export or not os.path.exists(export["path"]):
+            return
+        
+        with open(export["path"], "rb") as f:
+            st.download_button(
+                label=f"{label} ({export['count']:,} registros)",
+                data=f,
+                file_name=file_name,
+                mime=mime,
+                use_container_width=True
+            )
+    
+    def _store_export(self, state_key: str, path: str, count: int):
+        """Guarda la exportación en la sesión y elimina la anterior"""
+        previous = st.session_state.get(state_key)
+        if previous:
+            self.exporter.remove(previous["path"])
+        st.session_state[state_key] = {"path": path, "count": count}
     
     def render_home(self):
         """Renderiza página de inicio"""
@@ -2809,7 +5934,7 @@ class PageRenderer:
             if referral_code:
                 st.session_state.referral_code = referral_code
                 # Registrar visita de referido
-                self.db.add_referral(referral_code, f"guest_{int(time.time())}")
+                self.db.add_referral(referral_code, ID_GENERATOR.new_id("guest"))
                 st.sidebar.success(f"👋 ¡Bienvenido por referencia!")
         
         # Hero section
@@ -2929,6 +6054,11 @@ class PageRenderer:
             self._render_diagnostic_results()
             return
         
+        # Diagnóstico en segundo plano: de esta sesión o enlazado en la URL tras reconectar
+        job_id = st.session_state.get("diagnosis_job") or st.query_params.get("job")
+        if job_id and self._render_diagnosis_job(job_id):
+            return
+        
         # Formulario de diagnóstico
         with st.form("diagnostic_form"):
             st.subheader("📋 Información básica")
@@ -3051,26 +6181,10 @@ class PageRenderer:
                         "timestamp": datetime.now().isoformat()
                     }
                     
-                    # Guardar en sesión
-                    st.session_state.current_diagnostic = symptoms_data
-                    
-                    # Mostrar spinner mientras se genera diagnóstico
-                    with st.spinner("🔍 Analizando tu perfil emocional con IA..."):
-                        # Generar diagnóstico
-                        diagnosis = self.ai_system.analyze_symptoms(symptoms_data)
-                        st.session_state.current_diagnosis = diagnosis
-                        
-                        # Registrar en historial
-                        if 'diagnostic_history' not in st.session_state:
-                            st.session_state.diagnostic_history = []
-                        
-                        st.session_state.diagnostic_history.append({
-                            "data": symptoms_data,
-                            "diagnosis": diagnosis,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                    
-                    st.success("✅ Diagnóstico completado")
+                    # Encolar el diagnóstico: el análisis con IA no bloquea este script
+                    job_id = self.diagnosis_jobs.submit(symptoms_data)
+                    st.session_state.diagnosis_job = job_id
+                    st.query_params["job"] = job_id
                     st.rerun()
         
         # Botón para volver
@@ -3078,6 +6192,67 @@ class PageRenderer:
             st.session_state.page = "home"
             st.rerun()
     
+    def _render_diagnosis_job(self, job_id: str) -> bool:
+        """Muestra el estado de un diagnóstico en segundo plano; False si hay que mostrar el formulario"""
+        job = self.diagnosis_jobs.get(job_id)
+        
+        if job is None or job["status"] == "error":
+            self._clear_diagnosis_job()
+            if job is None:
+                st.warning("El diagnóstico solicitado no existe o ha caducado. Puedes generar uno nuevo.")
+            else:
+                st.error(f"No se pudo completar el diagnóstico: {job.get('error')}")
+            return False
+        
+        if job["status"] == "done":
+            symptoms_data = job["data"]
+            diagnosis = job["result"]
+            st.session_state.current_diagnostic = symptoms_data
+            st.session_state.current_diagnosis = diagnosis
+            
+            # Registrar en historial
+            if 'diagnostic_history' not in st.session_state:
+                st.session_state.diagnostic_history = []
+            
+            st.session_state.diagnostic_history.append({
+                "data": symptoms_data,
+                "diagnosis": diagnosis,
+                "timestamp": datetime.now().isoformat()
+            })
+            
+            self._clear_diagnosis_job()
+            st.success("✅ Diagnóstico completado")
+            st.rerun()
+            return True
+        
+        # En cola o en curso: solo el fragmento de estado se vuelve a ejecutar
+        # periódicamente; el script de la página termina y no espera a la IA
+        if st.button("✖️ Descartar y volver al formulario", type="secondary"):
+            self._clear_diagnosis_job()
+            st.rerun()
+        
+        poll_seconds = ConfigManager().performance_config["diagnosis_poll_seconds"]
+        st.fragment(self._render_diagnosis_job_status, run_every=poll_seconds)(job_id)
+        st.caption("Puedes salir de esta página: el resultado se guardará y aparecerá al volver.")
+        return True
+    
+    def _render_diagnosis_job_status(self, job_id: str):
+        """Estado de un diagnóstico pendiente (fragmento con refresco periódico)"""
+        job = self.diagnosis_jobs.get(job_id)
+        if job is None or job["status"] not in ("queued", "running"):
+            # Terminado, fallido o caducado: la página completa muestra el resultado
+            st.rerun()
+            return
+        
+        elapsed = time.time() - job.get("submitted_at", time.time())
+        st.info(f"🔍 Analizando tu perfil emocional con IA... ({elapsed:.0f} s)")
+    
+    def _clear_diagnosis_job(self):
+        """Olvida el diagnóstico en segundo plano de la sesión y de la URL"""
+        st.session_state.pop("diagnosis_job", None)
+        if "job" in st.query_params:
+            del st.query_params["job"]
+    
     def _render_diagnostic_results(self):
         """Renderiza resultados del diagnóstico"""
         if 'current_diagnosis' not in st.session_state:
@@ -3474,6 +6649,8 @@ class PageRenderer:
         st.subheader("🎧 Catálogo de Sesiones")
         
         session_catalog = self.hypnosis_system.session_catalog
+        if not session_catalog:
+            st.error("El catálogo de sesiones no está disponible en este momento")
         
         cols = st.columns(3)
         
@@ -3726,27 +6903,27 @@ class PageRenderer:
         st.divider()
         
         if st.button("📥 Exportar mis estadísticas (CSV)", use_container_width=True):
-            # Preparar datos para exportación
-            export_data = []
-            
-            for record in history:
-                export_data.append({
-                    'Fecha': record['timestamp'][:10],
-                    'Síntomas_Emocionales': ', '.join(record['data'].get('emotional_symptoms', [])),
-                    'Síntomas_Físicos': ', '.join(record['data'].get('physical_symptoms', [])),
-                    'Notas': record['data'].get('additional_info', '')
-                })
-            
-            df_export = pd.DataFrame(export_data)
-            csv = df_export.to_csv(index=False)
-            
-            st.download_button(
-                label="Descargar CSV",
-                data=csv,
-                file_name=f"estadisticas_mindgeekclinic_{datetime.now().strftime('%Y%m%d')}.csv",
-                mime="text/csv",
-                use_container_width=True
+            # Las filas se generan y escriben una a una en un archivo temporal
+            export_rows = ({
+                'Fecha': record['timestamp'][:10],
+                'Síntomas_Emocionales': ', '.join(record['data'].get('emotional_symptoms', [])),
+                'Síntomas_Físicos': ', '.join(record['data'].get('physical_symptoms', [])),
+                'Notas': record['data'].get('additional_info', '')
+            } for record in history)
+            
+            path, count = self.exporter.export_rows(
+                export_rows,
+                ['Fecha', 'Síntomas_Emocionales', 'Síntomas_Físicos', 'Notas'],
+                prefix="estadisticas"
             )
+            self._store_export("stats_export", path, count)
+        
+        self._serve_export(
+            "stats_export",
+            "Descargar CSV",
+            f"estadisticas_mindgeekclinic_{datetime.now().strftime('%Y%m%d')}.csv",
+            "text/csv"
+        )
     
     def render_chat(self):
         """Renderiza chat con IA"""
@@ -3799,74 +6976,86 @@ class PageRenderer:
                 st.chat_message("user").write(user_input)
             
             # Generar respuesta de IA
-            with st.spinner("El especialista está pensando..."):
-                try:
+            config = ConfigManager()
+            streaming = config.performance_config["chat_streaming"]
+            ai_response = None
+            displayed = False
+            
+            try:
+                if config.groq_api_key:
                     # Usar Groq para generar respuesta
-                    config = ConfigManager()
+                    groq_client = Groq(api_key=config.groq_api_key)
                     
-                    if config.groq_api_key:
-                        groq_client = Groq(api_key=config.groq_api_key)
-                        
-                        # Preparar contexto
-                        context = f"""
-                        Eres un especialista en biodescodificación emocional con 15 años de experiencia.
-                        Modo actual: {chat_mode}
-                        
-                        Responde a la siguiente pregunta del usuario:
-                        {user_input}
-                        
-                        Proporciona una respuesta útil, empática y basada en principios de biodescodificación.
-                        Si la pregunta requiere diagnóstico médico, recomienda consultar a un profesional.
-                        """
-                        
-                        response = groq_client.chat.completions.create(
-                            messages=[
-                                {
-                                    "role": "system",
-                                    "content": "Eres un experto en biodescodificación. Responde de forma clara, empática y profesional."
-                                },
-                                {
-                                    "role": "user",
-                                    "content": context
-                                }
-                            ],
-                            model="mixtral-8x7b-32768",
-                            temperature=temperature,
-                            max_tokens=1000,
-                            stream=False
-                        )
-                        
-                        ai_response = response.choices[0].message.content
-                        
+                    # Preparar contexto
+                    context = f"""
+                    Eres un especialista en biodescodificación emocional con 15 años de experiencia.
+                    Modo actual: {chat_mode}
+                    
+                    Responde a la siguiente pregunta del usuario:
+                    {user_input}
+                    
+                    Proporciona una respuesta útil, empática y basada en principios de biodescodificación.
+                    Si la pregunta requiere diagnóstico médico, recomienda consultar a un profesional.
+                    """
+                    
+                    request = {
+                        "messages": [
+                            {
+                                "role": "system",
+                                "content": "Eres un experto en biodescodificación. Responde de forma clara, empática y profesional."
+                            },
+                            {
+                                "role": "user",
+                                "content": context
+                            }
+                        ],
+                        "model": "mixtral-8x7b-32768",
+                        "temperature": temperature,
+                        "max_tokens": 1000
+                    }
+                    
+                    if streaming:
+                        # Los tokens se muestran a medida que llegan; write_stream devuelve el texto completo
+                        stream = groq_client.chat.completions.create(**request, stream=True)
+                        with chat_container:
+                            with st.chat_message("assistant"):
+                                ai_response = st.write_stream(iter_completion_text(stream))
+                        displayed = True
                     else:
-                        # Respuesta de fallback
-                        ai_response = """
-                        Hola, soy tu asistente de biodescodificación. 
-                        
-                        Lamentablemente, el servicio de IA no está disponible en este momento. 
-                        
-                        Te recomiendo:
-                        1. Completar nuestro diagnóstico automático en la sección correspondiente
-                        2. Explorar nuestras sesiones guiadas de meditación
-                        3. Contactarnos por email para consultas específicas
-                        
-                        Mientras tanto, te comparto un principio básico de biodescodificación:
-                        Cada síntoma físico tiene una correspondencia emocional. Escuchar el mensaje del cuerpo es el primer paso hacia la sanación.
-                        """
+                        with st.spinner("El especialista está pensando..."):
+                            response = groq_client.chat.completions.create(**request, stream=False)
+                        ai_response = response.choices[0].message.content
                     
-                    # Agregar respuesta al historial
-                    st.session_state.chat_history.append({
-                        'role': 'assistant',
-                        'content': ai_response,
-                        'timestamp': datetime.now().isoformat()
-                    })
+                else:
+                    # Respuesta de fallback
+                    ai_response = """
+                    Hola, soy tu asistente de biodescodificación. 
                     
-                    # Mostrar respuesta
+                    Lamentablemente, el servicio de IA no está disponible en este momento. 
+                    
+                    Te recomiendo:
+                    1. Completar nuestro diagnóstico automático en la sección correspondiente
+                    2. Explorar nuestras sesiones guiadas de meditación
+                    3. Contactarnos por email para consultas específicas
+                    
+                    Mientras tanto, te comparto un principio básico de biodescodificación:
+                    Cada síntoma físico tiene una correspondencia emocional. Escuchar el mensaje del cuerpo es el primer paso hacia la sanación.
+                    """
+                
+                # Agregar respuesta al historial
+                st.session_state.chat_history.append({
+                    'role': 'assistant',
+                    'content': ai_response,
+                    'timestamp': datetime.now().isoformat()
+                })
+                
+                # Mostrar respuesta
+                if not displayed:
                     with chat_container:
                         st.chat_message("assistant").write(ai_response)
-                    
-                except Exception as e:
-                    st.error(f"Error en el chat: {str(e)}")
+                
+            except Exception as e:
+                st.error(f"Error en el chat: {str(e)}")
         
         # Opciones adicionales
         st.divider()
@@ -4202,20 +7391,15 @@ class PageRenderer:
             
             if submitted:
                 # Buscar afiliado por email o ID
-                db = self.db.load_affiliates()
-                
                 found_affiliate = None
                 
                 # Buscar por ID
-                if affiliate_id and affiliate_id in db["affiliates"]:
-                    found_affiliate = db["affiliates"][affiliate_id]
+                if affiliate_id:
+                    found_affiliate = self.db.get_affiliate(affiliate_id)
                 
                 # Buscar por email
                 if not found_affiliate and email:
-                    for aff in db["affiliates"].values():
-                        if aff["email"] == email:
-                            found_affiliate = aff
-                            break
+                    found_affiliate = self.db.find_affiliate_by_email(email)
                 
                 if found_affiliate:
                     # Verificar estado
@@ -4276,7 +7460,7 @@ class PageRenderer:
         st.subheader("🎯 Tu Código de Referido")
         
         # Obtener código de referido
-        db = self.db.load_affiliates()
+        db = self.db.load_affiliates(readonly=True)
         affiliate = db["affiliates"].get(affiliate_id, {})
         referral_code = affiliate.get("referral_code", "N/A")
         
@@ -4599,6 +7783,37 @@ class PageRenderer:
             with col_serv4:
                 status = service_icons.get(services.get("storage", False), "❓")
                 st.metric("Almacenamiento", status)
+            
+            # Precarga en segundo plano
+            warmup = health.get("warmup", {})
+            if warmup.get("enabled"):
+                if warmup.get("ready"):
+                    st.caption(f"🔥 Precarga completada en {warmup.get('elapsed_ms', 0):,.0f} ms")
+                else:
+                    st.caption("⏳ Precarga en curso...")
+            
+            # Caché de diagnósticos del LLM
+            diagnosis_cache = health.get("diagnosis_cache", {})
+            st.caption(
+                f"🧠 Caché de diagnósticos: {diagnosis_cache.get('hit_rate', 0.0)}% de aciertos "
+                f"({diagnosis_cache.get('entries', 0)} perfiles en memoria)"
+            )
+            
+            # Proveedores de IA (orden de failover, latencia y errores)
+            for name, provider in health.get("ai_providers", {}).get("providers", {}).items():
+                p95 = provider.get("p95_ms")
+                st.caption(
+                    f"🤖 {name}: {provider.get('requests', 0)} peticiones, "
+                    f"p95 {f'{p95:,.0f} ms' if p95 is not None else 'N/D'}, "
+                    f"{provider.get('error_rate', 0.0)}% de errores"
+                )
+            
+            # Tiempos por etapa del diagnóstico
+            pipeline = health.get("diagnosis_pipeline", {})
+            if pipeline:
+                st.caption("⏱️ Diagnóstico (mediana): " + ", ".join(
+                    f"{stage} {timing['median_ms']:,.0f} ms" for stage, timing in pipeline.items()
+                ))
     
     def _render_admin_affiliates(self):
         """Renderiza gestión de afiliados"""
@@ -4618,7 +7833,7 @@ class PageRenderer:
                 st.rerun()
         
         # Cargar afiliados
-        db = self.db.load_affiliates()
+        db = self.db.load_affiliates(readonly=True)
         affiliates = list(db.get("affiliates", {}).values())
         
         # Aplicar filtros
@@ -4830,14 +8045,13 @@ class PageRenderer:
     def _update_payment_status(self, payment_data: dict):
         """Actualiza estado de pago en base de datos"""
         try:
-            payments = self.db.load_payments()
-            
-            for i, p in enumerate(payments):
-                if p.get('payment_id') == payment_data.get('payment_id'):
-                    payments[i] = payment_data
-                    break
+            if not payment_data.get('payment_id'):
+                logger.warning("Pago sin payment_id: no se puede actualizar")
+                return
             
-            self.db.save_payments(payments)
+            # Solo se registran los campos que cambian con el estado
+            changes = {k: payment_data[k] for k in ('status', 'completed_date') if k in payment_data}
+            self.db.update_payment_fields(payment_data['payment_id'], changes)
             
         except Exception as e:
             logger.error(f"Error actualizando estado de pago: {e}")
@@ -4864,6 +8078,17 @@ class PageRenderer:
             # Tabla detallada
             st.dataframe(top_df, use_container_width=True)
         
+        if stats and stats.get('diagnoses_by_day'):
+            st.subheader("🩺 Diagnósticos por Día")
+            
+            diag_df = pd.DataFrame(
+                list(stats['diagnoses_by_day'].items()),
+                columns=['Fecha', 'Diagnósticos']
+            ).tail(30)
+            
+            fig_diag = px.bar(diag_df, x='Fecha', y='Diagnósticos', title='Diagnósticos (últimos 30 días con actividad)')
+            st.plotly_chart(fig_diag, use_container_width=True)
+        
         # Análisis de conversión
         st.subheader("📊 Análisis de Conversión")
         
@@ -4981,36 +8206,51 @@ class PageRenderer:
             
             with col_back2:
                 if st.button("🗑️ Limpiar cache", use_container_width=True, type="secondary"):
-                    st.success("Cache limpiado (simulado)")
+                    STORE_CACHE.clear()
+                    st.success("Cache limpiado")
             
             # Exportar datos
             st.subheader("📁 Exportar Datos")
             
-            col_exp1, col_exp2 = st.columns(2)
+            col_exp1, col_exp2, col_exp3 = st.columns([2, 1, 1])
             
             with col_exp1:
-                if st.button("📊 Exportar afiliados", use_container_width=True):
-                    db = self.db.load_affiliates()
-                    json_data = json.dumps(db, indent=2, ensure_ascii=False)
-                    
-                    st.download_button(
-                        label="Descargar JSON",
-                        data=json_data,
-                        file_name=f"affiliates_backup_{datetime.now().strftime('%Y%m%d')}.json",
-                        mime="application/json"
-                    )
+                export_table = st.selectbox(
+                    "Tabla",
+                    list(TABLE_STORES),
+                    key="admin_export_table"
+                )
             
             with col_exp2:
-                if st.button("💰 Exportar pagos", use_container_width=True):
-                    payments = self.payment_system.get_payment_history()
-                    json_data = json.dumps(payments, indent=2, ensure_ascii=False)
-                    
-                    st.download_button(
-                        label="Descargar JSON",
-                        data=json_data,
-                        file_name=f"payments_backup_{datetime.now().strftime('%Y%m%d')}.json",
-                        mime="application/json"
+                export_format = st.selectbox("Formato", EXPORT_FORMATS, key="admin_export_format")
+            
+            with col_exp3:
+                st.write("")
+                generate_export = st.button("📦 Generar exportación", use_container_width=True)
+            
+            if generate_export:
+                progress_text = st.empty()
+                try:
+                    path, count = self.exporter.export_table(
+                        export_table,
+                        export_format,
+                        progress=lambda n: progress_text.caption(f"⏳ {n:,} registros exportados...")
                     )
+                    self._store_export("admin_export", path, count)
+                    st.session_state.admin_export.update({"table": export_table, "format": export_format})
+                    progress_text.caption(f"✅ Exportación lista: {count:,} registros")
+                except Exception as e:
+                    progress_text.empty()
+                    st.error(f"❌ Error exportando {export_table}: {e}")
+            
+            export = st.session_state.get("admin_export")
+            if export:
+                self._serve_export(
+                    "admin_export",
+                    f"Descargar {export['table']}.{export['format']}",
+                    f"{export['table']}_backup_{datetime.now().strftime('%Y%m%d')}.{export['format']}",
+                    DataExporter.MIME_TYPES[export["format"]]
+                )
     
     def _render_admin_tests(self):
         """Renderiza pruebas administrativas"""
@@ -5039,14 +8279,14 @@ class PageRenderer:
         
         with col_db1:
             if st.button("🔍 Ver estadísticas BD", use_container_width=True):
-                db = self.db.load_affiliates()
+                db = self.db.load_affiliates(readonly=True)
                 stats = db.get("statistics", {})
                 st.json(stats)
         
         with col_db2:
             if st.button("🔄 Verificar conexión", use_container_width=True):
                 try:
-                    db = self.db.load_affiliates()
+                    db = self.db.load_affiliates(readonly=True)
                     st.success(f"✅ Base de datos conectada. {len(db.get('affiliates', {}))} afiliados.")
                 except Exception as e:
                     st.error(f"❌ Error: {e}")
@@ -5095,6 +8335,25 @@ class PageRenderer:
                 except Exception as e:
                     st.error(f"❌ Error en IA: {e}")
 
+# Páginas de la aplicación: método que las dibuja y servicios que necesitan.
+# Los servicios se construyen la primera vez que alguien navega a la página,
+# de modo que pagos, analítica y email no se cargan en sesiones de pacientes.
+PAGE_REGISTRY = {
+    "home": {"render": "render_home", "services": ("db",)},
+    "diagnostic": {"render": "render_diagnostic", "services": ("ai_system", "diagnosis_jobs", "pdf_generator")},
+    "sessions": {"render": "render_sessions", "services": ("hypnosis_system",)},
+    "stats": {"render": "render_stats", "services": ("exporter",)},
+    "chat": {"render": "render_chat", "services": ()},
+    "affiliate": {
+        "render": "render_affiliate",
+        "services": ("db", "email_service", "payment_system", "analytics")
+    },
+    "admin": {
+        "render": "render_admin",
+        "services": ("db", "email_service", "payment_system", "analytics", "exporter")
+    }
+}
+
 # ============================================
 # PARTE 13: APLICACIÓN PRINCIPAL
 # ============================================
@@ -5104,7 +8363,10 @@ def main():
     
     # Inicializar sistemas
     config = ConfigManager()
-    page_renderer = PageRenderer()
+    preload_modules(config.performance_config["eager_imports"])
+    if config.performance_config["warmup"]:
+        get_warmup()
+    page_renderer = PageRenderer(get_services())
     
     # Verificar modo mantenimiento
     if config.app_config.get("maintenance_mode", False):
@@ -5123,21 +8385,7 @@ def main():
     
     # Navegar a página seleccionada
     current_page = st.session_state.get("page", "home")
-    
-    if current_page == "home":
-        page_renderer.render_home()
-    elif current_page == "diagnostic":
-        page_renderer.render_diagnostic()
-    elif current_page == "sessions":
-        page_renderer.render_sessions()
-    elif current_page == "stats":
-        page_renderer.render_stats()
-    elif current_page == "chat":
-        page_renderer.render_chat()
-    elif current_page == "affiliate":
-        page_renderer.render_affiliate()
-    elif current_page == "admin":
-        page_renderer.render_admin()
+    page_renderer.render_page(current_page)
     
     # Footer
     st.markdown("---")
@@ -5153,9 +8401,99 @@ def main():
     with col_foot3:
         st.markdown(f"v{config.app_config.get('version', '5.0')}")
 
+# ============================================
+# HERRAMIENTAS DE LÍNEA DE COMANDOS
+# ============================================
+
+def convert_data_files(data_dir: str, target: str) -> int:
+    """Reescribe los archivos de los almacenes (incluidos los shards) en otro formato"""
+    serializer = get_serializer(target)
+    if serializer.name != target:
+        print(f"❌ El formato {target} no está disponible")
+        return 1
+    
+    if os.path.exists(os.path.join(data_dir, "transaction.intent.json")):
+        print("❌ Hay una transacción pendiente; arranca la aplicación una vez antes de convertir")
+        return 1
+    
+    # Solo los almacenes: instantáneas, caché y trabajos de diagnóstico se leen como JSON
+    paths = store_data_files(data_dir)
+    
+    total_before = total_after = 0
+    for path in paths:
+        before = os.path.getsize(path)
+        data = read_data_file(path)
+        write_data_file(path + ".tmp", data, serializer)
+        os.replace(path + ".tmp", path)
+        after = os.path.getsize(path)
+        total_before += before
+        total_after += after
+        print(f"  {path}: {before:,} -> {after:,} bytes")
+    
+    print(f"✅ {len(paths)} archivos convertidos a {target}: {total_before:,} -> {total_after:,} bytes")
+    print(f"   Configura serializer = \"{target}\" en [database] para seguir escribiendo en este formato")
+    return 0
+
+
+def export_store(table: str, fmt: str, output: str) -> int:
+    """Exporta una tabla a un archivo sin cargarla completa en memoria"""
+    storage = DatabaseManager().storage
+    progress = lambda count: print(f"  exportados: {count:,} registros", file=sys.stderr)
+    count = write_records(with_progress(storage.iter_items(table), progress, every=10000), output, fmt)
+    print(f"✅ {count:,} registros de {table} exportados a {output}")
+    return 0
+
+
+def import_store(table: str, fmt: str, source: str) -> int:
+    """Importa (inserta o actualiza) los registros de un archivo en una tabla"""
+    storage = DatabaseManager().storage
+    progress = lambda count: print(f"  importados: {count:,} registros", file=sys.stderr)
+    count = storage.put_many(table, with_progress(read_records(source, fmt), progress, every=10000))
+    print(f"✅ {count:,} registros importados en {table} desde {source}")
+    return 0
+
+
+def run_cli(argv: list) -> int:
+    """Punto de entrada de los comandos de mantenimiento (python app.py <comando>)"""
+    parser = argparse.ArgumentParser(prog="app.py", description="Herramientas de datos de MINDGEEKCLINIC")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    convert = subparsers.add_parser("convert", help="Convierte los archivos de datos a otro formato")
+    convert.add_argument("--to", required=True, choices=sorted(SERIALIZERS), help="Formato de destino")
+    convert.add_argument("--data-dir", default="data/", help="Directorio de datos")
+    
+    export = subparsers.add_parser("export", help="Exporta una tabla en streaming")
+    export.add_argument("--store", required=True, choices=sorted(TABLE_STORES), help="Tabla a exportar")
+    export.add_argument("--format", default="jsonl", choices=EXPORT_FORMATS)
+    export.add_argument("--output", help="Archivo de destino (por defecto <tabla>.<formato>)")
+    
+    import_parser = subparsers.add_parser("import", help="Importa registros exportados en una tabla")
+    import_parser.add_argument("--store", required=True, choices=sorted(TABLE_STORES), help="Tabla de destino")
+    import_parser.add_argument("--format", default="jsonl", choices=EXPORT_FORMATS)
+    import_parser.add_argument("--input", required=True, help="Archivo a importar")
+    
+    args = parser.parse_args(argv)
+    
+    try:
+        if args.command == "convert":
+            return convert_data_files(args.data_dir, args.to)
+        if args.command == "export":
+            return export_store(args.store, args.format, args.output or f"{args.store}.{args.format}")
+        if args.command == "import":
+            return import_store(args.store, args.format, args.input)
+    except (RuntimeError, ValueError, OSError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+    return 1
+
+
+# Comandos disponibles fuera de Streamlit
+CLI_COMMANDS = {"convert", "export", "import"}
+
 # ============================================
 # EJECUCIÓN
 # ============================================
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
@@ -0,0 +1,82 @@
+"""Benchmark de generación de reportes PDF
+
+Mide reportes por segundo de PDFGenerator con los recursos compartidos del
+proceso (estilos, TableStyle y flowables fijos) frente a reconstruirlos en
+cada reporte, que era el comportamiento anterior.
+
+    python benchmarks/bench_pdf.py [--reports 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import PDFGenerator  # noqa: E402
+
+DIAGNOSIS = {
+    "diagnosis": {
+        "analysis": "Conflicto de territorio asociado a presión laboral sostenida.\nTensión acumulada.",
+        "conflict": "Territorio",
+        "biodescodification_insights": [
+            {"symptom": "migraña", "conflict": "Imposibilidad de resolver un problema"},
+            {"symptom": "gastritis", "conflict": "Algo que no se puede digerir"}
+        ]
+    },
+    "emotional_analysis": {
+        "primary_emotions": ["ansiedad", "preocupación"],
+        "intensity_level": "moderado",
+        "emotional_patterns": ["Ansiedad anticipatoria"],
+        "emotional_needs": ["seguridad"]
+    },
+    "physical_analysis": {"body_mind_connection": ["Cabeza: control y sobrecarga mental"]},
+    "treatment_plan": {
+        "duration_days": 30,
+        "daily_practices": ["Respiración consciente 10 min", "Diario emocional"],
+        "weekly_sessions": ["Relajación profunda"],
+        "diet_recommendations": ["Reducir estimulantes"],
+        "monitoring": ["Escala de humor (1-10)"]
+    },
+    "recommendations": [f"Recomendación {i}" for i in range(1, 8)],
+    "timestamp": "2024-12-01T10:00:00",
+    "session_id": "DIAG_BENCH"
+}
+
+USER_INFO = {"name": "Paciente de prueba", "age": 35, "gender": "Femenino"}
+
+
+def measure(build_generator, reports: int) -> float:
+    """Reportes por segundo"""
+    start = time.perf_counter()
+    for _ in range(reports):
+        build_generator().generate_diagnostic_report(DIAGNOSIS, USER_INFO)
+    return reports / (time.perf_counter() - start)
+
+
+def uncached_generator() -> PDFGenerator:
+    PDFGenerator.clear_cache()
+    return PDFGenerator()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reports", type=int, default=200)
+    args = parser.parse_args()
+
+    # Calentamiento: importación de reportlab y primeras fuentes
+    PDFGenerator().generate_diagnostic_report(DIAGNOSIS, USER_INFO)
+
+    without_cache = measure(uncached_generator, args.reports)
+    PDFGenerator.clear_cache()
+    with_cache = measure(PDFGenerator, args.reports)
+
+    print(f"{'modo':>14} {'reportes/s':>11}")
+    print(f"{'sin caché':>14} {without_cache:>11.1f}")
+    print(f"{'con caché':>14} {with_cache:>11.1f}")
+    print(f"{'mejora':>14} {with_cache / without_cache:>10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
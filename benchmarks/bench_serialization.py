@@ -0,0 +1,99 @@
+"""Benchmark de los formatos de archivo de datos
+
+Compara latencia de guardado/carga y tamaño en disco de un documento de
+afiliados sintético con 1k, 10k y 100k afiliados para cada serializador
+disponible.
+
+    python benchmarks/bench_serialization.py [--sizes 1000 10000 100000] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import SERIALIZERS, MSGPACK_AVAILABLE, read_data_file, write_data_file  # noqa: E402
+
+
+def build_affiliates_document(count: int) -> dict:
+    """Documento con la misma forma que affiliates_db"""
+    rng = random.Random(count)
+    affiliates, referrals = {}, {}
+    
+    for i in range(1, count + 1):
+        affiliate_id = f"AFF{i:04d}"
+        code = f"MG{i:06d}"
+        affiliates[affiliate_id] = {
+            "id": affiliate_id,
+            "referral_code": code,
+            "status": rng.choice(["active", "pending", "suspended"]),
+            "registration_date": "2024-01-01T10:00:00",
+            "full_name": f"Afiliado Número {i}",
+            "email": f"afiliado{i}@ejemplo.com",
+            "country": "España",
+            "total_earnings": round(rng.uniform(0, 5000), 2),
+            "pending_earnings": round(rng.uniform(0, 500), 2),
+            "commission_rate": 0.30,
+            "referrals_count": rng.randint(0, 20),
+            "payment_method": "binance",
+            "payment_address": f"0x{rng.getrandbits(160):040x}"
+        }
+        referrals[code] = {
+            "affiliate_id": affiliate_id,
+            "referrals": [
+                {"user_id": f"guest_{i}_{j}", "timestamp": "2024-02-01T12:00:00",
+                 "converted": j % 3 == 0, "conversion_date": None, "commission": 0.0}
+                for j in range(rng.randint(0, 5))
+            ],
+            "conversions": 0,
+            "total_commission": 0.0
+        }
+    
+    return {"affiliates": affiliates, "referrals": referrals, "next_id": count + 1, "statistics": {}}
+
+
+def measure(serializer, document: dict, directory: str, repeat: int) -> dict:
+    path = os.path.join(directory, f"bench.{serializer.name}")
+    save_times, load_times = [], []
+    
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write_data_file(path, document, serializer)
+        save_times.append(time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        read_data_file(path)
+        load_times.append(time.perf_counter() - start)
+    
+    return {
+        "save_ms": statistics.median(save_times) * 1000,
+        "load_ms": statistics.median(load_times) * 1000,
+        "size_kb": os.path.getsize(path) / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    
+    serializers = [s for s in SERIALIZERS.values() if s.name != "msgpack" or MSGPACK_AVAILABLE]
+    
+    print(f"{'afiliados':>10} {'formato':>13} {'guardar ms':>11} {'cargar ms':>10} {'tamaño KB':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            document = build_affiliates_document(size)
+            for serializer in serializers:
+                result = measure(serializer, document, directory, args.repeat)
+                print(f"{size:>10} {serializer.name:>13} {result['save_ms']:>11.1f} "
+                      f"{result['load_ms']:>10.1f} {result['size_kb']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
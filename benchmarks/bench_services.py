@@ -0,0 +1,63 @@
+"""Benchmark del coste de construir los servicios en cada rerun
+
+Compara el tiempo de preparar los servicios como se hacía antes (todos los
+servicios nuevos en cada rerun) con el contenedor compartido del proceso,
+que solo construye los servicios declarados por la página visitada.
+Se ejecuta en un directorio temporal para no tocar data/.
+
+    python benchmarks/bench_services.py [--reruns 20]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import PAGE_REGISTRY, PageRenderer, ServiceContainer, get_services  # noqa: E402
+
+ALL_SERVICES = sorted({name for page in PAGE_REGISTRY.values() for name in page["services"]})
+
+
+def measure(build, reruns: int) -> dict:
+    times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        build()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "first_ms": times[0] * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "max_ms": max(times) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reruns", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        results = {
+            "servicios nuevos": measure(
+                lambda: PageRenderer(ServiceContainer()).services.require(ALL_SERVICES), args.reruns
+            )
+        }
+        for page, definition in PAGE_REGISTRY.items():
+            results[f"compartido ({page})"] = measure(
+                lambda: PageRenderer(get_services()).services.require(definition["services"]), args.reruns
+            )
+
+    print(f"{'modo':>24} {'primer rerun ms':>16} {'mediana ms':>11} {'máximo ms':>10}")
+    for mode, result in results.items():
+        print(f"{mode:>24} {result['first_ms']:>16.2f} {result['median_ms']:>11.2f} {result['max_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Benchmark de arranque en frío y coste por rerun
+
+Mide, sin navegador y con el LLM y el SMTP simulados:
+
+  * tiempo de importación por paquete (resumen de `python -X importtime`)
+  * tiempo de construcción de cada servicio (DatabaseManager, AIDiagnosticSystem, ...)
+  * tiempo hasta la página de inicio renderizada en un proceso nuevo
+  * tiempo de cada rerun de main() para cada página de PageRenderer
+
+Las páginas se ejecutan con streamlit.testing (AppTest). El resultado se emite
+en JSON para poder compararlo entre commits:
+
+    python benchmarks/bench_startup.py [--reruns 5] [--output startup.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from unittest import mock
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_PATH = os.path.join(REPO_DIR, "app.py")
+sys.path.insert(0, REPO_DIR)
+
+PAGES = ["home", "diagnostic", "sessions", "stats", "chat", "affiliate", "admin"]
+
+SERVICES = ["DatabaseManager", "EmailService", "AIDiagnosticSystem", "HypnosisSystem",
+            "PDFGenerator", "PaymentSystem", "AnalyticsSystem"]
+
+BENCH_SECRETS = {
+    "email": {
+        "smtp_server": "smtp.invalid", "smtp_port": 465, "username": "bench",
+        "password": "bench", "sender_email": "bench@invalid", "admin_email": "admin@invalid"
+    },
+    "groq": {"api_key": "bench"},
+    "openai": {"api_key": "bench"},
+    "anthropic": {"api_key": "bench"},
+    "app": {"admin_password": "bench", "admin_email": "admin@invalid", "name": "MINDGEEKCLINIC"},
+    "affiliates": {"commission_rate": 0.30, "min_payout": 50.0, "payout_day": "thursday",
+                   "default_currency": "USD"}
+}
+
+FAKE_DIAGNOSIS = json.dumps({
+    "analysis": "Diagnóstico simulado para el benchmark",
+    "conflict": "Conflicto simulado",
+    "recommendations": ["Respiración consciente"]
+}, ensure_ascii=False)
+
+
+# ============================================
+# SIMULACIÓN DE LLM Y SMTP
+# ============================================
+
+def _fake_completion(*args, **kwargs):
+    message = types.SimpleNamespace(content=FAKE_DIAGNOSIS)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class _FakeLLMClient:
+    """Cliente con la forma de Groq/OpenAI/Anthropic que responde al instante"""
+
+    def __init__(self, *args, **kwargs):
+        completions = types.SimpleNamespace(create=_fake_completion)
+        self.chat = types.SimpleNamespace(completions=completions)
+        self.messages = types.SimpleNamespace(create=_fake_completion)
+
+
+def install_fakes():
+    """Sustituye los SDK de LLM y el SMTP antes de importar la aplicación"""
+    for module_name, class_name in (("groq", "Groq"), ("openai", "OpenAI"),
+                                    ("anthropic", "Anthropic"), ("cohere", "Client")):
+        module = types.ModuleType(module_name)
+        setattr(module, class_name, _FakeLLMClient)
+        sys.modules[module_name] = module
+
+    mock.patch("smtplib.SMTP").start()
+    mock.patch("smtplib.SMTP_SSL").start()
+
+
+# ============================================
+# MEDICIONES
+# ============================================
+
+def measure_imports(top: int) -> dict:
+    """Resume `-X importtime` de `import app` por paquete de primer nivel"""
+    with tempfile.TemporaryDirectory() as directory:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app"],
+            cwd=directory,
+            env=dict(os.environ, PYTHONPATH=REPO_DIR),
+            capture_output=True,
+            text=True
+        )
+
+    self_us = defaultdict(int)
+    app_cumulative_us = None
+    pattern = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+    for line in result.stderr.splitlines():
+        match = pattern.match(line)
+        if not match:
+            continue
+        own, cumulative, _, name = match.groups()
+        self_us[name.split(".")[0]] += int(own)
+        if name == "app":
+            app_cumulative_us = int(cumulative)
+
+    packages = sorted(self_us.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "app_total_ms": round(app_cumulative_us / 1000, 1) if app_cumulative_us else None,
+        "packages_ms": {name: round(us / 1000, 1) for name, us in packages[:top]},
+        "packages_loaded": len(self_us),
+        "returncode": result.returncode
+    }
+
+
+def measure_constructors(repeat: int) -> dict:
+    """Tiempo de construcción de cada servicio (el primero incluye importaciones diferidas)"""
+    import app
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        for name in SERVICES:
+            cls = getattr(app, name)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                cls()
+                times.append(time.perf_counter() - start)
+            results[name] = {
+                "first_ms": round(times[0] * 1000, 2),
+                "median_ms": round(statistics.median(times) * 1000, 2)
+            }
+        os.chdir(REPO_DIR)
+    return results
+
+
+def _new_app_test():
+    from streamlit.testing.v1 import AppTest
+
+    app_test = AppTest.from_file(APP_PATH, default_timeout=120)
+    for section, values in BENCH_SECRETS.items():
+        app_test.secrets[section] = values
+    return app_test
+
+
+def measure_pages(reruns: int) -> dict:
+    """Tiempo de cada rerun de main() por página, en una misma sesión"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        app_test = _new_app_test()
+        app_test.run()
+
+        for page in PAGES:
+            times = []
+            for _ in range(reruns):
+                app_test.session_state["page"] = page
+                start = time.perf_counter()
+                app_test.run()
+                times.append(time.perf_counter() - start)
+            results[page] = {
+                "first_ms": round(times[0] * 1000, 2),
+                "median_ms": round(statistics.median(times) * 1000, 2),
+                "exceptions": len(app_test.exception)
+            }
+        os.chdir(REPO_DIR)
+    return results
+
+
+def measure_cold_start() -> dict:
+    """Proceso nuevo hasta la página de inicio renderizada"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--cold-child"],
+        capture_output=True,
+        text=True
+    )
+    total = time.perf_counter() - start
+
+    child = json.loads(result.stdout) if result.returncode == 0 and result.stdout.strip() else {}
+    return {
+        "process_to_home_ms": round(total * 1000, 1),
+        "first_run_ms": child.get("first_run_ms"),
+        "returncode": result.returncode
+    }
+
+
+def cold_child():
+    """Proceso hijo de measure_cold_start: renderiza la página de inicio una vez"""
+    with contextlib.redirect_stdout(sys.stderr):
+        install_fakes()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            start = time.perf_counter()
+            _new_app_test().run()
+            first_run = time.perf_counter() - start
+            os.chdir(REPO_DIR)
+    print(json.dumps({"first_run_ms": round(first_run * 1000, 1)}))
+
+
+def _git_commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                            capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reruns", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="paquetes a listar en importaciones")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto stdout)")
+    parser.add_argument("--cold-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_child:
+        cold_child()
+        return
+
+    report = {
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "imports": measure_imports(args.top),
+        "cold_start": measure_cold_start()
+    }
+
+    # Los mensajes que la aplicación imprime al importarse no deben mezclarse con el JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        install_fakes()
+        report["constructors"] = measure_constructors(args.reruns)
+        report["pages"] = measure_pages(args.reruns)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()